@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Benchmark del Spotify MCP Server
+Arranca la API simulada (fake_spotify_api.py), lanza fixed_server.py por stdio como lo haría un cliente MCP
+y mide la latencia (p50/p95/p99) y las peticiones por segundo de cada herramienta.
+
+Ejemplos:
+    # Medición básica
+    python benchmark.py --requests 200 --concurrency 8 --latency 50
+    
+    # Guardar una línea base y comparar después para detectar regresiones
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json --tolerance 0.2
+    
+    # Comparar modos: por ejemplo, sin caché de búsquedas
+    python benchmark.py --tools search_track --env SPOTIFY_MCP_SEARCH_CACHE_SIZE=0
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+
+import requests
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+
+from fake_spotify_api import FakeConfig, start_fake_server
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixed_server.py")
+TOKEN_KEY = "benchmark-token-key"
+
+QUERIES = ["love", "night dream", "fire", "heart summer", "blue rain", "dance", "light river", "gold", "shadow wild", "moon city"]
+
+# Argumentos de cada herramienta en función del número de llamada
+SCENARIOS = {
+    "search_track": lambda i: {"query": QUERIES[i % len(QUERIES)], "limit": 10},
+    "search_album": lambda i: {"query": QUERIES[i % len(QUERIES)], "limit": 10},
+    "get_profile": lambda i: {},
+    "get_tracks": lambda i: {"track_ids": [f"track{(i * 37 + j) % 2000:06d}" for j in range(120)]},
+    "get_audio_features": lambda i: {"track_ids": [f"track{(i * 37 + j) % 2000:06d}" for j in range(150)]},
+    "get_user_playlists": lambda i: {"fetch_all": True},
+    "get_user_playlists_page": lambda i: {"limit": 50},
+    "play": lambda i: {"track_id": f"track{i % 2000:06d}"},
+    "pause": lambda i: {},
+    "now_playing": lambda i: {},
+    "create_playlist": lambda i: {"name": f"Benchmark {i}", "description": "benchmark"},
+    "search_library": lambda i: {"query": QUERIES[i % len(QUERIES)], "limit": 20},
+    "sync_library": lambda i: {},
+    "build_playlist_from_queries": lambda i: {"name": f"Benchmark {i}", "queries": [f"{QUERIES[j % len(QUERIES)]} {j}" for j in range(200)]},
+    # Cada llamada sincroniza su propia playlist: con una sola, las llamadas simultáneas chocan por snapshot_id (409)
+    "sync_playlist": lambda i: {"playlist_id": f"playlist{(i % 100) + 2:05d}", "track_ids": [f"track{(i * 3 + j) % 2000:06d}" for j in range(300)]},
+    "export_listening_data": lambda i: {"dataset": "saved_tracks", "path": f"saved_tracks_{i}.ndjson"},
+    "add_tracks_to_playlist": lambda i: {"playlist_id": "playlist00001", "track_ids": [f"track{(i + j) % 2000:06d}" for j in range(250)]},
+}
+DEFAULT_TOOLS = ["search_track", "search_album", "get_profile", "get_audio_features", "get_user_playlists", "play", "pause"]
+
+# Percentil por el método del rango más cercano
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+# Detectar respuestas de error devueltas como datos por las herramientas
+def is_error_result(result):
+    if result.isError:
+        return True
+    for content in result.content:
+        text = getattr(content, "text", "")
+        if text.startswith("{") and '"error"' in text:
+            try:
+                return "error" in json.loads(text)
+            except ValueError:
+                return False
+    return False
+
+# Preparar credenciales y un token válido en un directorio temporal
+def prepare_environment(base_url, workdir, extra_env):
+    with open(os.path.join(workdir, "spotify_credentials.py"), "w") as f:
+        f.write('SPOTIFY_CLIENT_ID = "benchmark"\nSPOTIFY_CLIENT_SECRET = "benchmark"\n')
+    
+    # Pedir un token al simulador y guardarlo cifrado como lo haría el servidor
+    response = requests.post(f"{base_url}/api/token", data={"grant_type": "authorization_code", "code": "benchmark"}, timeout=10)
+    token = response.json()
+    token["expires_at"] = int(time.time()) + token["expires_in"]
+    
+    store_path = os.path.join(workdir, "token.enc")
+    sys.path.insert(0, workdir)
+    from fixed_server import EncryptedFileCacheHandler
+    EncryptedFileCacheHandler(store_path, TOKEN_KEY).save_token_to_cache(token)
+    
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": os.pathsep.join([workdir, env.get("PYTHONPATH", "")]),
+        "SPOTIFY_MCP_API_BASE": f"{base_url}/v1",
+        "SPOTIFY_MCP_ACCOUNTS_BASE": base_url,
+        "SPOTIFY_MCP_TOKEN_STORE": store_path,
+        "SPOTIFY_MCP_TOKEN_KEY": TOKEN_KEY,
+        "SPOTIFY_MCP_HTTP_CACHE": os.path.join(workdir, "http_cache.db"),
+        "SPOTIFY_MCP_EXPORT_DIR": os.path.join(workdir, "exports"),
+        # El simulador no limita el ritmo salvo con --rate-limit-rate; se puede restaurar con --env
+        "SPOTIFY_MCP_RATE_LIMIT_REQUESTS": "100000"
+    })
+    env.update(extra_env)
+    return env
+
+# Ejecutar las llamadas de una herramienta con concurrencia limitada
+async def run_tool(session, tool, total, concurrency, warmup):
+    make_args = SCENARIOS[tool]
+    for i in range(warmup):
+        await session.call_tool(tool, make_args(i))
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    
+    async def call(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            result = await session.call_tool(tool, make_args(i))
+            latencies.append((time.perf_counter() - start) * 1000)
+            if is_error_result(result):
+                errors += 1
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(call(i) for i in range(warmup, warmup + total)))
+    elapsed = time.perf_counter() - started
+    
+    latencies.sort()
+    return {
+        "calls": total,
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+        "rps": round(total / elapsed, 1) if elapsed else 0.0
+    }
+
+def upstream_stats(base_url):
+    return requests.get(f"{base_url}/_stats", timeout=10).json()
+
+async def run_benchmark(args, base_url, env):
+    server = StdioServerParameters(command=sys.executable, args=[SERVER_PATH], env=env)
+    errlog = sys.stderr if args.verbose else open(os.devnull, "w")
+    
+    results = {}
+    async with stdio_client(server, errlog=errlog) as (read, write):
+        async with ClientSession(read, write) as session:
+            started = time.perf_counter()
+            await session.initialize()
+            results["_startup"] = {"initialize_ms": round((time.perf_counter() - started) * 1000, 2)}
+            
+            for tool in args.tools:
+                before = upstream_stats(base_url)
+                results[tool] = await run_tool(session, tool, args.requests, args.concurrency, args.warmup)
+                after = upstream_stats(base_url)
+                upstream = sum(after.values()) - sum(before.values())
+                results[tool]["upstream_per_call"] = round(upstream / (args.requests + args.warmup), 2)
+    return results
+
+def print_report(results):
+    print(f"{'tool':<26}{'calls':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rps':>9}{'upstream':>10}")
+    for tool, stats in results.items():
+        if tool.startswith("_"):
+            continue
+        print(f"{tool:<26}{stats['calls']:>7}{stats['errors']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['rps']:>9}{stats['upstream_per_call']:>10}")
+    if "_startup" in results:
+        print(f"initialize: {results['_startup']['initialize_ms']} ms")
+
+# Comparar con una ejecución anterior; devuelve la lista de regresiones encontradas
+def compare_with_baseline(results, baseline, tolerance):
+    regressions = []
+    for tool, stats in results.items():
+        previous = baseline.get("results", {}).get(tool)
+        if tool.startswith("_") or not previous:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            # Ignorar variaciones de menos de 2 ms, que son ruido de medición
+            if stats[metric] > previous[metric] * (1 + tolerance) and stats[metric] - previous[metric] > 2:
+                regressions.append(f"{tool} {metric}: {previous[metric]} -> {stats[metric]}")
+        if stats["rps"] < previous["rps"] * (1 - tolerance):
+            regressions.append(f"{tool} rps: {previous['rps']} -> {stats['rps']}")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de latencia y rendimiento de las herramientas MCP")
+    parser.add_argument("--tools", nargs="+", default=DEFAULT_TOOLS, choices=sorted(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=100, help="Llamadas medidas por herramienta")
+    parser.add_argument("--concurrency", type=int, default=4, help="Llamadas simultáneas")
+    parser.add_argument("--warmup", type=int, default=3, help="Llamadas previas no medidas")
+    parser.add_argument("--latency", type=float, default=30.0, help="Latencia simulada de la API en ms")
+    parser.add_argument("--jitter", type=float, default=10.0, help="Variación de la latencia en ms")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Probabilidad de una respuesta lenta de la API")
+    parser.add_argument("--slow-ms", type=float, default=1000.0, help="Retraso extra de las respuestas lentas en ms")
+    parser.add_argument("--env", action="append", default=[], metavar="CLAVE=VALOR", help="Variables de entorno para el servidor")
+    parser.add_argument("--output", help="Guardar resultados en JSON")
+    parser.add_argument("--baseline", help="JSON de una ejecución anterior con el que comparar")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Empeoramiento relativo admitido frente a la línea base")
+    parser.add_argument("--verbose", action="store_true", help="Mostrar los logs del servidor")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    
+    fake_server, base_url = start_fake_server(FakeConfig(
+        latency_ms=args.latency,
+        jitter_ms=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        slow_rate=args.slow_rate,
+        slow_ms=args.slow_ms
+    ))
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            env = prepare_environment(base_url, workdir, extra_env)
+            results = asyncio.run(run_benchmark(args, base_url, env))
+    finally:
+        fake_server.shutdown()
+    
+    print_report(results)
+    
+    config = {key: getattr(args, key) for key in ("requests", "concurrency", "latency", "jitter", "error_rate", "rate_limit_rate", "slow_rate", "slow_ms")}
+    config["env"] = extra_env
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regresiones detectadas:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("Sin regresiones respecto a la línea base")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,715 @@
+#!/usr/bin/env python3
+"""
+Fake Spotify API
+Servidor local que imita los endpoints de la Web API y de cuentas de Spotify que usa fixed_server.py.
+Permite medir y probar el servidor MCP sin una cuenta real, con latencia, errores y respuestas 429 configurables.
+
+Uso:
+    python fake_spotify_api.py --port 8900 --latency 80 --rate-limit-rate 0.02
+
+Y arrancar el servidor MCP apuntando a él:
+    SPOTIFY_MCP_API_BASE=http://127.0.0.1:8900/v1 SPOTIFY_MCP_ACCOUNTS_BASE=http://127.0.0.1:8900 python fixed_server.py
+"""
+
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+
+WORDS = [
+    "love", "night", "dream", "fire", "heart", "summer", "blue", "rain", "dance", "light",
+    "river", "gold", "shadow", "wild", "moon", "city", "road", "star", "echo", "storm"
+]
+ARTISTS = [
+    "The Testers", "Mock Orchestra", "Latency Kings", "Cache Hit", "Null Pointer",
+    "Async Avenue", "Rate Limiters", "Packet Loss", "Keep Alive", "Retry After"
+]
+RECENTLY_PLAYED_SIZE = 50  # Reproducciones que conserva el historial
+TOP_ITEMS_SIZE = 100  # Canciones en el ranking de más escuchadas
+
+# Permisos concedidos a los tokens (los mismos que solicita fixed_server.py)
+GRANTED_SCOPE = (
+    "user-read-private user-read-email user-read-playback-state user-modify-playback-state "
+    "user-read-currently-playing playlist-read-private playlist-modify-private playlist-modify-public "
+    "user-follow-read user-follow-modify user-top-read user-read-recently-played user-library-read user-library-modify"
+)
+
+# Número determinista a partir de un texto, para generar datos estables entre ejecuciones
+def stable_hash(text):
+    return int(hashlib.md5(text.encode()).hexdigest(), 16)
+
+# Configuración de la simulación (latencia, errores y límites)
+class FakeConfig:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, rate_limit_rate=0.0,
+                 retry_after=1, catalogue_size=2000, playlists=120, saved_tracks=300, seed=42,
+                 slow_rate=0.0, slow_ms=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.catalogue_size = catalogue_size
+        self.playlists = playlists
+        self.saved_tracks = saved_tracks
+        self.slow_rate = slow_rate  # Probabilidad de una respuesta lenta (cola de latencia)
+        self.slow_ms = slow_ms
+        self.random = random.Random(seed)
+
+# Estado en memoria de la cuenta simulada
+class FakeSpotifyState:
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.tokens = {}
+        self.user = {
+            "id": "fake_user",
+            "display_name": "Fake User",
+            "email": "fake@example.com",
+            "country": "ES",
+            "product": "premium",
+            "followers": {"total": 42},
+            "images": [{"url": "https://i.scdn.co/image/fake", "height": 300, "width": 300}],
+            "type": "user",
+            "uri": "spotify:user:fake_user"
+        }
+        self.tracks = [self._make_track(i) for i in range(config.catalogue_size)]
+        self.tracks_by_id = {track["id"]: track for track in self.tracks}
+        self.albums_by_id = {}
+        for track in self.tracks:
+            self.albums_by_id.setdefault(track["album"]["id"], dict(track["album"], type="album", popularity=track["popularity"]))
+        self.artists_by_id = {
+            f"artist{index:03d}": {
+                "id": f"artist{index:03d}",
+                "name": name,
+                "type": "artist",
+                "genres": [WORDS[index % len(WORDS)] + " pop"],
+                "popularity": 50 + index,
+                "followers": {"total": 1000 * (index + 1)},
+                "images": [{"url": f"https://i.scdn.co/image/artist{index:03d}", "height": 640, "width": 640}]
+            }
+            for index, name in enumerate(ARTISTS)
+        }
+        self.playlists = {}
+        for i in range(config.playlists):
+            items = [self.tracks[(i * 7 + j) % len(self.tracks)]["id"] for j in range(i % 40)]
+            self.create_playlist(f"Playlist {i}", "", items)
+        # Canciones guardadas, de la más reciente a la más antigua
+        self.saved_tracks = [
+            {"added_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(1700000000 - i * 3600)), "track_id": self.tracks[(i * 13) % len(self.tracks)]["id"]}
+            for i in range(config.saved_tracks)
+        ]
+        self.playback = {"is_playing": False, "track_id": None, "progress_ms": 0, "updated": time.time()}
+        # Historial de reproducción (la API real solo conserva las 50 últimas), del más reciente al más antiguo
+        now_ms = int(time.time() * 1000)
+        self.recently_played = [
+            {"played_at_ms": now_ms - (i + 1) * 200000, "track_id": self.tracks[(i * 17) % len(self.tracks)]["id"]}
+            for i in range(RECENTLY_PLAYED_SIZE)
+        ]
+    
+    def record_play(self, track_id):
+        self.recently_played.insert(0, {"played_at_ms": int(time.time() * 1000), "track_id": track_id})
+        del self.recently_played[RECENTLY_PLAYED_SIZE:]
+    
+    # Ranking estable por periodo: el mismo time_range devuelve siempre el mismo orden
+    def top_items(self, item_type, time_range):
+        items = self.tracks[:TOP_ITEMS_SIZE] if item_type == "tracks" else list(self.artists_by_id.values())
+        return sorted(items, key=lambda item: stable_hash(f"{time_range}:{item['id']}"))
+    
+    def _make_track(self, index):
+        track_id = f"track{index:06d}"
+        name = " ".join(WORDS[(index * k + 3) % len(WORDS)] for k in (1, 3, 7)[: 1 + index % 3]).title()
+        artist = ARTISTS[index % len(ARTISTS)]
+        album_id = f"album{index // 10:05d}"
+        return {
+            "id": track_id,
+            "name": f"{name} {index}",
+            "uri": f"spotify:track:{track_id}",
+            "type": "track",
+            "duration_ms": 120000 + (index * 7919) % 180000,
+            "popularity": index % 100,
+            "preview_url": f"https://p.scdn.co/mp3-preview/{track_id}",
+            "explicit": index % 9 == 0,
+            "artists": [{"id": f"artist{index % len(ARTISTS):03d}", "name": artist, "type": "artist"}],
+            "album": {
+                "id": album_id,
+                "name": f"Album {index // 10}",
+                "release_date": f"{1990 + index % 35}-01-01",
+                "total_tracks": 10,
+                "album_type": "album",
+                "artists": [{"id": f"artist{index % len(ARTISTS):03d}", "name": artist}],
+                "images": [{"url": f"https://i.scdn.co/image/{album_id}", "height": 640, "width": 640}]
+            },
+            "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}"}
+        }
+    
+    def create_playlist(self, name, description, items=None, public=False):
+        playlist_id = f"playlist{len(self.playlists):05d}"
+        self.playlists[playlist_id] = {
+            "id": playlist_id,
+            "name": name,
+            "description": description,
+            "public": public,
+            "owner": {"id": self.user["id"], "display_name": self.user["display_name"]},
+            "items": list(items or []),
+            "snapshot": 1,
+            "external_urls": {"spotify": f"https://open.spotify.com/playlist/{playlist_id}"}
+        }
+        return self.playlists[playlist_id]
+    
+    def playlist_summary(self, playlist):
+        return {
+            "id": playlist["id"],
+            "name": playlist["name"],
+            "description": playlist["description"],
+            "public": playlist["public"],
+            "owner": playlist["owner"],
+            "snapshot_id": self.snapshot_id(playlist),
+            "tracks": {"total": len(playlist["items"])},
+            "images": [],
+            "external_urls": playlist["external_urls"]
+        }
+    
+    def snapshot_id(self, playlist):
+        return f"{playlist['id']}-snap{playlist['snapshot']}"
+    
+    def audio_features(self, track_id):
+        if track_id not in self.tracks_by_id:
+            return None
+        h = stable_hash(track_id)
+        return {
+            "id": track_id,
+            "danceability": (h % 1000) / 1000,
+            "energy": ((h >> 10) % 1000) / 1000,
+            "key": (h >> 20) % 12,
+            "loudness": -((h >> 24) % 300) / 10,
+            "mode": (h >> 30) % 2,
+            "speechiness": ((h >> 32) % 1000) / 1000,
+            "acousticness": ((h >> 42) % 1000) / 1000,
+            "instrumentalness": ((h >> 52) % 1000) / 1000,
+            "liveness": ((h >> 62) % 1000) / 1000,
+            "valence": ((h >> 72) % 1000) / 1000,
+            "tempo": 60 + ((h >> 82) % 1400) / 10,
+            "duration_ms": self.tracks_by_id[track_id]["duration_ms"],
+            "time_signature": 3 + (h >> 96) % 2
+        }
+    
+    def search(self, query, limit, offset):
+        words = [word for word in query.lower().split() if ":" not in word]
+        matches = [track for track in self.tracks if all(word in track["name"].lower() or word in track["artists"][0]["name"].lower() for word in words)]
+        if not matches:
+            # Sin coincidencias: resultados deterministas según la consulta
+            start = stable_hash(query) % len(self.tracks)
+            matches = [self.tracks[(start + i) % len(self.tracks)] for i in range(50)]
+        return matches[offset:offset + limit], len(matches)
+
+# Handler HTTP con los endpoints simulados
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None  # Se asigna al crear el servidor
+    
+    def log_message(self, format, *args):
+        pass
+    
+    # Utilidades de respuesta
+    def _send_json(self, status, body=None, headers=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        
+        # ETag de las lecturas: con If-None-Match coincidente se responde 304 sin cuerpo
+        if self.command == "GET" and status == 200 and payload:
+            etag = '"' + hashlib.md5(payload).hexdigest()[:16] + '"'
+            headers = dict(headers or {}, ETag=etag)
+            if self.headers.get("If-None-Match") == etag:
+                status, body, payload = 304, None, b""
+        
+        self.send_response(status)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if payload:
+            self.wfile.write(payload)
+    
+    def _send_error(self, status, message, headers=None):
+        self._send_json(status, {"error": {"status": status, "message": message}}, headers)
+    
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+    
+    def _read_json(self):
+        body = self._read_body()
+        return json.loads(body) if body else {}
+    
+    def _next_url(self, path, query, offset, limit, total):
+        if offset + limit >= total:
+            return None
+        params = {key: values[0] for key, values in query.items()}
+        params.update({"offset": offset + limit, "limit": limit})
+        return f"http://{self.headers.get('Host')}{path}?{urlencode(params)}"
+    
+    # Simular latencia, errores y límites de peticiones
+    def _simulate(self, endpoint):
+        config = self.state.config
+        with self.state.lock:
+            self.state.requests[endpoint] += 1
+            roll_429 = config.random.random()
+            roll_error = config.random.random()
+            roll_slow = config.random.random()
+            jitter = config.random.uniform(-config.jitter_ms, config.jitter_ms)
+        
+        delay = max(config.latency_ms + jitter, 0) / 1000
+        if roll_slow < config.slow_rate:
+            delay += config.slow_ms / 1000
+        if delay:
+            time.sleep(delay)
+        
+        if roll_429 < config.rate_limit_rate:
+            with self.state.lock:
+                self.state.requests["429"] += 1
+            self._send_error(429, "API rate limit exceeded", {"Retry-After": str(config.retry_after)})
+            return False
+        if roll_error < config.error_rate:
+            with self.state.lock:
+                self.state.requests["5xx"] += 1
+            self._send_error(503, "Service unavailable")
+            return False
+        return True
+    
+    def _authorized(self):
+        authorization = self.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer ") or authorization[7:] not in self.state.tokens:
+            self._send_error(401, "Invalid access token")
+            return False
+        return True
+    
+    def _dispatch(self, method):
+        parsed = urlparse(self.path)
+        path = parsed.path.rstrip("/")
+        query = parse_qs(parsed.query)
+        
+        # Endpoints de control del propio simulador
+        if path == "/_stats":
+            with self.state.lock:
+                return self._send_json(200, dict(self.state.requests))
+        if path == "/_reset":
+            with self.state.lock:
+                self.state.requests.clear()
+            return self._send_json(200, {"status": "ok"})
+        
+        if path == "/api/token" and method == "POST":
+            return self._token()
+        
+        if not path.startswith("/v1/"):
+            return self._send_error(404, "Not found")
+        
+        route = match_route(method, path[4:].split("/"))
+        if route is None:
+            return self._send_error(404, "Service not found")
+        
+        handler, endpoint, ids = route
+        if not self._authorized() or not self._simulate(endpoint):
+            return
+        handler(self, query, *ids)
+    
+    def do_GET(self):
+        self._dispatch("GET")
+    
+    def do_POST(self):
+        self._dispatch("POST")
+    
+    def do_PUT(self):
+        self._dispatch("PUT")
+    
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+    
+    # Cuentas: intercambio de código y renovación de token
+    def _token(self):
+        form = parse_qs(self._read_body().decode())
+        grant_type = form.get("grant_type", [""])[0]
+        with self.state.lock:
+            self.state.requests["POST /api/token"] += 1
+        if grant_type not in ("authorization_code", "refresh_token"):
+            return self._send_json(400, {"error": "unsupported_grant_type"})
+        
+        access_token = f"fake-access-{len(self.state.tokens)}-{int(time.time() * 1000)}"
+        self.state.tokens[access_token] = time.time() + 3600
+        body = {"access_token": access_token, "token_type": "Bearer", "expires_in": 3600, "scope": GRANTED_SCOPE}
+        if grant_type == "authorization_code":
+            body["refresh_token"] = "fake-refresh-token"
+        self._send_json(200, body)
+    
+    # Web API
+    def _search(self, query):
+        q = query.get("q", [""])[0]
+        search_type = query.get("type", ["track"])[0]
+        limit = int(query.get("limit", ["10"])[0])
+        offset = int(query.get("offset", ["0"])[0])
+        tracks, total = self.state.search(q, limit, offset)
+        
+        if search_type == "album":
+            albums = []
+            for track in tracks:
+                album = dict(track["album"])
+                if album not in albums:
+                    albums.append(album)
+            return self._send_json(200, {"albums": {"items": albums, "total": total, "limit": limit, "offset": offset}})
+        
+        self._send_json(200, {"tracks": {"items": tracks, "total": total, "limit": limit, "offset": offset}})
+    
+    def _me(self, query):
+        self._send_json(200, self.state.user)
+    
+    def _play(self, query):
+        body = self._read_json()
+        uris = body.get("uris") or []
+        with self.state.lock:
+            playback = self.state.playback
+            if uris:
+                playback["track_id"] = uris[0].split(":")[-1]
+                playback["progress_ms"] = 0
+                self.state.record_play(playback["track_id"])
+            playback["is_playing"] = True
+            playback["updated"] = time.time()
+        self._send_json(204)
+    
+    def _pause(self, query):
+        self._read_body()
+        with self.state.lock:
+            playback = self.state.playback
+            playback["progress_ms"] += int((time.time() - playback["updated"]) * 1000) if playback["is_playing"] else 0
+            playback["is_playing"] = False
+            playback["updated"] = time.time()
+        self._send_json(204)
+    
+    # Estado de reproducción; al terminar una canción pasa a la siguiente del catálogo
+    def _current_playback(self, query):
+        with self.state.lock:
+            playback = self.state.playback
+            if playback["track_id"] is None:
+                return self._send_json(204)
+            
+            now = time.time()
+            if playback["is_playing"]:
+                playback["progress_ms"] += int((now - playback["updated"]) * 1000)
+                playback["updated"] = now
+                track = self.state.tracks_by_id[playback["track_id"]]
+                while playback["progress_ms"] >= track["duration_ms"]:
+                    playback["progress_ms"] -= track["duration_ms"]
+                    index = (self.state.tracks.index(track) + 1) % len(self.state.tracks)
+                    track = self.state.tracks[index]
+                    playback["track_id"] = track["id"]
+            
+            body = {
+                "device": {"id": "fake_device", "name": "Fake Speaker", "type": "Speaker", "volume_percent": 50, "is_active": True},
+                "shuffle_state": False,
+                "repeat_state": "off",
+                "timestamp": int(now * 1000),
+                "progress_ms": playback["progress_ms"],
+                "is_playing": playback["is_playing"],
+                "currently_playing_type": "track",
+                "item": self.state.tracks_by_id[playback["track_id"]]
+            }
+        self._send_json(200, body)
+    
+    def _current_user_playlists(self, query):
+        limit = min(int(query.get("limit", ["20"])[0]), 50)
+        offset = int(query.get("offset", ["0"])[0])
+        with self.state.lock:
+            playlists = list(self.state.playlists.values())
+        items = [self.state.playlist_summary(playlist) for playlist in playlists[offset:offset + limit]]
+        self._send_json(200, {
+            "items": items,
+            "total": len(playlists),
+            "limit": limit,
+            "offset": offset,
+            "next": self._next_url("/v1/me/playlists", query, offset, limit, len(playlists))
+        })
+    
+    def _create_playlist(self, query, user_id):
+        body = self._read_json()
+        with self.state.lock:
+            playlist = self.state.create_playlist(body.get("name", ""), body.get("description", ""), public=body.get("public", True))
+            summary = self.state.playlist_summary(playlist)
+        self._send_json(201, summary)
+    
+    def _playlist_items(self, query, playlist_id):
+        playlist = self.state.playlists.get(playlist_id)
+        if playlist is None:
+            return self._send_error(404, "Not found")
+        limit = min(int(query.get("limit", ["100"])[0]), 100)
+        offset = int(query.get("offset", ["0"])[0])
+        with self.state.lock:
+            item_ids = list(playlist["items"])
+        items = [{"added_at": "2024-01-01T00:00:00Z", "track": self.state.tracks_by_id.get(track_id)} for track_id in item_ids[offset:offset + limit]]
+        self._send_json(200, {
+            "items": items,
+            "total": len(item_ids),
+            "limit": limit,
+            "offset": offset,
+            "next": self._next_url(f"/v1/playlists/{playlist_id}/tracks", query, offset, limit, len(item_ids))
+        })
+    
+    def _playlist_add_items(self, query, playlist_id):
+        playlist = self.state.playlists.get(playlist_id)
+        if playlist is None:
+            return self._send_error(404, "Not found")
+        body = self._read_json()
+        uris = body.get("uris") or []
+        if len(uris) > 100:
+            return self._send_error(400, "Too many ids requested")
+        with self.state.lock:
+            new_ids = [uri.split(":")[-1] for uri in uris]
+            position = body.get("position", query.get("position", [None])[0])
+            if position is None:
+                playlist["items"].extend(new_ids)
+            else:
+                position = int(position)
+                playlist["items"][position:position] = new_ids
+            playlist["snapshot"] += 1
+            snapshot = self.state.snapshot_id(playlist)
+        self._send_json(201, {"snapshot_id": snapshot})
+    
+    def _playlist(self, query, playlist_id):
+        playlist = self.state.playlists.get(playlist_id)
+        if playlist is None:
+            return self._send_error(404, "Not found")
+        with self.state.lock:
+            summary = self.state.playlist_summary(playlist)
+        self._send_json(200, summary)
+    
+    # Las operaciones por posición exigen el snapshot_id actual (409 si la playlist cambió entretanto)
+    def _check_snapshot(self, playlist, snapshot_id):
+        if snapshot_id is not None and snapshot_id != self.state.snapshot_id(playlist):
+            self._send_error(409, "Snapshot ID does not match")
+            return False
+        return True
+    
+    def _playlist_remove_items(self, query, playlist_id):
+        playlist = self.state.playlists.get(playlist_id)
+        if playlist is None:
+            return self._send_error(404, "Not found")
+        body = self._read_json()
+        tracks = body.get("tracks") or []
+        if len(tracks) > 100:
+            return self._send_error(400, "Too many tracks requested")
+        with self.state.lock:
+            if not self._check_snapshot(playlist, body.get("snapshot_id")):
+                return
+            items = playlist["items"]
+            positions = set()
+            for track in tracks:
+                track_id = track["uri"].split(":")[-1]
+                if "positions" in track:
+                    if any(position >= len(items) or items[position] != track_id for position in track["positions"]):
+                        return self._send_error(400, "Track not found at position")
+                    positions.update(track["positions"])
+                else:
+                    positions.update(index for index, item in enumerate(items) if item == track_id)
+            playlist["items"] = [item for index, item in enumerate(items) if index not in positions]
+            playlist["snapshot"] += 1
+            snapshot = self.state.snapshot_id(playlist)
+        self._send_json(200, {"snapshot_id": snapshot})
+    
+    def _playlist_reorder_items(self, query, playlist_id):
+        playlist = self.state.playlists.get(playlist_id)
+        if playlist is None:
+            return self._send_error(404, "Not found")
+        body = self._read_json()
+        with self.state.lock:
+            if not self._check_snapshot(playlist, body.get("snapshot_id")):
+                return
+            items = playlist["items"]
+            start = body["range_start"]
+            length = body.get("range_length", 1)
+            insert_before = body["insert_before"]
+            if start + length > len(items) or insert_before > len(items):
+                return self._send_error(400, "Index out of bounds")
+            block = items[start:start + length]
+            rest = items[:start] + items[start + length:]
+            target = insert_before if insert_before <= start else insert_before - length
+            playlist["items"] = rest[:target] + block + rest[target:]
+            playlist["snapshot"] += 1
+            snapshot = self.state.snapshot_id(playlist)
+        self._send_json(200, {"snapshot_id": snapshot})
+    
+    def _saved_tracks(self, query):
+        limit = min(int(query.get("limit", ["20"])[0]), 50)
+        offset = int(query.get("offset", ["0"])[0])
+        with self.state.lock:
+            saved = list(self.state.saved_tracks)
+        items = [{"added_at": item["added_at"], "track": self.state.tracks_by_id[item["track_id"]]} for item in saved[offset:offset + limit]]
+        self._send_json(200, {
+            "items": items,
+            "total": len(saved),
+            "limit": limit,
+            "offset": offset,
+            "next": self._next_url("/v1/me/tracks", query, offset, limit, len(saved))
+        })
+    
+    # Historial con cursores de tiempo: after pide las siguientes reproducciones, before las anteriores
+    def _recently_played(self, query):
+        limit = min(int(query.get("limit", ["20"])[0]), 50)
+        after = query.get("after", [None])[0]
+        before = query.get("before", [None])[0]
+        if after and before:
+            return self._send_error(400, "Only one of after and before can be specified")
+        with self.state.lock:
+            history = list(self.state.recently_played)
+        if after:
+            newer = [play for play in history if play["played_at_ms"] > int(after)]
+            plays = newer[-limit:]
+        else:
+            older = [play for play in history if not before or play["played_at_ms"] < int(before)]
+            plays = older[:limit]
+        items = [
+            {
+                "track": self.state.tracks_by_id[play["track_id"]],
+                "played_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(play["played_at_ms"] // 1000)) + f".{play['played_at_ms'] % 1000:03d}Z",
+                "context": None
+            }
+            for play in plays
+        ]
+        cursors = {"after": str(plays[0]["played_at_ms"]), "before": str(plays[-1]["played_at_ms"])} if plays else None
+        has_older = bool(plays) and plays[-1]["played_at_ms"] > history[-1]["played_at_ms"]
+        next_url = f"http://{self.headers.get('Host')}/v1/me/player/recently-played?{urlencode({'before': cursors['before'], 'limit': limit})}" if has_older else None
+        self._send_json(200, {"items": items, "limit": limit, "cursors": cursors, "next": next_url})
+    
+    def _top_items(self, query, item_type):
+        if item_type not in ("tracks", "artists"):
+            return self._send_error(404, "Service not found")
+        limit = min(int(query.get("limit", ["20"])[0]), 50)
+        offset = int(query.get("offset", ["0"])[0])
+        time_range = query.get("time_range", ["medium_term"])[0]
+        items = self.state.top_items(item_type, time_range)
+        self._send_json(200, {
+            "items": items[offset:offset + limit],
+            "total": len(items),
+            "limit": limit,
+            "offset": offset,
+            "next": self._next_url(f"/v1/me/top/{item_type}", query, offset, limit, len(items))
+        })
+    
+    def _audio_features(self, query):
+        ids = [track_id for track_id in query.get("ids", [""])[0].split(",") if track_id]
+        if len(ids) > 100:
+            return self._send_error(400, "Too many ids requested")
+        self._send_json(200, {"audio_features": [self.state.audio_features(track_id) for track_id in ids]})
+
+    # Consultas por varios IDs; los inexistentes se devuelven como null, como en la API real
+    def _multiple(self, query, key, items_by_id, max_ids):
+        ids = [item_id for item_id in query.get("ids", [""])[0].split(",") if item_id]
+        if len(ids) > max_ids:
+            return self._send_error(400, "Too many ids requested")
+        self._send_json(200, {key: [items_by_id.get(item_id) for item_id in ids]})
+    
+    def _tracks(self, query):
+        self._multiple(query, "tracks", self.state.tracks_by_id, 50)
+    
+    def _albums(self, query):
+        self._multiple(query, "albums", self.state.albums_by_id, 20)
+    
+    def _artists(self, query):
+        self._multiple(query, "artists", self.state.artists_by_id, 50)
+
+ROUTES = {
+    ("GET", ("search",)): FakeSpotifyHandler._search,
+    ("GET", ("me",)): FakeSpotifyHandler._me,
+    ("GET", ("me", "player")): FakeSpotifyHandler._current_playback,
+    ("PUT", ("me", "player", "play")): FakeSpotifyHandler._play,
+    ("PUT", ("me", "player", "pause")): FakeSpotifyHandler._pause,
+    ("GET", ("me", "playlists")): FakeSpotifyHandler._current_user_playlists,
+    ("GET", ("me", "tracks")): FakeSpotifyHandler._saved_tracks,
+    ("GET", ("me", "player", "recently-played")): FakeSpotifyHandler._recently_played,
+    ("GET", ("me", "top", "{id}")): FakeSpotifyHandler._top_items,
+    ("POST", ("users", "{id}", "playlists")): FakeSpotifyHandler._create_playlist,
+    ("GET", ("playlists", "{id}")): FakeSpotifyHandler._playlist,
+    ("GET", ("playlists", "{id}", "tracks")): FakeSpotifyHandler._playlist_items,
+    ("DELETE", ("playlists", "{id}", "tracks")): FakeSpotifyHandler._playlist_remove_items,
+    ("PUT", ("playlists", "{id}", "tracks")): FakeSpotifyHandler._playlist_reorder_items,
+    ("POST", ("playlists", "{id}", "tracks")): FakeSpotifyHandler._playlist_add_items,
+    ("GET", ("audio-features",)): FakeSpotifyHandler._audio_features,
+    ("GET", ("tracks",)): FakeSpotifyHandler._tracks,
+    ("GET", ("albums",)): FakeSpotifyHandler._albums,
+    ("GET", ("artists",)): FakeSpotifyHandler._artists,
+}
+
+# Buscar el handler de una ruta; "{id}" en el patrón acepta cualquier segmento
+def match_route(method, parts):
+    for (route_method, pattern), handler in ROUTES.items():
+        if route_method != method or len(pattern) != len(parts):
+            continue
+        if all(expected == "{id}" or expected == part for expected, part in zip(pattern, parts)):
+            ids = [part for expected, part in zip(pattern, parts) if expected == "{id}"]
+            return handler, f"{method} /" + "/".join(pattern), ids
+    return None
+
+# Crear el servidor simulado (puerto 0 = puerto libre aleatorio)
+def create_fake_server(config, host="127.0.0.1", port=0):
+    state = FakeSpotifyState(config)
+    handler = type("BoundFakeSpotifyHandler", (FakeSpotifyHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    return server
+
+# Arrancar el servidor simulado en un hilo y devolverlo junto con su URL base
+def start_fake_server(config, host="127.0.0.1", port=0):
+    server = create_fake_server(config, host, port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Servidor local que simula la API de Spotify")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.0, help="Latencia media por petición en ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Variación de la latencia en ms (+/-)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilidad de responder 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Probabilidad de responder 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Segundos de la cabecera Retry-After")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Probabilidad de una respuesta lenta")
+    parser.add_argument("--slow-ms", type=float, default=0.0, help="Retraso extra de las respuestas lentas en ms")
+    parser.add_argument("--catalogue-size", type=int, default=2000)
+    parser.add_argument("--playlists", type=int, default=120)
+    parser.add_argument("--saved-tracks", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args(argv)
+
+def config_from_args(args):
+    return FakeConfig(
+        latency_ms=args.latency,
+        jitter_ms=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        catalogue_size=args.catalogue_size,
+        playlists=args.playlists,
+        saved_tracks=args.saved_tracks,
+        seed=args.seed,
+        slow_rate=args.slow_rate,
+        slow_ms=args.slow_ms
+    )
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = create_fake_server(config_from_args(args), args.host, args.port)
+    base_url = f"http://{args.host}:{server.server_address[1]}"
+    print(f"Fake Spotify API escuchando en {base_url}", file=sys.stderr)
+    print(f"  SPOTIFY_MCP_API_BASE={base_url}/v1", file=sys.stderr)
+    print(f"  SPOTIFY_MCP_ACCOUNTS_BASE={base_url}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
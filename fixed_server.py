@@ -4,47 +4,368 @@ Fixed Spotify MCP Server
 Un servidor MCP para Spotify con autenticación simplificada y token en memoria (Versión con URI fija)
 """
 
+import time
+
+# Inicio del arranque, para --profile-startup
+STARTUP_STARTED = time.perf_counter()
+
 import os
 import sys
 import json
+import asyncio
+import logging
+import logging.handlers
 import threading
-import webbrowser
+import queue
+import re
+import atexit
 import socket
-import time
 import base64
-import requests
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs, quote
-from typing import Dict, Any, List, Optional
+import hashlib
+import random
+import heapq
+import itertools
+import contextvars
+import functools
+import bisect
+import sqlite3
+import argparse
+import zlib
+import importlib
+import httpx
+from collections import OrderedDict, Counter, deque
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote, urlencode
+from typing import Dict, Any, List, Optional, Union
+
+# Tiempo de cada fase del arranque: importaciones, configuración y calentamiento
+class StartupProfile:
+    def __init__(self, started):
+        self.phases = []
+        self._last = started
+        self._lock = threading.Lock()
+    
+    # Cerrar la fase que empezó en la marca anterior
+    def mark(self, name):
+        now = time.perf_counter()
+        with self._lock:
+            self.phases.append((name, now - self._last))
+            self._last = now
+    
+    # Medir un bloque concreto (por ejemplo, el calentamiento en su propio hilo)
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append((name, time.perf_counter() - started))
+    
+    def report(self):
+        width = max(len(name) for name, _ in self.phases)
+        lines = [f"{name:<{width}}  {seconds * 1000:9.1f} ms" for name, seconds in self.phases]
+        lines.append(f"{'total':<{width}}  {(time.perf_counter() - STARTUP_STARTED) * 1000:9.1f} ms")
+        return "\n".join(lines)
+
+startup_profile = StartupProfile(STARTUP_STARTED)
+startup_profile.mark("import: biblioteca estándar y httpx")
 
 from mcp.server.fastmcp import FastMCP
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-from spotipy.cache_handler import CacheHandler
 
-# Redirigir prints a stderr para no interferir con el protocolo JSON
-def log(message):
-    print(message, file=sys.stderr)
+startup_profile.mark("import: mcp")
+
+# Dependencias opcionales (cryptography, numpy, redis): se importan al primer uso, no en el arranque.
+# spotipy y requests también se importan dentro de las funciones que los usan
+@functools.lru_cache(maxsize=None)
+def optional_module(name):
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+# Logging estructurado y no bloqueante: log() solo encola el registro y un hilo aparte lo
+# formatea y lo escribe en stderr (nunca en stdout, que es el canal del protocolo JSON)
+LOG_LEVEL = os.environ.get("SPOTIFY_MCP_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("SPOTIFY_MCP_LOG_FORMAT", "text")  # "text" o "json"
+LOG_RATE_LIMIT = int(os.environ.get("SPOTIFY_MCP_LOG_RATE_LIMIT", "20"))  # Líneas por punto de log y ventana (0 = sin límite)
+LOG_RATE_WINDOW = 10.0  # Segundos
+LOG_DEBUG_SAMPLE = float(os.environ.get("SPOTIFY_MCP_LOG_DEBUG_SAMPLE", "1"))  # Fracción de mensajes DEBUG que se escriben
+LOG_QUEUE_SIZE = 10000  # Con la cola llena se descartan registros en vez de bloquear
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+
+# Identificador de correlación de la llamada en curso: (id, herramienta, sesión)
+request_context = contextvars.ContextVar("request_context", default=None)
+
+# Secretos que nunca deben llegar a los logs: parámetros OAuth, tokens y cabeceras de autorización
+SECRET_PARAM_PATTERN = re.compile(r"(?i)\b(code|state|access_token|refresh_token|client_secret|token)=([^&\s'\",]+)")
+SECRET_FIELD_PATTERN = re.compile(r"""(?i)(['"](?:code|state|access_token|refresh_token|client_secret)['"]\s*:\s*\[?\s*['"])[^'"]+""")
+AUTHORIZATION_PATTERN = re.compile(r"(?i)\b(Bearer|Basic)\s+[A-Za-z0-9._~+/=-]+")
+SECRET_FIELDS = {"code", "state", "access_token", "refresh_token", "client_secret", "token"}
+
+def redact(text):
+    text = SECRET_PARAM_PATTERN.sub(r"\1=***", text)
+    text = SECRET_FIELD_PATTERN.sub(r"\1***", text)
+    return AUTHORIZATION_PATTERN.sub(r"\1 ***", text)
+
+# Muestreo y límite de frecuencia por punto de log (fichero y línea de la llamada a log()).
+# Se aplica antes de encolar para que los mensajes descartados no cuesten nada más
+class LogFilter(logging.Filter):
+    def __init__(self, rate_limit, window, debug_sample):
+        super().__init__()
+        self.rate_limit = rate_limit
+        self.window = window
+        self.debug_sample = debug_sample
+        self._windows = {}  # (fichero, línea) -> [inicio de la ventana, escritos, suprimidos]
+        self._lock = threading.Lock()
+        self.rate_limited = 0
+        self.sampled_out = 0
+    
+    def filter(self, record):
+        sample = getattr(record, "sample", None)
+        if sample is None and record.levelno <= logging.DEBUG:
+            sample = self.debug_sample
+        if sample is not None and sample < 1 and random.random() >= sample:
+            self.sampled_out += 1
+            return False
+        
+        record.suppressed = 0
+        if self.rate_limit > 0:
+            key = (record.pathname, record.lineno)
+            now = time.monotonic()
+            with self._lock:
+                window = self._windows.get(key)
+                if window is None or now - window[0] >= self.window:
+                    # Los suprimidos de la ventana anterior se anuncian en el primer mensaje de la nueva
+                    record.suppressed = window[2] if window else 0
+                    window = self._windows[key] = [now, 0, 0]
+                if window[1] >= self.rate_limit:
+                    window[2] += 1
+                    self.rate_limited += 1
+                    return False
+                window[1] += 1
+        
+        context = request_context.get()
+        record.request_id, record.tool, record.session = context if context else (None, None, None)
+        return True
+
+# Formato de salida en texto o JSON (una línea por registro). Se ejecuta en el hilo de escritura
+class LogFormatter(logging.Formatter):
+    def __init__(self, json_output=False):
+        super().__init__()
+        self.json_output = json_output
+    
+    def format(self, record):
+        message = redact(record.getMessage())
+        fields = {
+            key: "***" if key in SECRET_FIELDS else (redact(value) if isinstance(value, str) else value)
+            for key, value in (getattr(record, "fields", None) or {}).items()
+        }
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z"
+        request_id = getattr(record, "request_id", None)
+        suppressed = getattr(record, "suppressed", 0)
+        
+        if self.json_output:
+            entry = {"ts": timestamp, "level": record.levelname, "msg": message}
+            if request_id:
+                entry["request_id"] = request_id
+                entry["tool"] = record.tool
+                entry["session"] = record.session
+            if suppressed:
+                entry["suppressed"] = suppressed
+            entry.update(fields)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        
+        line = f"{timestamp} {record.levelname:<7} "
+        if request_id:
+            line += f"[{request_id}] "
+        line += message
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if suppressed:
+            line += f" ({suppressed} mensajes similares suprimidos)"
+        return line
+
+# Encolado sin bloqueo: si el hilo de escritura no da abasto se cuenta el descarte y se sigue
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging():
+    formatter = LogFormatter(json_output=LOG_FORMAT == "json")
+    handlers = [logging.StreamHandler(sys.stderr)]
+    # Copia en logs/spotify_mcp.log si existe el directorio
+    if os.path.isdir(LOG_DIR):
+        handlers.append(logging.FileHandler(os.path.join(LOG_DIR, "spotify_mcp.log"), encoding="utf-8", delay=True))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(LogFilter(LOG_RATE_LIMIT, LOG_RATE_WINDOW, LOG_DEBUG_SAMPLE))
+    
+    logger = logging.getLogger("spotify_mcp")
+    logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    logger.propagate = False
+    logger.addHandler(queue_handler)
+    
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    # Al salir se vacía la cola para no perder los últimos mensajes
+    atexit.register(listener.stop)
+    return logger, queue_handler
+
+logger, log_queue_handler = setup_logging()
+
+def log(message, level=logging.INFO, sample=None, **fields):
+    """Encola un mensaje de log. sample < 1 escribe solo esa fracción de los mensajes de este punto."""
+    logger.log(level, message, extra={"fields": fields, "sample": sample}, stacklevel=2)
+
+def log_stats():
+    log_filter = log_queue_handler.filters[0]
+    return {
+        "level": logging.getLevelName(logger.level),
+        "format": LOG_FORMAT,
+        "queued": log_queue_handler.queue.qsize(),
+        "dropped": log_queue_handler.dropped,
+        "rate_limited": log_filter.rate_limited,
+        "sampled_out": log_filter.sampled_out,
+    }
 
 # Importar credenciales
 try:
     from spotify_credentials import SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET
     log("Credenciales client_id y client_secret cargadas desde spotify_credentials.py")
 except ImportError:
-    log("Error: No se pudieron cargar las credenciales.")
+    log("Error: No se pudieron cargar las credenciales.", level=logging.ERROR)
     sys.exit(1)
 
 # Definir URI de redirección explícitamente - esta URI debe estar registrada en el Dashboard de Spotify
 SPOTIFY_REDIRECT_URI = "http://127.0.0.1:8888/callback"
-log(f"Usando URI de redirección fija: {SPOTIFY_REDIRECT_URI}")
 
-# Variables globales
-spotify = None
-token_info = None  # Almacenamos el token en memoria
-auth_in_progress = False
-auth_url = None
-auth_code_received = threading.Event()
-authorization_code = None
+# Endpoint de cuentas de Spotify (autorización y tokens)
+SPOTIFY_ACCOUNTS_BASE = os.environ.get("SPOTIFY_MCP_ACCOUNTS_BASE", "https://accounts.spotify.com")
+
+# Renovación anticipada del token y almacén persistente opcional
+TOKEN_REFRESH_MARGIN = int(os.environ.get("SPOTIFY_MCP_TOKEN_REFRESH_MARGIN", "300"))  # Segundos antes de expirar
+TOKEN_REFRESH_RETRY_DELAY = 30  # Segundos entre reintentos si la renovación falla
+TOKEN_STORE_PATH = os.environ.get("SPOTIFY_MCP_TOKEN_STORE")  # Ruta del archivo cifrado (desactivado si no se define)
+TOKEN_STORE_KEY = os.environ.get("SPOTIFY_MCP_TOKEN_KEY")  # Clave de cifrado (por defecto se deriva del client secret)
+
+# Sesiones de usuario: cada clave (usuario de Spotify) tiene su propio token y flujo OAuth
+DEFAULT_SESSION = "default"
+# Cuentas por red, "id_de_usuario_de_spotify=secreto,...": el cliente elige la suya con Authorization: Bearer <secreto>
+# Solo se guarda el hash del secreto
+ACCOUNT_SECRETS = {
+    hashlib.sha256(secret.strip().encode()).hexdigest(): user_id.strip()
+    for user_id, _, secret in (entry.partition("=") for entry in os.environ.get("SPOTIFY_MCP_ACCOUNTS", "").split(","))
+    if user_id.strip() and secret.strip()
+}
+MAX_SESSIONS = int(os.environ.get("SPOTIFY_MCP_MAX_SESSIONS", "16"))  # Sesiones en memoria antes de desalojar
+
+# Configuración de la caché de búsquedas (TTL en segundos y número máximo de entradas)
+SEARCH_CACHE_TTL = float(os.environ.get("SPOTIFY_MCP_SEARCH_CACHE_TTL", "300"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SPOTIFY_MCP_SEARCH_CACHE_SIZE", "256"))
+
+# Las características de audio no cambian, así que se guardan sin caducidad
+AUDIO_FEATURES_CACHE_MAX_ENTRIES = int(os.environ.get("SPOTIFY_MCP_AUDIO_FEATURES_CACHE_SIZE", "10000"))
+SIMILARITY_INDEX_MAX_TRACKS = int(os.environ.get("SPOTIFY_MCP_SIMILARITY_INDEX_SIZE", "5000"))  # Canciones por cuenta en find_similar_tracks
+AUDIO_FEATURES_BATCH_SIZE = 100  # Máximo de IDs por petición que admite la API
+TRACKS_BATCH_SIZE = 50  # Máximo de IDs por petición en GET /tracks
+ALBUMS_BATCH_SIZE = 20  # Máximo de IDs por petición en GET /albums
+ARTISTS_BATCH_SIZE = 50  # Máximo de IDs por petición en GET /artists
+MAX_CONCURRENT_REQUESTS = 4  # Peticiones simultáneas para operaciones por lotes
+PLAYLIST_ADD_BATCH_SIZE = 100  # Máximo de URIs por petición al añadir a una playlist
+PLAYLIST_REMOVE_BATCH_SIZE = 100  # Máximo de elementos por petición al quitar de una playlist
+BUILD_PLAYLIST_CONCURRENCY = int(os.environ.get("SPOTIFY_MCP_BUILD_PLAYLIST_CONCURRENCY", "8"))  # Búsquedas simultáneas
+BUILD_PLAYLIST_CANDIDATES = 5  # Resultados por búsqueda entre los que elegir si el primero está repetido
+PLAYLISTS_PAGE_SIZE = 50  # Máximo de playlists por página que devuelve la API
+
+SAVED_TRACKS_PAGE_SIZE = 50  # Máximo de canciones guardadas por página
+PLAYLIST_ITEMS_PAGE_SIZE = 100  # Máximo de elementos de playlist por página
+RECENTLY_PLAYED_PAGE_SIZE = 50  # Máximo de reproducciones por página
+TOP_ITEMS_PAGE_SIZE = 50  # Máximo de canciones o artistas del ranking por página
+
+# Sondeo de la reproducción en curso (un sondeo compartido por cuenta)
+NOW_PLAYING_FAST_INTERVAL = float(os.environ.get("SPOTIFY_MCP_NOW_PLAYING_FAST_INTERVAL", "1"))  # Cerca de un cambio de canción
+NOW_PLAYING_MAX_INTERVAL = float(os.environ.get("SPOTIFY_MCP_NOW_PLAYING_MAX_INTERVAL", "10"))  # Reproduciendo
+NOW_PLAYING_IDLE_INTERVAL = float(os.environ.get("SPOTIFY_MCP_NOW_PLAYING_IDLE_INTERVAL", "30"))  # En pausa o sin reproducción
+NOW_PLAYING_BOOST_WINDOW = 5  # Segundos de sondeo rápido tras play/pause
+NOW_PLAYING_IDLE_STOP = 120  # Segundos sin consultas tras los que se detiene el sondeo
+NOW_PLAYING_MAX_WAIT = 300  # Espera máxima de now_playing(wait_for_change=True)
+
+# Índice local de la biblioteca del usuario
+LIBRARY_DB_PATH = os.path.expanduser(os.environ.get("SPOTIFY_MCP_LIBRARY_DB", "~/.spotify_mcp_library.db"))
+
+# Exportaciones de historial y biblioteca (los ficheros siempre se crean dentro de este directorio)
+EXPORT_DIR = os.path.expanduser(os.environ.get("SPOTIFY_MCP_EXPORT_DIR", "~/spotify_mcp_exports"))
+EXPORT_DATASETS = ("recently_played", "top_tracks", "top_artists", "saved_tracks")
+EXPORT_FORMATS = ("ndjson", "columnar")
+TOP_TIME_RANGES = ("short_term", "medium_term", "long_term")
+EXPORT_PREFETCH_PAGES = 2  # Páginas pedidas por adelantado mientras se escribe la anterior
+EXPORT_TOP_INTERVAL = 86400  # Spotify recalcula los rankings a diario: no se repiten instantáneas más seguidas
+
+# Caché HTTP en disco del catálogo y las playlists (vacío la desactiva)
+HTTP_CACHE_PATH = os.path.expanduser(os.environ.get("SPOTIFY_MCP_HTTP_CACHE", "~/.spotify_mcp_http_cache.db"))
+HTTP_CACHE_MAX_BYTES = int(float(os.environ.get("SPOTIFY_MCP_HTTP_CACHE_SIZE_MB", "64")) * 1024 * 1024)
+HTTP_CACHE_TTL = float(os.environ.get("SPOTIFY_MCP_HTTP_CACHE_TTL", "86400"))  # Segundos que el catálogo se usa sin revalidar
+HTTP_CACHE_TOUCH_INTERVAL = 60  # Segundos entre actualizaciones de last_used de una entrada (orden de desalojo)
+
+# Configuración del cliente HTTP compartido con la Web API
+SPOTIFY_API_BASE = os.environ.get("SPOTIFY_MCP_API_BASE", "https://api.spotify.com/v1")
+HTTP_MAX_CONNECTIONS = int(os.environ.get("SPOTIFY_MCP_MAX_CONNECTIONS", "10"))  # Conexiones simultáneas por host
+HTTP_TIMEOUT = float(os.environ.get("SPOTIFY_MCP_HTTP_TIMEOUT", "15"))
+COALESCE_REQUESTS = os.environ.get("SPOTIFY_MCP_COALESCE_REQUESTS", "1") != "0"  # Compartir GETs idénticos en curso
+
+# Límite de peticiones: Spotify aplica el límite sobre una ventana móvil de 30 segundos
+RATE_LIMIT_REQUESTS = int(os.environ.get("SPOTIFY_MCP_RATE_LIMIT_REQUESTS", "150"))
+RATE_LIMIT_WINDOW = float(os.environ.get("SPOTIFY_MCP_RATE_LIMIT_WINDOW", "30"))
+MAX_RETRIES = int(os.environ.get("SPOTIFY_MCP_MAX_RETRIES", "3"))
+RETRY_BASE_DELAY = 0.5  # Segundos de espera base para reintentos con backoff exponencial
+
+# Latencia de cola: plazo total por petición (cola, intentos y reintentos), peticiones duplicadas para los
+# GET lentos y un cortacircuitos por endpoint que falla rápido o sirve la última respuesta guardada
+UPSTREAM_DEADLINE = float(os.environ.get("SPOTIFY_MCP_DEADLINE", "10"))  # Segundos; 0 = sin plazo
+DEFAULT_DEADLINES = {"GET search": 5, "GET me/player": 3}
+# Plazos por endpoint, p. ej. "GET search=4,GET me/player=2"
+UPSTREAM_DEADLINES = dict(DEFAULT_DEADLINES, **{
+    endpoint.strip(): float(seconds)
+    for endpoint, _, seconds in (entry.rpartition("=") for entry in os.environ.get("SPOTIFY_MCP_DEADLINES", "").split(",") if "=" in entry)
+})
+HEDGE_PERCENTILE = float(os.environ.get("SPOTIFY_MCP_HEDGE_PERCENTILE", "0.95"))  # Duplicar un GET más lento que este percentil; 0 = nunca
+HEDGE_MIN_DELAY = float(os.environ.get("SPOTIFY_MCP_HEDGE_MIN_DELAY", "0.05"))  # Espera mínima antes de duplicar (segundos)
+HEDGE_MAX_RATIO = float(os.environ.get("SPOTIFY_MCP_HEDGE_MAX_RATIO", "0.1"))  # Fracción máxima de GETs duplicados
+HEDGE_MIN_SAMPLES = 20  # Latencias observadas de un endpoint antes de usar su percentil
+BREAKER_FAILURES = int(os.environ.get("SPOTIFY_MCP_BREAKER_FAILURES", "5"))  # Fallos seguidos que abren el circuito
+BREAKER_COOLDOWN = float(os.environ.get("SPOTIFY_MCP_BREAKER_COOLDOWN", "30"))  # Segundos abierto antes de probar de nuevo
+
+# Métricas: endpoint Prometheus opcional y muestreo del tamaño de las respuestas de las herramientas
+METRICS_PORT = int(os.environ.get("SPOTIFY_MCP_METRICS_PORT", "0"))  # 0 = desactivado
+METRICS_HOST = os.environ.get("SPOTIFY_MCP_METRICS_HOST", "127.0.0.1")
+PAYLOAD_SAMPLE_EVERY = int(os.environ.get("SPOTIFY_MCP_PAYLOAD_SAMPLE_EVERY", "10"))  # Medir 1 de cada N respuestas
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# Transporte HTTP/SSE: varios workers de uvicorn comparten tokens y cachés a través del backend compartido
+HTTP_TRANSPORT = os.environ.get("SPOTIFY_MCP_TRANSPORT", "stdio")  # stdio, http o sse
+HTTP_HOST = os.environ.get("SPOTIFY_MCP_HTTP_HOST", "127.0.0.1")
+HTTP_PORT = int(os.environ.get("SPOTIFY_MCP_HTTP_PORT", "8000"))
+HTTP_WORKERS = max(int(os.environ.get("SPOTIFY_MCP_WORKERS", "1")), 1)
+SHARED_BACKEND = os.environ.get("SPOTIFY_MCP_SHARED_BACKEND", "")  # sqlite:///ruta.db o redis://host:6379/0
+AUTH_TIMEOUT = 300  # Segundos que se espera a que el usuario complete el login
+
+# Prioridades del planificador (menor valor = se atiende antes)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BULK = 2
 
 # Extraer información de la URI de redirección
 try:
@@ -52,10 +373,8 @@ try:
     DEFAULT_PORT = int(redirect_uri_parts.port)
     CALLBACK_PATH = redirect_uri_parts.path
     HOST = redirect_uri_parts.hostname
-    log(f"URI de redirección configurada: {SPOTIFY_REDIRECT_URI}")
-    log(f"HOST: {HOST}, PORT: {DEFAULT_PORT}, PATH: {CALLBACK_PATH}")
 except:
-    log(f"Error al extraer información de {SPOTIFY_REDIRECT_URI}")
+    log(f"Error al extraer información de {SPOTIFY_REDIRECT_URI}", level=logging.ERROR)
     DEFAULT_PORT = 8080
     CALLBACK_PATH = "/callback"
     HOST = "127.0.0.1"
@@ -63,22 +382,37 @@ except:
 # Handler para la autenticación OAuth
 class AuthHandler(BaseHTTPRequestHandler):
     def log_message(self, format, *args):
-        log(format % args)
+        log(format % args, level=logging.DEBUG)
     
     def do_GET(self):
-        global authorization_code
-        
         parsed_path = urlparse(self.path)
-        log(f"Recibida solicitud en: {self.path}")
+        log(f"Recibida solicitud en: {self.path}", level=logging.DEBUG)
         
         # Verificar si es la ruta de callback
         if parsed_path.path == CALLBACK_PATH:
             query_params = parse_qs(parsed_path.query)
-            log(f"Parámetros recibidos: {query_params}")
+            log(f"Parámetros recibidos: {query_params}", level=logging.DEBUG)
+            
+            # El parámetro state identifica la sesión que inició el flujo
+            state = query_params.get('state', [None])[0]
+            session = sessions.find_by_state(state) if state else None
+            # Flujo iniciado en otro worker: el código se le entrega a través del backend compartido
+            remote = session is None and state and shared_store is not None and shared_store.get(f"oauth_state:{state}") is not None
+            if session is None and not remote:
+                log("Callback de autorización con state desconocido", level=logging.WARNING)
+                self.send_response(400)
+                self.send_header('Content-type', 'text/html')
+                self.end_headers()
+                self.wfile.write(b"Error: Estado de autorizacion no valido o caducado")
+                return
             
             if 'code' in query_params:
-                authorization_code = query_params['code'][0]
-                log(f"Código de autorización recibido: {authorization_code[:5]}...")
+                code = query_params['code'][0]
+                if session is not None:
+                    session.authorization_code = code
+                else:
+                    shared_store.set(f"oauth_code:{state}", code, ttl=AUTH_TIMEOUT)
+                log("Código de autorización recibido")
                 self.send_response(200)
                 self.send_header('Content-type', 'text/html')
                 self.end_headers()
@@ -118,10 +452,11 @@ class AuthHandler(BaseHTTPRequestHandler):
                 self.wfile.write(html.encode('utf-8'))
                 
                 # Señalizar que recibimos el código
-                auth_code_received.set()
+                if session is not None:
+                    session.auth_code_received.set()
             else:
                 if 'error' in query_params:
-                    log(f"Error recibido: {query_params['error'][0]}")
+                    log(f"Error recibido: {query_params['error'][0]}", level=logging.ERROR)
                 
                 self.send_response(400)
                 self.send_header('Content-type', 'text/html')
@@ -133,20 +468,30 @@ class AuthHandler(BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(b"Not Found")
 
-# Clase personalizada para gestión de tokens sin archivos
-class MemoryCacheHandler(CacheHandler):
-    def __init__(self, token_info=None):
-        self.token_info = token_info
+# spotipy exige que el manejador herede de su CacheHandler; la clase se crea al primer uso
+# para no importar spotipy al arrancar
+@functools.lru_cache(maxsize=None)
+def memory_cache_handler_class():
+    from spotipy.cache_handler import CacheHandler
+    
+    # Clase personalizada para gestión de tokens sin archivos
+    class MemoryCacheHandler(CacheHandler):
+        def __init__(self, token_info=None):
+            self.token_info = token_info
+            
+        def get_cached_token(self):
+            return self.token_info
         
-    def get_cached_token(self):
-        return self.token_info
+        def save_token_to_cache(self, token_info):
+            self.token_info = token_info
+            return None
     
-    def save_token_to_cache(self, token_info):
-        self.token_info = token_info
-        return None
+    return MemoryCacheHandler
 
 # Método para obtener token directamente sin usar la biblioteca spotipy
 def get_token_directly(code):
+    import requests
+    
     try:
         auth_header = base64.b64encode(f"{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}".encode()).decode()
         headers = {
@@ -160,85 +505,651 @@ def get_token_directly(code):
             'redirect_uri': SPOTIFY_REDIRECT_URI
         }
         
-        log(f"Solicitando token con code: {code[:5]}...")
-        log(f"Usando redirect_uri: {SPOTIFY_REDIRECT_URI}")
+        log("Solicitando token con el código de autorización", level=logging.DEBUG)
+        log(f"Usando redirect_uri: {SPOTIFY_REDIRECT_URI}", level=logging.DEBUG)
         
         response = requests.post(
-            'https://accounts.spotify.com/api/token',
+            f'{SPOTIFY_ACCOUNTS_BASE}/api/token',
             headers=headers,
-            data=data
+            data=data,
+            timeout=HTTP_TIMEOUT
         )
         
         if response.status_code == 200:
             token_info = response.json()
+            # Añadir la fecha de expiración absoluta, igual que hace spotipy
+            token_info['expires_at'] = int(time.time()) + token_info.get('expires_in', 3600)
             log("Token obtenido correctamente con método directo")
             return token_info
         else:
-            log(f"Error al obtener token: {response.status_code} - {response.text}")
+            log(f"Error al obtener token: {response.status_code} - {response.text}", level=logging.ERROR)
             return None
     except Exception as e:
-        log(f"Excepción al obtener token: {str(e)}")
+        log(f"Excepción al obtener token: {str(e)}", level=logging.ERROR)
         return None
 
-# Función para inicializar el cliente de Spotify
-def initialize_spotify_client():
-    global spotify, token_info
+# Almacén de tokens cifrado, con la misma interfaz que MemoryCacheHandler
+# Las subclases solo deciden dónde se guarda el contenido cifrado (archivo o backend compartido)
+class EncryptedTokenStore:
+    always_reload = False  # Releer en cada consulta si otros procesos pueden cambiar el token
     
-    # Si ya existe un cliente, devolverlo
-    if spotify:
-        return spotify
+    def __init__(self, secret):
+        self.secret = secret
+        self.token_info = None
+        self._loaded = False
+        self._salt = None
+        self._fernets = {}
+    
+    def _get_fernet(self, salt):
+        # Derivar la clave una sola vez por proceso y sal
+        if salt not in self._fernets:
+            key = hashlib.pbkdf2_hmac("sha256", self.secret.encode(), salt, 100000)
+            self._fernets[salt] = optional_module("cryptography.fernet").Fernet(base64.urlsafe_b64encode(key))
+        return self._fernets[salt]
+    
+    def _read(self):
+        raise NotImplementedError
+    
+    def _write(self, data):
+        raise NotImplementedError
     
-    # Si tenemos token en memoria, usarlo
-    if token_info:
+    def _remove(self):
+        raise NotImplementedError
+    
+    def get_cached_token(self):
+        if self._loaded and not self.always_reload:
+            return self.token_info
+        
+        self._loaded = True
         try:
-            # Crear manejador de autenticación con nuestro token en memoria
-            scope = "user-read-private user-read-email user-read-playback-state user-modify-playback-state user-read-currently-playing playlist-read-private playlist-modify-private playlist-modify-public user-follow-read user-follow-modify user-top-read user-read-recently-played user-library-read user-library-modify"
+            data = self._read()
+            if data is None:
+                self.token_info = None
+                return None
+            stored = json.loads(data)
+            salt = base64.b64decode(stored["salt"])
+            payload = self._get_fernet(salt).decrypt(stored["token"].encode())
+            self._salt = salt
+            self.token_info = json.loads(payload)
+            log(f"Token cargado desde {self.location}")
+        except (optional_module("cryptography.fernet").InvalidToken, KeyError, ValueError, OSError) as e:
+            log(f"No se pudo leer el token guardado en {self.location}: {type(e).__name__}", level=logging.WARNING)
+            self.token_info = None
+        return self.token_info
+    
+    def save_token_to_cache(self, token_info):
+        self.token_info = token_info
+        self._loaded = True
+        
+        if not token_info:
+            self._remove()
+            return None
+        
+        salt = self._salt or os.urandom(16)
+        self._salt = salt
+        encrypted = self._get_fernet(salt).encrypt(json.dumps(token_info).encode())
+        self._write(json.dumps({"salt": base64.b64encode(salt).decode(), "token": encrypted.decode()}))
+        return None
+
+# Token cifrado en un archivo local
+class EncryptedFileCacheHandler(EncryptedTokenStore):
+    def __init__(self, path, secret):
+        super().__init__(secret)
+        self.path = path
+        self.location = path
+    
+    def _read(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "r") as f:
+            return f.read()
+    
+    def _write(self, data):
+        # Escritura atómica y legible solo por el usuario actual
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+    
+    def _remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# Token cifrado en el backend compartido; se relee siempre porque otro worker puede haberlo renovado
+class SharedTokenStore(EncryptedTokenStore):
+    always_reload = True
+    
+    def __init__(self, store, key, secret):
+        super().__init__(secret)
+        self.store = store
+        self.key = key
+        self.location = f"{store.name}:{key}"
+    
+    def _read(self):
+        return self.store.get(self.key)
+    
+    def _write(self, data):
+        self.store.set(self.key, data)
+    
+    def _remove(self):
+        self.store.delete(self.key)
+
+# Backend compartido en un archivo SQLite: vale para varios workers en la misma máquina
+class SQLiteSharedStore:
+    def __init__(self, path):
+        self.path = path
+        self.name = f"sqlite:{path}"
+        self._conn = None
+        self._lock = threading.Lock()
+        self._writes = 0
+    
+    def _connect(self):
+        if self._conn is None:
+            # Modo autocommit: cada sentencia es su propia transacción salvo los BEGIN explícitos
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+            self._conn = conn
+        return self._conn
+    
+    def get(self, key):
+        with self._lock:
+            row = self._connect().execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return row[0]
+    
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO kv(key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at))
+            # Purgar de vez en cuando las entradas caducadas
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+    
+    def delete(self, key):
+        with self._lock:
+            self._connect().execute("DELETE FROM kv WHERE key = ?", (key,))
+    
+    def acquire_lock(self, name, owner, ttl):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM locks WHERE name = ? AND expires_at <= ?", (name, now))
+                cursor = conn.execute("INSERT OR IGNORE INTO locks(name, owner, expires_at) VALUES (?, ?, ?)", (name, owner, now + ttl))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return cursor.rowcount == 1
+    
+    def release_lock(self, name, owner):
+        with self._lock:
+            self._connect().execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+# Backend compartido en Redis (o cualquier servidor compatible con su protocolo)
+class RedisSharedStore:
+    # Borrar el lock solo si sigue siendo nuestro, de forma atómica
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+    
+    def __init__(self, url, prefix="spotify_mcp:"):
+        self.name = url.split("@")[-1]  # Sin credenciales en los logs
+        self.prefix = prefix
+        self._client = optional_module("redis").Redis.from_url(url, decode_responses=True)
+    
+    def get(self, key):
+        return self._client.get(self.prefix + key)
+    
+    def set(self, key, value, ttl=None):
+        self._client.set(self.prefix + key, value, px=int(ttl * 1000) if ttl else None)
+    
+    def delete(self, key):
+        self._client.delete(self.prefix + key)
+    
+    def acquire_lock(self, name, owner, ttl):
+        return bool(self._client.set(self.prefix + name, owner, nx=True, px=int(ttl * 1000)))
+    
+    def release_lock(self, name, owner):
+        self._client.eval(self.RELEASE_SCRIPT, 1, self.prefix + name, owner)
+
+# Crear el backend compartido a partir de su URL (None si no está configurado)
+def create_shared_store(url):
+    if not url:
+        return None
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        if optional_module("redis") is None:
+            log("Backend compartido desactivado: instala el paquete redis para usar una URL redis://", level=logging.WARNING)
+            return None
+        return RedisSharedStore(url)
+    if url.startswith("sqlite://"):
+        return SQLiteSharedStore(os.path.expanduser(url[len("sqlite://"):]))
+    log(f"Backend compartido no soportado: {url}", level=logging.WARNING)
+    return None
+
+shared_store = create_shared_store(SHARED_BACKEND)
+
+# Lock entre procesos sobre el backend compartido; sin backend solo hay un proceso y no hace falta
+@contextmanager
+def shared_lock(name, ttl=30, timeout=30):
+    if shared_store is None:
+        yield
+        return
+    
+    owner = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}:{random.random()}"
+    deadline = time.monotonic() + timeout
+    while not shared_store.acquire_lock(f"lock:{name}", owner, ttl):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"No se pudo obtener el lock {name}")
+        time.sleep(0.05)
+    try:
+        yield
+    finally:
+        shared_store.release_lock(f"lock:{name}", owner)
+
+# Ruta de un archivo por sesión: la sesión por defecto usa la ruta configurada tal cual
+def session_path(path, key):
+    if key == DEFAULT_SESSION:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{hashlib.sha256(key.encode()).hexdigest()[:16]}{ext}"
+
+# Crear el almacén persistente de una sesión si está configurado (el backend compartido tiene prioridad)
+def create_token_store(key=DEFAULT_SESSION):
+    if not TOKEN_STORE_PATH and not shared_store:
+        return None
+    if optional_module("cryptography.fernet") is None:
+        log("Almacén de tokens desactivado: instala el paquete cryptography para usarlo", level=logging.WARNING)
+        return None
+    if shared_store:
+        return SharedTokenStore(shared_store, f"token:{key}", TOKEN_STORE_KEY or SPOTIFY_CLIENT_SECRET)
+    path = session_path(os.path.expanduser(TOKEN_STORE_PATH), key)
+    return EncryptedFileCacheHandler(path, TOKEN_STORE_KEY or SPOTIFY_CLIENT_SECRET)
+
+# Perfil del usuario autenticado, compartido por todas las herramientas
+# Se invalida al cambiar de autorización (nuevo login o refresh token distinto), no al rotar el access token
+class ProfileCache:
+    def __init__(self):
+        self._profile = None
+        self._grant = None
+        self._lock = threading.Lock()
+    
+    def get(self):
+        with self._lock:
+            return self._profile
+    
+    def set(self, profile, token):
+        with self._lock:
+            self._profile = profile
+            self._grant = token.get('refresh_token') if token else None
+    
+    def invalidate(self):
+        with self._lock:
+            self._profile = None
+            self._grant = None
+    
+    def token_changed(self, token):
+        with self._lock:
+            if not token or token.get('refresh_token') != self._grant:
+                self._profile = None
+                self._grant = None
+
+# Sesión de un usuario: token, cliente verificado, perfil, índice de biblioteca y flujo OAuth propios
+class Session:
+    def __init__(self, key):
+        self.key = key
+        self.token_info = None
+        self.spotify = None  # Cliente spotipy verificado; si existe, la sesión está autenticada
+        self.token_store = create_token_store(key)
+        self.profile_cache = ProfileCache()
+        self.refresh_lock = threading.Lock()
+        self.refresh_retry_at = 0.0
+        self.init_lock = threading.Lock()
+        # El estado del flujo OAuth se modifica desde el hilo de espera y desde el callback
+        self.lock = threading.Lock()
+        self.auth_in_progress = False
+        self.auth_url = None
+        self.auth_state = None
+        self.authorization_code = None
+        self.auth_code_received = threading.Event()
+        self.last_used = time.monotonic()
+        self._library = None
+        self._now_playing = None
+        self._similarity_index = None
+    
+    @property
+    def library(self):
+        with self.lock:
+            if self._library is None:
+                self._library = LibraryIndex(session_path(LIBRARY_DB_PATH, self.key))
+            return self._library
+    
+    @property
+    def now_playing(self):
+        with self.lock:
+            if self._now_playing is None:
+                self._now_playing = NowPlayingPoller(self.key)
+            return self._now_playing
+    
+    # Canciones con características de audio que ha consultado esta cuenta (find_similar_tracks)
+    @property
+    def similarity_index(self):
+        with self.lock:
+            if self._similarity_index is None:
+                self._similarity_index = SimilarityIndex()
+            return self._similarity_index
+    
+    # Recuperar el token guardado en disco de una ejecución anterior
+    def load_token(self):
+        with self.refresh_lock:
+            if self.token_info or not self.token_store:
+                return self.token_info
+            stored_token = self.token_store.get_cached_token()
+            if stored_token:
+                self.token_info = stored_token
+        if stored_token:
+            token_refresher.start()
+            token_refresher.notify()
+        return stored_token
+    
+    # Guardar un nuevo token en memoria y en el almacén persistente
+    def set_token_info(self, new_token):
+        self.token_info = new_token
+        self.refresh_retry_at = 0.0
+        self.profile_cache.token_changed(new_token)
+        if not new_token:
+            self.spotify = None
+        if self.token_store:
+            try:
+                self.token_store.save_token_to_cache(new_token)
+            except Exception as e:
+                log(f"Error al guardar token en disco: {str(e)}", level=logging.ERROR)
+        
+        # Reprogramar la renovación anticipada
+        if new_token:
+            token_refresher.start()
+        token_refresher.notify()
+    
+    # Renovar el token si expira dentro del margen; las renovaciones simultáneas se agrupan en una
+    def ensure_fresh_token(self, margin=60):
+        with self.refresh_lock:
+            current = self.token_info
+            if not current or not current.get('refresh_token'):
+                return current
             
-            # Usar siempre la misma URI que está definida globalmente
-            log(f"Inicializando cliente con URI: {SPOTIFY_REDIRECT_URI}")
+            # Otro hilo pudo renovarlo mientras esperábamos el lock
+            if current.get('expires_at', 0) - margin > time.time():
+                return current
             
-            # Crear auth manager con handler personalizado
-            auth_manager = SpotifyOAuth(
-                client_id=SPOTIFY_CLIENT_ID,
-                client_secret=SPOTIFY_CLIENT_SECRET,
-                redirect_uri=SPOTIFY_REDIRECT_URI,
-                scope=scope,
-                cache_handler=MemoryCacheHandler(token_info),
-                open_browser=False
-            )
+            # Entre workers solo uno renueva; los demás recogen el token que dejó en el backend compartido
+            with shared_lock(f"refresh:{self.key}"):
+                stored = self.token_store.get_cached_token() if shared_store and self.token_store else None
+                if stored and stored.get('refresh_token'):
+                    if stored.get('expires_at', 0) - margin > time.time():
+                        self.token_info = stored
+                        self.profile_cache.token_changed(stored)
+                        token_refresher.notify()
+                        return stored
+                    current = stored
+                
+                log(f"Renovando token de acceso de la sesión {self.key}...")
+                try:
+                    new_token = request_token_refresh(current['refresh_token'])
+                except RefreshTokenRejected:
+                    # Único caso en que se borra el token guardado: los fallos transitorios lo conservan
+                    log(f"El refresh token de la sesión {self.key} ya no es válido; hace falta un nuevo login", level=logging.WARNING)
+                    self.set_token_info(None)
+                    raise
+                self.set_token_info(new_token)
+                token_refresher.refreshes += 1
+                log("Token renovado correctamente")
+                return new_token
+    
+    def close(self):
+        with self.lock:
+            if self._library is not None:
+                self._library.close()
+                self._library = None
+            if self._now_playing is not None:
+                self._now_playing.stop()
+
+# Registro de sesiones con desalojo LRU; las sesiones con un login en curso no se desalojan
+class SessionRegistry:
+    def __init__(self, max_sessions):
+        self.max_sessions = max(max_sessions, 1)
+        self._sessions = OrderedDict()
+        self._by_state = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+    
+    def get(self, key):
+        evicted = []
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = Session(key)
+                self._sessions[key] = session
+                evicted = self._evict(keep=key)
+            self._sessions.move_to_end(key)
+            session.last_used = time.monotonic()
+        
+        # Cerrar recursos fuera del lock; el token sigue en el almacén y se recarga al volver
+        for old_session in evicted:
+            log(f"Sesión {old_session.key} desalojada por inactividad")
+            old_session.close()
+        return session
+    
+    def _evict(self, keep):
+        evicted = []
+        for key in list(self._sessions):
+            if len(self._sessions) <= self.max_sessions:
+                break
+            session = self._sessions[key]
+            if key == keep or session.auth_in_progress:
+                continue
+            del self._sessions[key]
+            evicted.append(session)
+            self.evictions += 1
+        return evicted
+    
+    def register_state(self, state, session):
+        with self._lock:
+            self._by_state[state] = session
+        # El callback puede llegar a otro worker: el state se publica en el backend compartido
+        if shared_store:
+            shared_store.set(f"oauth_state:{state}", session.key, ttl=AUTH_TIMEOUT)
+    
+    def find_by_state(self, state):
+        with self._lock:
+            return self._by_state.get(state)
+    
+    def forget_state(self, state):
+        with self._lock:
+            self._by_state.pop(state, None)
+        if shared_store:
+            shared_store.delete(f"oauth_state:{state}")
+            shared_store.delete(f"oauth_code:{state}")
+    
+    def all(self):
+        with self._lock:
+            return list(self._sessions.values())
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "active": len(self._sessions),
+                "authenticated": sum(1 for session in self._sessions.values() if session.spotify),
+                "auth_in_progress": sum(1 for session in self._sessions.values() if session.auth_in_progress),
+                "max_sessions": self.max_sessions,
+                "evictions": self.evictions
+            }
+
+sessions = SessionRegistry(MAX_SESSIONS)
+
+# Clave de la sesión de la petición en curso (la fija el decorador de herramientas)
+session_key = contextvars.ContextVar("session_key", default=DEFAULT_SESSION)
+
+def current_session():
+    return sessions.get(session_key.get())
+
+# El refresh token fue revocado o caducó (invalid_grant): solo un nuevo login lo arregla
+class RefreshTokenRejected(Exception):
+    pass
+
+def oauth_error_code(response):
+    try:
+        return response.json().get("error")
+    except ValueError:
+        return None
+
+# Pedir un nuevo token de acceso con el refresh token
+def request_token_refresh(refresh_token):
+    import requests
+    
+    auth_header = base64.b64encode(f"{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}".encode()).decode()
+    response = requests.post(
+        f'{SPOTIFY_ACCOUNTS_BASE}/api/token',
+        headers={
+            'Authorization': f'Basic {auth_header}',
+            'Content-Type': 'application/x-www-form-urlencoded'
+        },
+        data={'grant_type': 'refresh_token', 'refresh_token': refresh_token},
+        timeout=HTTP_TIMEOUT
+    )
+    if response.status_code == 400 and oauth_error_code(response) == "invalid_grant":
+        raise RefreshTokenRejected(f"Spotify rechazó el refresh token: {response.text}")
+    if response.status_code != 200:
+        raise Exception(f"Error al renovar token: {response.status_code} - {response.text}")
+    
+    new_token = response.json()
+    new_token['expires_at'] = int(time.time()) + new_token.get('expires_in', 3600)
+    # Spotify no siempre devuelve un refresh token nuevo
+    new_token.setdefault('refresh_token', refresh_token)
+    return new_token
+
+# Hilo en segundo plano que renueva los tokens de todas las sesiones poco antes de que expiren
+class TokenRefresher:
+    def __init__(self, margin):
+        self.margin = margin
+        self.refreshes = 0
+        self.failures = 0
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+    
+    def start(self):
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="token-refresher")
+            self._thread.daemon = True
+            self._thread.start()
+    
+    def notify(self):
+        self._wakeup.set()
+    
+    def _run(self):
+        while True:
+            timeout = None  # Sin tokens renovables, esperar a que llegue uno
+            for session in sessions.all():
+                current = session.token_info
+                if not current or not current.get('refresh_token'):
+                    continue
+                
+                # Con tokens de vida corta, renovar a mitad de su duración
+                margin = min(self.margin, current.get('expires_in', 3600) / 2)
+                due = max(current.get('expires_at', 0) - margin, session.refresh_retry_at) - time.time()
+                if due <= 0:
+                    try:
+                        current = session.ensure_fresh_token(margin)
+                        due = current.get('expires_at', 0) - margin - time.time()
+                    except Exception as e:
+                        self.failures += 1
+                        log(f"Error en la renovación anticipada del token de la sesión {session.key}: {str(e)}", level=logging.ERROR)
+                        session.refresh_retry_at = time.time() + TOKEN_REFRESH_RETRY_DELAY
+                        due = TOKEN_REFRESH_RETRY_DELAY
+                timeout = due if timeout is None else min(timeout, due)
             
-            # Verificar si el token está expirado
-            if auth_manager.is_token_expired(token_info):
-                log("Token expirado, renovando...")
+            self._wakeup.wait(None if timeout is None else max(timeout, 0))
+            self._wakeup.clear()
+
+token_refresher = TokenRefresher(TOKEN_REFRESH_MARGIN)
+
+# Función para inicializar el cliente de Spotify de una sesión
+def initialize_spotify_client(session):
+    # Si ya existe un cliente, devolverlo
+    if session.spotify:
+        return session.spotify
+    
+    # Las llamadas simultáneas (calentamiento y primeras herramientas) esperan a una sola verificación
+    with session.init_lock:
+        if session.spotify:
+            return session.spotify
+        
+        # Recuperar el token guardado en disco de una ejecución anterior
+        session.load_token()
+        
+        # Si tenemos token en memoria, usarlo
+        token_info = session.token_info
+        if token_info:
+            try:
+                # spotipy se importa aquí y no al arrancar: es lo más lento de cargar después de mcp
+                import spotipy
+                from spotipy.oauth2 import SpotifyOAuth
+                
+                # Crear manejador de autenticación con nuestro token en memoria
+                scope = "user-read-private user-read-email user-read-playback-state user-modify-playback-state user-read-currently-playing playlist-read-private playlist-modify-private playlist-modify-public user-follow-read user-follow-modify user-top-read user-read-recently-played user-library-read user-library-modify"
+                
+                # Usar siempre la misma URI que está definida globalmente
+                log(f"Inicializando cliente con URI: {SPOTIFY_REDIRECT_URI}", level=logging.DEBUG)
+                
+                # Crear auth manager con handler personalizado
+                auth_manager = SpotifyOAuth(
+                    client_id=SPOTIFY_CLIENT_ID,
+                    client_secret=SPOTIFY_CLIENT_SECRET,
+                    redirect_uri=SPOTIFY_REDIRECT_URI,
+                    scope=scope,
+                    cache_handler=memory_cache_handler_class()(token_info),
+                    open_browser=False
+                )
+                
+                # Verificar si el token está expirado
+                if auth_manager.is_token_expired(token_info):
+                    log("Token expirado, renovando...")
+                    try:
+                        auth_manager.cache_handler.save_token_to_cache(session.ensure_fresh_token())
+                    except Exception as e:
+                        log(f"Error al renovar token: {str(e)}", level=logging.ERROR)
+                        return None
+                
+                # Crear cliente con el token válido
+                spotify_client = spotipy.Spotify(auth_manager=auth_manager, requests_timeout=HTTP_TIMEOUT)
+                spotify_client.prefix = f"{SPOTIFY_API_BASE.rstrip('/')}/"
+                
+                # Verificar que funciona
                 try:
-                    token_info = auth_manager.refresh_access_token(token_info['refresh_token'])
-                    log("Token renovado correctamente")
+                    user_info = spotify_client.me()
+                    log(f"Cliente verificado. Usuario: {user_info['display_name']}")
+                    session.profile_cache.set(user_info, session.token_info)
+                    session.spotify = spotify_client
+                    return spotify_client
                 except Exception as e:
-                    log(f"Error al renovar token: {str(e)}")
-                    token_info = None
+                    log(f"Error al verificar cliente: {str(e)}", level=logging.ERROR)
                     return None
-            
-            # Crear cliente con el token válido
-            spotify_client = spotipy.Spotify(auth_manager=auth_manager)
-            
-            # Verificar que funciona
-            try:
-                user_info = spotify_client.me()
-                log(f"Cliente verificado. Usuario: {user_info['display_name']}")
-                spotify = spotify_client
-                return spotify
             except Exception as e:
-                log(f"Error al verificar cliente: {str(e)}")
+                log(f"Error al inicializar cliente: {str(e)}", level=logging.ERROR)
                 return None
-        except Exception as e:
-            log(f"Error al inicializar cliente: {str(e)}")
-            return None
-    
-    # Si no tenemos token en memoria, devolver None
-    return None
+        
+        # Si no tenemos token en memoria, devolver None
+        return None
 
-# Función para generar la URL de autorización directamente
-def generate_auth_url():
+# Función para generar la URL de autorización directamente (state identifica la sesión en el callback)
+def generate_auth_url(state):
     scope = "user-read-private user-read-email user-read-playback-state user-modify-playback-state user-read-currently-playing playlist-read-private playlist-modify-private playlist-modify-public user-follow-read user-follow-modify user-top-read user-read-recently-played user-library-read user-library-modify"
     scope_encoded = quote(scope)
     
@@ -248,102 +1159,174 @@ def generate_auth_url():
         f"&response_type=code"
         f"&redirect_uri={quote(SPOTIFY_REDIRECT_URI)}"
         f"&scope={scope_encoded}"
+        f"&state={quote(state)}"
     )
     
     return auth_url
 
-# Función para manejar el proceso de autenticación OAuth
-def authenticate_user():
-    global auth_in_progress, auth_url, authorization_code, spotify, token_info
+# Servidor HTTP del callback OAuth, compartido por los flujos de todas las sesiones
+class CallbackServer:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._server = None
+        self._users = 0
+        self._lock = threading.Lock()
     
-    # Si ya está en curso, no iniciar otro proceso
-    if auth_in_progress:
-        return {
-            "status": "in_progress",
-            "message": "Ya hay un proceso de autenticación en curso. Revisa el navegador o usa login() nuevamente para ver la URL."
-        }
+    def acquire(self):
+        with self._lock:
+            if self._server is None:
+                try:
+                    server = ThreadingHTTPServer((self.host, self.port), AuthHandler)
+                except OSError as e:
+                    # Con backend compartido otro worker puede estar atendiendo el callback
+                    if shared_store is None:
+                        raise
+                    log(f"El callback OAuth lo atiende otro proceso ({str(e)})")
+                    return False
+                server.daemon_threads = True
+                server_thread = threading.Thread(target=server.serve_forever)
+                server_thread.daemon = True
+                server_thread.start()
+                self._server = server
+                log(f"Servidor HTTP iniciado en {self.host}:{self.port}")
+            self._users += 1
+            return True
+    
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            # Detener el servidor cuando no queda ningún flujo pendiente
+            # (con varios workers se mantiene: puede recibir callbacks de flujos de otros procesos)
+            if self._users <= 0 and self._server is not None and shared_store is None:
+                self._server.shutdown()
+                self._server.server_close()
+                self._server = None
+                self._users = 0
+
+callback_server = CallbackServer(HOST, DEFAULT_PORT)
+
+# Esperar el código de autorización: llega por el callback local o, con varios workers, por el backend compartido
+def wait_for_authorization_code(session, state, timeout):
+    if shared_store is None:
+        return session.auth_code_received.wait(timeout)
     
-    auth_in_progress = True
-    auth_url = None
-    authorization_code = None
-    auth_code_received.clear()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if session.auth_code_received.wait(min(1.0, max(deadline - time.monotonic(), 0))):
+            return True
+        code = shared_store.get(f"oauth_code:{state}")
+        if code:
+            session.authorization_code = code
+            return True
+    return False
+
+# Función para manejar el proceso de autenticación OAuth de una sesión
+def authenticate_user(session):
+    with session.lock:
+        # Si ya está en curso, no iniciar otro proceso
+        if session.auth_in_progress:
+            return {
+                "status": "in_progress",
+                "message": "Ya hay un proceso de autenticación en curso. Revisa el navegador o usa login() nuevamente para ver la URL."
+            }
+        
+        session.auth_in_progress = True
+        session.auth_url = None
+        session.authorization_code = None
+        session.auth_code_received.clear()
+        state = base64.urlsafe_b64encode(os.urandom(18)).decode()
+        session.auth_state = state
     
-    # Iniciar servidor HTTP para callback en puerto fijo
+    # Iniciar (o reutilizar) el servidor HTTP para el callback en puerto fijo
     try:
-        server = HTTPServer((HOST, DEFAULT_PORT), AuthHandler)
-        log(f"Servidor HTTP iniciado en {HOST}:{DEFAULT_PORT}")
+        owns_callback = callback_server.acquire()
     except Exception as e:
-        log(f"Error al iniciar servidor HTTP: {str(e)}")
-        auth_in_progress = False
+        log(f"Error al iniciar servidor HTTP: {str(e)}", level=logging.ERROR)
+        with session.lock:
+            session.auth_in_progress = False
+            session.auth_state = None
         return {
             "status": "error",
             "message": f"No se pudo iniciar el servidor para autenticación: {str(e)}"
         }
     
-    # Iniciar servidor en thread
-    server_thread = threading.Thread(target=server.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
+    sessions.register_state(state, session)
     
     # Generar URL de autorización directamente
-    auth_url = generate_auth_url()
+    auth_url = generate_auth_url(state)
+    with session.lock:
+        session.auth_url = auth_url
     log(f"URL de autorización generada: {auth_url}")
     
     # Abrir navegador
     try:
+        import webbrowser
         webbrowser.open(auth_url)
         log("Navegador abierto con URL de autenticación")
     except:
-        log("No se pudo abrir el navegador automáticamente")
+        log("No se pudo abrir el navegador automáticamente", level=logging.WARNING)
     
     # Iniciar thread para esperar código de autorización
     def wait_for_auth():
-        global auth_in_progress, spotify, token_info
-        
-        # Esperar por el código (timeout: 5 minutos)
-        if auth_code_received.wait(300):
-            try:
-                # Intentar obtener el token directamente sin spotipy para más control
-                new_token = get_token_directly(authorization_code)
-                
-                if not new_token:
-                    log("No se pudo obtener token con método directo, intentando con spotipy")
-                    # Intentar con spotipy como respaldo
-                    auth_manager = SpotifyOAuth(
-                        client_id=SPOTIFY_CLIENT_ID,
-                        client_secret=SPOTIFY_CLIENT_SECRET,
-                        redirect_uri=SPOTIFY_REDIRECT_URI,
-                        scope="user-read-private",
-                        cache_handler=MemoryCacheHandler(),
-                        open_browser=False
-                    )
-                    
-                    new_token = auth_manager.get_access_token(authorization_code)
-                
-                # Guardar token en memoria
-                token_info = new_token
-                log("Token obtenido y guardado en memoria")
-                
-                # Inicializar cliente
-                spotify = spotipy.Spotify(auth=token_info['access_token'])
-                log("Cliente de Spotify inicializado correctamente")
-                
-                # Verificar que funciona
+        try:
+            # Esperar por el código (timeout: 5 minutos)
+            if wait_for_authorization_code(session, state, AUTH_TIMEOUT):
+                authorization_code = session.authorization_code
                 try:
-                    user_info = spotify.me()
-                    log(f"Cliente verificado. Usuario: {user_info['display_name']}")
+                    # Intentar obtener el token directamente sin spotipy para más control
+                    new_token = get_token_directly(authorization_code)
+                    
+                    if not new_token:
+                        log("No se pudo obtener token con método directo, intentando con spotipy", level=logging.WARNING)
+                        # Intentar con spotipy como respaldo
+                        from spotipy.oauth2 import SpotifyOAuth
+                        auth_manager = SpotifyOAuth(
+                            client_id=SPOTIFY_CLIENT_ID,
+                            client_secret=SPOTIFY_CLIENT_SECRET,
+                            redirect_uri=SPOTIFY_REDIRECT_URI,
+                            scope="user-read-private",
+                            cache_handler=memory_cache_handler_class()(),
+                            open_browser=False
+                        )
+                        
+                        new_token = auth_manager.get_access_token(authorization_code)
+                    
+                    # Guardar token en memoria (y en disco si el almacén está activado)
+                    session.set_token_info(new_token)
+                    log(f"Token obtenido y guardado en memoria para la sesión {session.key}")
+                    
+                    # Inicializar cliente
+                    import spotipy
+                    spotify_client = spotipy.Spotify(auth=new_token['access_token'], requests_timeout=HTTP_TIMEOUT)
+                    spotify_client.prefix = f"{SPOTIFY_API_BASE.rstrip('/')}/"
+                    log("Cliente de Spotify inicializado correctamente")
+                    
+                    # Verificar que funciona
+                    try:
+                        user_info = spotify_client.me()
+                        # Una cuenta de red solo admite el login de su propio usuario de Spotify
+                        if session.key != DEFAULT_SESSION and user_info['id'] != session.key:
+                            log(f"Login rechazado: el usuario {user_info['id']} no es el de la cuenta {session.key}", level=logging.WARNING)
+                            session.set_token_info(None)
+                            return
+                        log(f"Cliente verificado. Usuario: {user_info['display_name']}")
+                        session.profile_cache.set(user_info, new_token)
+                        session.spotify = spotify_client
+                    except Exception as e:
+                        log(f"Error al verificar cliente: {str(e)}", level=logging.ERROR)
                 except Exception as e:
-                    log(f"Error al verificar cliente: {str(e)}")
-                    spotify = None
-            except Exception as e:
-                log(f"Error durante autenticación: {str(e)}")
-                spotify = None
-        else:
-            log("Timeout alcanzado esperando autenticación")
-        
-        # Detener servidor
-        server.shutdown()
-        auth_in_progress = False
+                    log(f"Error durante autenticación: {str(e)}", level=logging.ERROR)
+            else:
+                log("Timeout alcanzado esperando autenticación", level=logging.WARNING)
+        finally:
+            # Detener servidor si no quedan otros flujos y liberar el state
+            sessions.forget_state(state)
+            if owns_callback:
+                callback_server.release()
+            with session.lock:
+                session.auth_in_progress = False
+                session.auth_state = None
     
     auth_thread = threading.Thread(target=wait_for_auth)
     auth_thread.daemon = True
@@ -355,157 +1338,2522 @@ def authenticate_user():
         "auth_url": auth_url
     }
 
-# Crear servidor MCP
-mcp = FastMCP("Spotify MCP")
+# Error devuelto por la Web API de Spotify
+class SpotifyAPIError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(f"http status: {status}, {message}")
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
 
-@mcp.tool()
-def login() -> Dict[str, Any]:
-    """
-    Iniciar sesión en Spotify o verificar estado de autenticación.
-    Si ya estás autenticado, simplemente lo confirma.
-    Si no, inicia el proceso de autenticación automáticamente.
-    """
-    global spotify, token_info
+# Histograma de buckets fijos, compatible con el formato de Prometheus
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum")
+    
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
     
-    # Intentar usar cliente existente o inicializar desde token
-    if not spotify:
-        spotify = initialize_spotify_client()
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
     
-    # Si ya tenemos cliente, confirmar autenticación
-    if spotify:
+    # Percentil aproximado por interpolación lineal dentro del bucket
+    def quantile(self, fraction):
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= target and bucket_count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (target - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+    
+    def summary(self, scale=1.0):
         return {
-            "status": "authenticated",
-            "message": "Ya estás autenticado con Spotify."
+            "count": self.count,
+            "mean": round(self.sum / self.count * scale, 2) if self.count else 0.0,
+            "p50": round(self.quantile(0.50) * scale, 2),
+            "p95": round(self.quantile(0.95) * scale, 2),
+            "p99": round(self.quantile(0.99) * scale, 2)
         }
+
+# Registro de métricas del servidor: herramientas MCP y llamadas a la API de Spotify
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.tool_latency = {}
+        self.tool_payload = {}
+        self.tool_calls = Counter()
+        self.tool_errors = Counter()
+        self.upstream_latency = {}
+        self.upstream_payload = {}
+        self.upstream_calls = Counter()
+        self.upstream_coalesced = Counter()
     
-    # Si hay una autenticación en curso, informar al usuario
-    if auth_in_progress:
-        if auth_url:
-            return {
-                "status": "auth_in_progress",
-                "message": "Proceso de autenticación en curso. Abre este enlace en tu navegador:",
-                "auth_url": auth_url
-            }
-        else:
-            return {
-                "status": "auth_starting",
-                "message": "Iniciando proceso de autenticación..."
-            }
+    def observe_tool(self, tool, seconds, error, payload_bytes=None):
+        with self._lock:
+            self.tool_calls[tool] += 1
+            if error:
+                self.tool_errors[tool] += 1
+            self.tool_latency.setdefault(tool, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            if payload_bytes is not None:
+                self.tool_payload.setdefault(tool, Histogram(SIZE_BUCKETS)).observe(payload_bytes)
     
-    # Iniciar nuevo proceso de autenticación (sin token existente)
-    token_info = None
-    return authenticate_user()
-
-@mcp.tool()
-def search_track(query: str, limit: int = 10) -> List[Dict[str, Any]]:
-    """Buscar canciones en Spotify."""
-    global spotify
+    def should_sample_payload(self, tool):
+        # Serializar la respuesta tiene coste, así que solo se mide una de cada N
+        return PAYLOAD_SAMPLE_EVERY > 0 and self.tool_calls[tool] % PAYLOAD_SAMPLE_EVERY == 0
     
-    # Verificar autenticación
-    if not spotify:
-        spotify = initialize_spotify_client()
-        if not spotify:
-            return [{"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}]
+    def observe_upstream(self, endpoint, status, seconds, payload_bytes):
+        with self._lock:
+            self.upstream_calls[(endpoint, status)] += 1
+            self.upstream_latency.setdefault(endpoint, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            self.upstream_payload.setdefault(endpoint, Histogram(SIZE_BUCKETS)).observe(payload_bytes)
     
-    # Realizar búsqueda
-    try:
-        results = spotify.search(q=query, type="track", limit=limit)
-        tracks = results["tracks"]["items"]
-        
-        return [{
-            "id": track["id"],
-            "name": track["name"],
-            "artist": track["artists"][0]["name"],
-            "album": track["album"]["name"],
-            "duration_ms": track["duration_ms"],
-            "popularity": track["popularity"],
-            "preview_url": track["preview_url"]
-        } for track in tracks]
-    except Exception as e:
-        log(f"Error al buscar canciones: {str(e)}")
+    # Percentil de latencia de un endpoint, o None si aún no hay suficientes observaciones
+    def upstream_quantile(self, endpoint, fraction, min_count):
+        with self._lock:
+            histogram = self.upstream_latency.get(endpoint)
+            if histogram is None or histogram.count < min_count:
+                return None
+            return histogram.quantile(fraction)
+    
+    def observe_coalesced(self, endpoint):
+        with self._lock:
+            self.upstream_coalesced[endpoint] += 1
+    
+    def snapshot(self):
+        with self._lock:
+            tools = {}
+            for tool, histogram in self.tool_latency.items():
+                tools[tool] = {
+                    "calls": self.tool_calls[tool],
+                    "errors": self.tool_errors[tool],
+                    "latency_ms": histogram.summary(1000)
+                }
+                if tool in self.tool_payload:
+                    tools[tool]["payload_bytes"] = self.tool_payload[tool].summary()
+            
+            upstream = {}
+            for endpoint, histogram in self.upstream_latency.items():
+                upstream[endpoint] = {
+                    "calls": {str(status): count for (name, status), count in self.upstream_calls.items() if name == endpoint},
+                    "coalesced": self.upstream_coalesced[endpoint],
+                    "latency_ms": histogram.summary(1000),
+                    "payload_bytes": self.upstream_payload[endpoint].summary()
+                }
+            
+            return {
+                "uptime_seconds": round(time.time() - self.started_at, 1),
+                "tools": tools,
+                "upstream": upstream,
+                "coalesced_requests": sum(self.upstream_coalesced.values())
+            }
+
+metrics = Metrics()
+
+# Nombre de endpoint sin IDs, para agrupar métricas (p. ej. "GET playlists/{id}/tracks")
+ID_PARENT_SEGMENTS = {"playlists", "users", "albums", "artists", "tracks", "shows", "episodes", "audiobooks"}
+
+def endpoint_label(method, path):
+    segments = urlparse(path).path.strip("/").split("/")
+    if segments and segments[0] == "v1":
+        segments = segments[1:]
+    
+    normalized = []
+    for index, segment in enumerate(segments):
+        if index > 0 and segments[index - 1] in ID_PARENT_SEGMENTS and normalized[-1] != "{id}":
+            normalized.append("{id}")
+        else:
+            normalized.append(segment)
+    return f"{method} {'/'.join(normalized)}"
+
+# Detectar las respuestas de error que las herramientas devuelven como datos
+def is_error_result(result):
+    if isinstance(result, dict):
+        return "error" in result
+    if isinstance(result, list) and len(result) == 1 and isinstance(result[0], dict):
+        return "error" in result[0]
+    return False
+
+# Prioridad de las peticiones lanzadas desde el contexto actual
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_DEFAULT)
+
+# Ejecutar un bloque con una prioridad de petición concreta
+@contextmanager
+def priority(level):
+    reset_token = request_priority.set(level)
+    try:
+        yield
+    finally:
+        request_priority.reset(reset_token)
+
+# Planificador central de peticiones: cubo de tokens con cola por prioridad y pausa global tras un 429
+class RequestScheduler:
+    def __init__(self, max_requests, window):
+        self.capacity = max_requests
+        self.rate = max_requests / window
+        self._tokens = float(max_requests)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._timer = None
+        self.throttled = 0
+        self.retries = 0
+        self.delayed = 0
+    
+    async def acquire(self, level=None):
+        if level is None:
+            level = request_priority.get()
+        
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (level, next(self._sequence), future))
+        self._dispatch()
+        
+        if not future.done():
+            self.delayed += 1
+        # Si la tarea se cancela, el futuro queda cancelado y _dispatch lo descarta
+        await future
+    
+    # Token sin esperar, para peticiones prescindibles (como las duplicadas): nunca adelanta a la cola
+    def try_acquire(self):
+        now = time.monotonic()
+        self._refill(now)
+        if self._waiting or now < self._blocked_until or self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+    
+    def throttle(self, retry_after):
+        # Spotify pide esperar: nadie sale de la cola hasta que pase Retry-After
+        self.throttled += 1
+        self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        self._tokens = 0.0
+        log(f"Límite de peticiones alcanzado, esperando {retry_after:.1f}s", level=logging.WARNING)
+    
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def _dispatch(self):
+        now = time.monotonic()
+        self._refill(now)
+        
+        # Entregar tokens a los que esperan por orden de prioridad y llegada
+        while self._waiting and now >= self._blocked_until and self._tokens >= 1:
+            _, _, future = heapq.heappop(self._waiting)
+            if future.done():
+                continue
+            self._tokens -= 1
+            future.set_result(None)
+        
+        # Descartar cancelados y programar el siguiente intento si aún hay cola
+        while self._waiting and self._waiting[0][2].done():
+            heapq.heappop(self._waiting)
+        if self._waiting and self._timer is None:
+            delay = max(self._blocked_until - now, (1 - self._tokens) / self.rate, 0.001)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+    
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+    
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "queue_depth": sum(1 for _, _, future in self._waiting if not future.done()),
+            "tokens_available": round(min(self.capacity, self._tokens + (now - self._updated) * self.rate), 2),
+            "capacity": self.capacity,
+            "window_seconds": self.capacity / self.rate,
+            "blocked_for_seconds": round(max(self._blocked_until - now, 0), 2),
+            "throttled": self.throttled,
+            "retries": self.retries,
+            "delayed": self.delayed
+        }
+
+# Planificador compartido por todas las peticiones a la API
+# Con varios workers el límite de la aplicación se reparte entre ellos
+scheduler = RequestScheduler(max(RATE_LIMIT_REQUESTS // HTTP_WORKERS, 1), RATE_LIMIT_WINDOW)
+
+# Segundos a esperar según la cabecera Retry-After (por defecto 1 segundo)
+def parse_retry_after(headers):
+    try:
+        return max(float(headers.get("Retry-After", 1)), 0.0)
+    except ValueError:
+        return 1.0
+
+# Espera antes de reintentar: backoff exponencial con jitter
+def retry_delay(attempt):
+    return RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+# Cortacircuitos de un endpoint: cerrado (normal), abierto (falla rápido) o semiabierto (una petición de prueba)
+class CircuitBreaker:
+    def __init__(self, endpoint, failure_threshold, cooldown):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+        self.opened = 0
+        self.rejected = 0
+    
+    def allow(self):
+        if self.state == "closed":
+            return True
+        # Pasado el enfriamiento pasa una petición de prueba; si no termina (p. ej. se cancela), caduca tras otro
+        now = time.monotonic()
+        since = self.opened_at if self.state == "open" else self.probe_started
+        if now - since >= self.cooldown:
+            self.state = "half_open"
+            self.probe_started = now
+            return True
+        self.rejected += 1
+        return False
+    
+    def record_success(self):
+        if self.state != "closed":
+            log(f"Circuito de {self.endpoint} cerrado: Spotify responde de nuevo")
+        self.state = "closed"
+        self.failures = 0
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.opened += 1
+            log(f"Circuito de {self.endpoint} abierto tras {self.failures} fallos seguidos", level=logging.WARNING)
+    
+    def stats(self):
+        return {"state": self.state, "consecutive_failures": self.failures, "opened": self.opened, "rejected": self.rejected}
+
+# Plazos, peticiones duplicadas y cortacircuitos de todas las llamadas a la API
+class Resilience:
+    def __init__(self):
+        self.breakers = {}
+        self.hedge_candidates = 0
+        self.hedged = Counter()
+        self.hedge_wins = Counter()
+        self.deadline_exceeded = Counter()
+        self.stale_served = Counter()
+    
+    def breaker(self, endpoint):
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            breaker = self.breakers[endpoint] = CircuitBreaker(endpoint, BREAKER_FAILURES, BREAKER_COOLDOWN)
+        return breaker
+    
+    # Las peticiones en segundo plano (sincronización, exportaciones) solo tienen el timeout de cada intento
+    def deadline(self, endpoint):
+        if request_priority.get() >= PRIORITY_BULK:
+            return None
+        seconds = UPSTREAM_DEADLINES.get(endpoint, UPSTREAM_DEADLINE)
+        return seconds if seconds > 0 else None
+    
+    # Cuánto esperar a la primera respuesta antes de duplicar un GET (None = no duplicar)
+    def hedge_delay(self, endpoint):
+        if HEDGE_PERCENTILE <= 0:
+            return None
+        self.hedge_candidates += 1
+        threshold = metrics.upstream_quantile(endpoint, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+        return None if threshold is None else max(threshold, HEDGE_MIN_DELAY)
+    
+    # Presupuesto de duplicados: si Spotify va lento en general, duplicar todo solo duplicaría la carga
+    def allow_hedge(self, endpoint):
+        if sum(self.hedged.values()) >= HEDGE_MAX_RATIO * self.hedge_candidates + 1:
+            return False
+        if self.breaker(endpoint).state != "closed":
+            return False
+        if not scheduler.try_acquire():
+            return False
+        self.hedged[endpoint] += 1
+        return True
+    
+    def stats(self):
+        return {
+            "deadline_seconds": UPSTREAM_DEADLINE,
+            "deadlines": UPSTREAM_DEADLINES,
+            "hedge_percentile": HEDGE_PERCENTILE,
+            "hedged": sum(self.hedged.values()),
+            "hedge_wins": sum(self.hedge_wins.values()),
+            "deadline_exceeded": dict(self.deadline_exceeded),
+            "stale_served": dict(self.stale_served),
+            "breakers": {endpoint: breaker.stats() for endpoint, breaker in self.breakers.items()}
+        }
+
+resilience = Resilience()
+
+# Esperar una corrutina como mucho timeout segundos; a diferencia de asyncio.wait_for,
+# una cancelación externa siempre se propaga
+async def run_with_deadline(coro, timeout):
+    if timeout is None:
+        return await coro
+    task = asyncio.ensure_future(coro)
+    try:
+        await asyncio.wait({task}, timeout=timeout)
+    finally:
+        timed_out = not task.done()
+        if timed_out:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    if timed_out:
+        raise TimeoutError()
+    return task.result()
+
+def response_error(response):
+    try:
+        message = response.json()["error"]["message"]
+    except Exception:
+        message = response.text
+    return SpotifyAPIError(response.status_code, message, response.headers)
+
+# Cliente asíncrono de la Web API que comparte un pool de conexiones keep-alive
+class SpotifyAPI:
+    def __init__(self, base_url, max_connections, timeout):
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._client = None
+        self._loop = None
+        self._inflight = {}
+    
+    def _get_client(self):
+        # El pool pertenece al bucle de eventos en el que se creó
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._inflight = {}
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=30
+                ),
+                timeout=self.timeout
+            )
+            self._loop = loop
+        return self._client
+    
+    async def request(self, method, path, params=None, json_body=None):
+        # Omitir parámetros sin valor, como hace spotipy
+        if params:
+            params = {key: value for key, value in params.items() if value is not None}
+        
+        # Solo las lecturas se reintentan ante errores de red o 5xx; un 429 indica que la petición no se procesó
+        idempotent = method == "GET"
+        endpoint = endpoint_label(method, path)
+        
+        # Caché en disco: el catálogo se sirve sin petición mientras está fresco; lo demás se revalida con su ETag
+        cache_key = None
+        cached = None
+        policy = http_cache_policy(self._relative_path(path)) if idempotent and http_cache else None
+        if policy:
+            cache_key = http_cache_key(self._relative_path(path), params)
+            cached = await asyncio.to_thread(http_cache.get, cache_key)
+            if cached and policy == "fresh" and time.time() - cached.stored_at < http_cache.ttl:
+                http_cache.record_hit()
+                return json.loads(cached.body)
+        
+        # Con el circuito abierto no se espera a un Spotify que no responde
+        breaker = resilience.breaker(endpoint)
+        if not breaker.allow():
+            return await self._serve_stale(endpoint, policy, cache_key, cached, SpotifyAPIError(503, f"Spotify no responde en {endpoint}, se reintentará en unos segundos"))
+        
+        headers = {}
+        if cached and cached.etag:
+            headers["If-None-Match"] = cached.etag
+        
+        # En las lecturas el plazo cubre la cola del planificador, los intentos y los reintentos.
+        # Una escritura ya enviada puede haberse aplicado aunque no llegue la respuesta: su plazo
+        # solo limita la espera en la cola, y el envío queda acotado por el timeout HTTP
+        deadline = resilience.deadline(endpoint)
+        in_flight = [False]
+        try:
+            if idempotent:
+                response = await run_with_deadline(
+                    self._send_with_retries(method, path, params, json_body, headers, endpoint, idempotent, breaker, in_flight),
+                    deadline
+                )
+            else:
+                queue_deadline = asyncio.get_running_loop().time() + deadline if deadline is not None else None
+                response = await self._send_with_retries(
+                    method, path, params, json_body, headers, endpoint, idempotent, breaker, in_flight, queue_deadline
+                )
+        except TimeoutError:
+            resilience.deadline_exceeded[endpoint] += 1
+            # Esperar en la cola propia no es culpa de Spotify
+            if in_flight[0]:
+                breaker.record_failure()
+            return await self._serve_stale(endpoint, policy, cache_key, cached, SpotifyAPIError(504, f"Spotify no respondió en {deadline:g}s"))
+        except SpotifyAPIError as e:
+            return await self._serve_stale(endpoint, policy, cache_key, cached, e)
+        
+        if response.status_code >= 500:
+            return await self._serve_stale(endpoint, policy, cache_key, cached, response_error(response))
+        if response.status_code >= 400:
+            raise response_error(response)
+        
+        if cache_key:
+            if response.status_code == 304 and cached:
+                await asyncio.to_thread(http_cache.revalidated, cache_key)
+                return json.loads(cached.body)
+            # Sin ETag solo merece la pena guardar lo que se sirve sin revalidar
+            if response.status_code == 200 and (policy == "fresh" or response.headers.get("etag")):
+                await asyncio.to_thread(http_cache.put, cache_key, response.headers.get("etag"), response.content)
+        
+        if response.status_code == 204 or not response.content:
+            return None
+        return response.json()
+    
+    async def _send_with_retries(self, method, path, params, json_body, headers, endpoint, idempotent, breaker, in_flight, queue_deadline=None):
+        attempt = 0
+        while True:
+            if queue_deadline is None:
+                await scheduler.acquire()
+            else:
+                remaining = queue_deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    raise TimeoutError()
+                await run_with_deadline(scheduler.acquire(), remaining)
+            
+            access_token = await current_access_token()
+            if not access_token:
+                raise SpotifyAPIError(401, "No hay token de acceso")
+            
+            # Si el plazo vence durante el envío, la marca queda puesta y cuenta como fallo de Spotify
+            started = time.perf_counter()
+            in_flight[0] = True
+            try:
+                response = await self._send(
+                    endpoint,
+                    idempotent,
+                    method=method,
+                    url=path,
+                    params=params,
+                    json=json_body,
+                    headers=dict(headers, Authorization=f"Bearer {access_token}")
+                )
+                in_flight[0] = False
+                metrics.observe_upstream(endpoint, response.status_code, time.perf_counter() - started, len(response.content))
+            except httpx.TransportError as e:
+                in_flight[0] = False
+                metrics.observe_upstream(endpoint, "error", time.perf_counter() - started, 0)
+                breaker.record_failure()
+                if idempotent and attempt < MAX_RETRIES and breaker.state == "closed":
+                    scheduler.retries += 1
+                    await asyncio.sleep(retry_delay(attempt))
+                    attempt += 1
+                    continue
+                raise SpotifyAPIError(503, f"Error de conexión: {str(e)}")
+            
+            if response.status_code >= 500:
+                breaker.record_failure()
+                if idempotent and attempt < MAX_RETRIES and breaker.state == "closed":
+                    scheduler.retries += 1
+                    await asyncio.sleep(retry_delay(attempt))
+                    attempt += 1
+                    continue
+                return response
+            
+            # Cualquier otra respuesta, incluido un 429, demuestra que Spotify está atendiendo
+            breaker.record_success()
+            if response.status_code == 429 and attempt < MAX_RETRIES:
+                scheduler.throttle(parse_retry_after(response.headers))
+                scheduler.retries += 1
+                attempt += 1
+                continue
+            return response
+    
+    # Enviar una petición; si es un GET y tarda más que el percentil habitual del endpoint, se lanza
+    # una copia y gana la primera respuesta sin error de servidor (la otra se cancela)
+    async def _send(self, endpoint, hedge, **request):
+        client = self._get_client()
+        delay = resilience.hedge_delay(endpoint) if hedge else None
+        if delay is None:
+            return await client.request(**request)
+        
+        first = asyncio.ensure_future(client.request(**request))
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done and resilience.allow_hedge(endpoint):
+                pending.add(asyncio.ensure_future(client.request(**request)))
+            
+            # Un 5xx o un error de red solo se devuelven si la otra copia tampoco responde bien
+            error = None
+            failed_response = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                    elif task.result().status_code >= 500:
+                        failed_response = failed_response or task.result()
+                    else:
+                        if task is not first:
+                            resilience.hedge_wins[endpoint] += 1
+                        return task.result()
+            if failed_response is not None:
+                return failed_response
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+    
+    # Spotify no responde: se sirve la última respuesta guardada del catálogo, aunque esté caducada, o se
+    # propaga el error. La caché es común a todas las sesiones, así que las playlists nunca se sirven sin
+    # que Spotify las autorice con el token de quien las pide
+    async def _serve_stale(self, endpoint, policy, cache_key, cached, error):
+        if policy != "fresh" or cached is None or error.status < 500:
+            raise error
+        resilience.stale_served[endpoint] += 1
+        log(f"Spotify no responde en {endpoint} ({error.status}): se sirve la respuesta guardada", level=logging.WARNING)
+        return json.loads(cached.body)
+    
+    # Las URLs de paginación son absolutas; la caché las identifica por la ruta relativa a la API
+    def _relative_path(self, path):
+        base = self.base_url.rstrip("/") + "/"
+        return path[len(base):] if path.startswith(base) else path.lstrip("/")
+    
+    async def get(self, path, **params):
+        if not COALESCE_REQUESTS:
+            return await self.request("GET", path, params=params)
+        
+        # Single-flight: los GETs idénticos en curso comparten una sola petición y su resultado
+        # (el mismo objeto para todos, por eso las respuestas no se modifican)
+        # La clave incluye la sesión: dos usuarios nunca comparten una respuesta
+        key = (session_key.get(), path, tuple(sorted((name, str(value)) for name, value in params.items() if value is not None)))
+        self._get_client()
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.request("GET", path, params=params))
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._forget_inflight, key))
+        else:
+            metrics.observe_coalesced(endpoint_label("GET", path))
+        
+        # shield: si un llamante se cancela, la petición sigue para los demás
+        return await asyncio.shield(task)
+    
+    def _forget_inflight(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Marcar el error como consultado aunque todos los llamantes se hayan cancelado
+        if not task.cancelled():
+            task.exception()
+    
+    async def post(self, path, json_body=None, **params):
+        return await self.request("POST", path, params=params, json_body=json_body)
+    
+    async def put(self, path, json_body=None, **params):
+        return await self.request("PUT", path, params=params, json_body=json_body)
+    
+    async def delete(self, path, json_body=None, **params):
+        return await self.request("DELETE", path, params=params, json_body=json_body)
+    
+    # Endpoints usados por las herramientas (mismos nombres y respuestas que spotipy)
+    async def search(self, q, type="track", limit=10, offset=0, market=None):
+        return await self.get("search", q=q, type=type, limit=limit, offset=offset, market=market)
+    
+    async def me(self):
+        return await self.get("me")
+    
+    async def audio_features(self, track_ids):
+        result = await self.get("audio-features", ids=",".join(track_ids))
+        return result["audio_features"]
+    
+    async def current_playback(self, market=None, additional_types=None):
+        return await self.get("me/player", market=market, additional_types=additional_types)
+    
+    async def tracks(self, track_ids, market=None):
+        result = await self.get("tracks", ids=",".join(track_ids), market=market)
+        return result["tracks"]
+    
+    async def albums(self, album_ids, market=None):
+        result = await self.get("albums", ids=",".join(album_ids), market=market)
+        return result["albums"]
+    
+    async def artists(self, artist_ids):
+        result = await self.get("artists", ids=",".join(artist_ids))
+        return result["artists"]
+    
+    async def start_playback(self, uris=None, device_id=None):
+        return await self.put("me/player/play", json_body={"uris": uris}, device_id=device_id)
+    
+    async def pause_playback(self, device_id=None):
+        return await self.put("me/player/pause", device_id=device_id)
+    
+    async def user_playlist_create(self, user, name, public=True, description=None):
+        body = {"name": name, "public": public, "description": description or ""}
+        return await self.post(f"users/{user}/playlists", json_body=body)
+    
+    async def playlist_add_items(self, playlist_id, items, position=None):
+        return await self.post(f"playlists/{playlist_id}/tracks", json_body={"uris": items}, position=position)
+    
+    async def playlist(self, playlist_id, fields=None, market=None):
+        return await self.get(f"playlists/{playlist_id}", fields=fields, market=market)
+    
+    async def playlist_remove_specific_occurrences_of_items(self, playlist_id, items, snapshot_id=None):
+        body = {"tracks": items}
+        if snapshot_id:
+            body["snapshot_id"] = snapshot_id
+        return await self.delete(f"playlists/{playlist_id}/tracks", json_body=body)
+    
+    async def playlist_reorder_items(self, playlist_id, range_start, insert_before, range_length=1, snapshot_id=None):
+        body = {"range_start": range_start, "insert_before": insert_before, "range_length": range_length}
+        if snapshot_id:
+            body["snapshot_id"] = snapshot_id
+        return await self.put(f"playlists/{playlist_id}/tracks", json_body=body)
+    
+    async def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, additional_types=("track",)):
+        return await self.get(
+            f"playlists/{playlist_id}/tracks",
+            fields=fields,
+            limit=limit,
+            offset=offset,
+            additional_types=",".join(additional_types)
+        )
+    
+    async def current_user_playlists(self, limit=50, offset=0):
+        return await self.get("me/playlists", limit=limit, offset=offset)
+    
+    async def current_user_saved_tracks(self, limit=20, offset=0, market=None):
+        return await self.get("me/tracks", limit=limit, offset=offset, market=market)
+    
+    async def current_user_recently_played(self, limit=50, after=None, before=None):
+        return await self.get("me/player/recently-played", limit=limit, after=after, before=before)
+    
+    async def current_user_top_tracks(self, limit=20, offset=0, time_range="medium_term"):
+        return await self.get("me/top/tracks", limit=limit, offset=offset, time_range=time_range)
+    
+    async def current_user_top_artists(self, limit=20, offset=0, time_range="medium_term"):
+        return await self.get("me/top/artists", limit=limit, offset=offset, time_range=time_range)
+    
+    async def next(self, result):
+        # La URL de la siguiente página es absoluta e incluye sus parámetros
+        return await self.request("GET", result["next"]) if result.get("next") else None
+    
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+# httpx registra cada petición a nivel INFO; basta con nuestros propios logs
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Respuesta guardada en la caché HTTP
+class CachedResponse:
+    __slots__ = ("etag", "body", "stored_at")
+    
+    def __init__(self, etag, body, stored_at):
+        self.etag = etag
+        self.body = body
+        self.stored_at = stored_at
+
+# Caché HTTP persistente en SQLite, por debajo del cliente de la API
+# Los cuerpos se guardan comprimidos con su ETag; al superar el presupuesto de bytes se desalojan
+# las respuestas usadas hace más tiempo. Es común a todas las sesiones: las playlists siempre se
+# revalidan con el token de quien pregunta, así que una cuenta sin acceso recibe el error de Spotify
+class HTTPCache:
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._conn = None
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self.hits = 0  # Servidas sin petición
+        self.revalidations = 0  # Respuestas 304
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.errors = 0
+    
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY, etag TEXT, body BLOB, size INTEGER,
+                    stored_at REAL, last_used REAL
+                );
+                CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used);
+            """)
+            self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        return self._conn
+    
+    def get(self, key):
+        with self._lock:
+            try:
+                conn = self._connect()
+                row = conn.execute("SELECT etag, body, stored_at, last_used FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                # Los aciertos solo escriben si last_used es antiguo: el LRU no necesita más precisión
+                now = time.time()
+                if now - row[3] > HTTP_CACHE_TOUCH_INTERVAL:
+                    conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+                    conn.commit()
+                return CachedResponse(row[0], zlib.decompress(row[1]), row[2])
+            except (sqlite3.Error, zlib.error) as e:
+                # Un fallo de la caché nunca impide la petición
+                self.errors += 1
+                log(f"Error al leer la caché HTTP: {str(e)}", level=logging.ERROR)
+                return None
+    
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+    
+    # 304: la copia sigue siendo válida y vuelve a contar como fresca
+    def revalidated(self, key):
+        with self._lock:
+            self.revalidations += 1
+            try:
+                conn = self._connect()
+                conn.execute("UPDATE responses SET stored_at = ? WHERE key = ?", (time.time(), key))
+                conn.commit()
+            except sqlite3.Error as e:
+                self.errors += 1
+                log(f"Error al actualizar la caché HTTP: {str(e)}", level=logging.ERROR)
+    
+    def put(self, key, etag, body):
+        compressed = zlib.compress(body)
+        if len(compressed) > self.max_bytes:
+            return
+        
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connect()
+                previous = conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, etag, body, size, stored_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, etag, compressed, len(compressed), now, now)
+                )
+                self._total_bytes += len(compressed) - (previous[0] if previous else 0)
+                self.stores += 1
+                if self._total_bytes > self.max_bytes:
+                    self._evict(conn)
+                conn.commit()
+            except sqlite3.Error as e:
+                self.errors += 1
+                log(f"Error al escribir en la caché HTTP: {str(e)}", level=logging.ERROR)
+    
+    def _evict(self, conn):
+        # Otros workers pueden escribir en el mismo archivo: se recalcula el tamaño real
+        self._total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        
+        # Desalojar hasta el 90% del presupuesto para no hacerlo en cada escritura
+        target = self.max_bytes * 0.9
+        rows = conn.execute("SELECT key, size FROM responses ORDER BY last_used")
+        evicted = []
+        for key, size in rows:
+            if self._total_bytes <= target:
+                break
+            evicted.append((key,))
+            self._total_bytes -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    def stats(self):
+        with self._lock:
+            try:
+                entries = self._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            except sqlite3.Error:
+                entries = None
+            lookups = self.hits + self.revalidations + self.misses
+            return {
+                "entries": entries,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "revalidations": self.revalidations,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "errors": self.errors,
+                "hit_rate": round((self.hits + self.revalidations) / lookups, 3) if lookups else 0.0
+            }
+
+HTTP_CACHE_CATALOGUE = {"tracks", "albums", "artists"}
+
+# Qué respuestas se guardan: el catálogo ("fresh", se usa sin revalidar durante el TTL)
+# y las playlists ("revalidate", siempre con If-None-Match); el resto depende del usuario o cambia a menudo
+def http_cache_policy(path):
+    segments = path.split("?", 1)[0].strip("/").split("/")
+    if segments[0] in HTTP_CACHE_CATALOGUE:
+        return "fresh"
+    if segments[0] == "playlists" and (len(segments) == 2 or (len(segments) == 3 and segments[2] == "tracks")):
+        return "revalidate"
+    return None
+
+def http_cache_key(path, params):
+    if not params:
+        return path
+    query = urlencode(sorted((name, str(value)) for name, value in params.items()))
+    return f"{path}&{query}" if "?" in path else f"{path}?{query}"
+
+http_cache = HTTPCache(HTTP_CACHE_PATH, HTTP_CACHE_MAX_BYTES, HTTP_CACHE_TTL) if HTTP_CACHE_PATH and HTTP_CACHE_MAX_BYTES > 0 else None
+
+# Cliente compartido por todas las herramientas
+spotify_api = SpotifyAPI(SPOTIFY_API_BASE, HTTP_MAX_CONNECTIONS, HTTP_TIMEOUT)
+
+# Obtener un token de acceso válido
+# Normalmente el hilo de renovación ya lo ha renovado; esto solo cubre el caso en que se haya retrasado
+async def current_access_token():
+    session = current_session()
+    current = session.token_info
+    if not current:
+        return None
+    
+    if current.get('refresh_token') and current.get('expires_at', 0) - 60 < time.time():
+        try:
+            current = await asyncio.to_thread(session.ensure_fresh_token)
+        except Exception as e:
+            log(f"Error al renovar token: {str(e)}", level=logging.ERROR)
+    
+    return current['access_token'] if current else None
+
+# Obtener el perfil del usuario actual desde la caché, o de la API si no está o se pide refrescarlo
+async def get_current_user(api, refresh=False):
+    session = current_session()
+    profile = None if refresh else session.profile_cache.get()
+    if profile is None:
+        profile = await api.me()
+        session.profile_cache.set(profile, session.token_info)
+    return profile
+
+# Obtener el cliente de la API si la sesión actual está autenticada
+async def get_api_client():
+    session = current_session()
+    if not session.spotify:
+        if not await asyncio.to_thread(initialize_spotify_client, session):
+            return None
+    return spotify_api
+
+# Caché en memoria con expiración por tiempo (TTL) y desalojo LRU
+# Con ttl=0 las entradas no caducan y solo se desalojan por tamaño
+# Con namespace y backend compartido, los fallos se consultan en el backend (segundo nivel común a los workers)
+class ResponseCache:
+    def __init__(self, ttl, max_entries, namespace=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.namespace = namespace
+        self.shared = shared_store if namespace else None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.shared_hits = 0
+    
+    def _shared_key(self, key):
+        return f"cache:{self.namespace}:{key if isinstance(key, str) else json.dumps(key)}"
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    # Marcar como usada recientemente
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                # Entrada caducada: se descarta y cuenta como fallo
+                del self._entries[key]
+        
+        value = self._get_shared(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.shared_hits += 1
+        return value
+    
+    def _get_shared(self, key):
+        if self.shared is None or self.max_entries <= 0:
+            return None
+        try:
+            data = self.shared.get(self._shared_key(key))
+        except Exception as e:
+            log(f"Error al leer la caché compartida: {str(e)}", level=logging.ERROR)
+            return None
+        if data is None:
+            return None
+        
+        # Conservar la caducidad original de la entrada
+        stored = json.loads(data)
+        remaining = stored["expires_at"] - time.time() if stored["expires_at"] else None
+        self._store(key, stored["value"], time.monotonic() + remaining if remaining is not None else None)
+        return stored["value"]
+    
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._store(key, value, expires_at)
+        
+        if self.shared is not None:
+            try:
+                stored = {"value": value, "expires_at": time.time() + self.ttl if self.ttl else None}
+                self.shared.set(self._shared_key(key), json.dumps(stored), ttl=self.ttl or None)
+            except Exception as e:
+                log(f"Error al escribir en la caché compartida: {str(e)}", level=logging.ERROR)
+    
+    def _store(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            
+            # Desalojar las entradas usadas hace más tiempo
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "shared": self.shared is not None,
+                "shared_hits": self.shared_hits,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+# Caché compartida por search_track y search_album
+search_cache = ResponseCache(SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES, namespace="search")
+
+# Normalizar los parámetros de búsqueda para construir la clave de caché
+# La clave incluye la sesión: los resultados dependen del mercado y la cuenta de cada usuario
+def search_cache_key(query, search_type, limit, market=None):
+    normalized_query = " ".join(query.lower().split())
+    return (session_key.get(), normalized_query, search_type, int(limit), (market or "").upper())
+
+# Búsqueda en Spotify pasando por la caché de respuestas
+async def cached_search(query, search_type, limit, market=None, use_cache=True):
+    key = search_cache_key(query, search_type, limit, market)
+    
+    if use_cache:
+        results = search_cache.get(key)
+        if results is not None:
+            return results
+    
+    results = await spotify_api.search(q=query, type=search_type, limit=limit, market=market)
+    search_cache.set(key, results)
+    return results
+
+# Dividir una lista en bloques de tamaño fijo
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+# Ejecutar una corrutina sobre varios elementos en paralelo con un límite de concurrencia, conservando el orden
+# Si una falla se cancelan las demás
+async def gather_with_limit(func, items, limit=MAX_CONCURRENT_REQUESTS):
+    semaphore = asyncio.Semaphore(limit)
+    
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+    
+    tasks = [asyncio.ensure_future(run(item)) for item in items]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # Al primer fallo (o si se cancela la llamada) no dejar peticiones huérfanas en marcha
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+# Caché de características de audio por ID de canción
+audio_features_cache = ResponseCache(0, AUDIO_FEATURES_CACHE_MAX_ENTRIES, namespace="audio_features")
+
+# Extraer los campos de características de audio que devuelven las herramientas
+def format_audio_features(features):
+    return {
+        "danceability": features["danceability"],
+        "energy": features["energy"],
+        "key": features["key"],
+        "loudness": features["loudness"],
+        "mode": features["mode"],
+        "speechiness": features["speechiness"],
+        "acousticness": features["acousticness"],
+        "instrumentalness": features["instrumentalness"],
+        "liveness": features["liveness"],
+        "valence": features["valence"],
+        "tempo": features["tempo"],
+        "duration_ms": features["duration_ms"],
+        "time_signature": features["time_signature"]
+    }
+
+# Características numéricas con las que se comparan canciones
+SIMILARITY_FEATURES = (
+    "danceability", "energy", "valence", "tempo", "loudness",
+    "acousticness", "instrumentalness", "speechiness", "liveness"
+)
+
+# Matriz de características de audio (una fila por canción) para buscar vecinos más cercanos
+# Con max_tracks lleno se desaloja la canción usada hace más tiempo y la última fila ocupa su hueco
+class SimilarityIndex:
+    def __init__(self, features=SIMILARITY_FEATURES, initial_capacity=1024, max_tracks=SIMILARITY_INDEX_MAX_TRACKS):
+        self.features = features
+        self.columns = {name: index for index, name in enumerate(features)}
+        self._matrix = None
+        self._initial_capacity = max(min(initial_capacity, max_tracks), 1)
+        self.max_tracks = max(max_tracks, 1)
+        self._ids = []
+        self._rows = OrderedDict()
+        self._scale = None
+        self.evictions = 0
+    
+    def __len__(self):
+        return len(self._ids)
+    
+    def __contains__(self, track_id):
+        return track_id in self._rows
+    
+    # Añadir o actualizar una canción; la matriz crece duplicando su capacidad hasta max_tracks
+    def add(self, track_id, features):
+        np = optional_module("numpy")
+        if np is None:
+            return
+        if self._matrix is None:
+            self._matrix = np.zeros((self._initial_capacity, len(self.features)))
+        
+        row = self._rows.get(track_id)
+        if row is None:
+            if len(self._ids) >= self.max_tracks:
+                self._evict_oldest()
+            row = len(self._ids)
+            if row == self._matrix.shape[0]:
+                capacity = min(self._matrix.shape[0] * 2, self.max_tracks)
+                self._matrix = np.concatenate([self._matrix, np.zeros((capacity - self._matrix.shape[0], len(self.features)))])
+            self._ids.append(track_id)
+            self._rows[track_id] = row
+        else:
+            self._rows.move_to_end(track_id)
+            # Los aciertos de caché repiten valores: no invalidar la normalización si no cambian
+            if (self._matrix[row] == [features[name] for name in self.features]).all():
+                return
+        
+        self._matrix[row] = [features[name] for name in self.features]
+        self._scale = None
+    
+    def _evict_oldest(self):
+        track_id, row = self._rows.popitem(last=False)
+        last_id = self._ids.pop()
+        if last_id != track_id:
+            self._matrix[row] = self._matrix[len(self._ids)]
+            self._ids[row] = last_id
+            self._rows[last_id] = row
+        self.evictions += 1
+    
+    def values(self, track_id, features):
+        row = self._matrix[self._rows[track_id]]
+        return {name: float(row[self.columns[name]]) for name in features}
+    
+    # Media y desviación por columna, recalculadas solo cuando cambian los datos
+    def _normalization(self):
+        if self._scale is None:
+            data = self._matrix[:len(self._ids)]
+            std = data.std(axis=0)
+            std[std == 0] = 1.0
+            self._scale = (data.mean(axis=0), std)
+        return self._scale
+    
+    # Las k canciones más cercanas (distancia euclídea sobre columnas normalizadas)
+    def nearest(self, track_id, k=10, features=None):
+        np = optional_module("numpy")
+        columns = [self.columns[name] for name in features or self.features]
+        mean, std = self._normalization()
+        data = (self._matrix[:len(self._ids), columns] - mean[columns]) / std[columns]
+        
+        seed_row = self._rows[track_id]
+        distances = np.sqrt(((data - data[seed_row]) ** 2).sum(axis=1))
+        distances[seed_row] = np.inf
+        
+        k = min(k, len(self._ids) - 1)
+        if k <= 0:
+            return []
+        # argpartition evita ordenar toda la matriz: solo se ordenan los k mejores
+        candidates = np.argpartition(distances, k - 1)[:k]
+        candidates = candidates[np.argsort(distances[candidates])]
+        return [(self._ids[row], float(distances[row])) for row in candidates]
+
+# Obtener características de audio de muchas canciones usando la caché y lotes de 100 IDs
+async def fetch_audio_features(track_ids):
+    # Eliminar duplicados conservando el orden original
+    unique_ids = list(dict.fromkeys(track_ids))
+    
+    # La caché es común a todas las cuentas; el índice de similitud es de la sesión que las consulta
+    similarity_index = current_session().similarity_index
+    results = {}
+    missing = []
+    for track_id in unique_ids:
+        features = audio_features_cache.get(track_id)
+        if features is not None:
+            results[track_id] = features
+            similarity_index.add(track_id, features)
+        else:
+            missing.append(track_id)
+    
+    batches = chunked(missing, AUDIO_FEATURES_BATCH_SIZE)
+    
+    async def fetch_batch(batch):
+        try:
+            return batch, await spotify_api.audio_features(batch), None
+        except Exception as e:
+            return batch, None, str(e)
+    
+    errors = []
+    for batch, batch_features, error in await gather_with_limit(fetch_batch, batches):
+        if error:
+            log(f"Error al obtener características de audio de {len(batch)} canciones: {error}", level=logging.ERROR)
+            errors.append(error)
+            continue
+        
+        for track_id, features in zip(batch, batch_features):
+            if features:
+                formatted = format_audio_features(features)
+                audio_features_cache.set(track_id, formatted)
+                similarity_index.add(track_id, formatted)
+                results[track_id] = formatted
+            else:
+                # La API devuelve null para IDs sin características
+                results[track_id] = None
+    
+    return {
+        "features": {track_id: results.get(track_id) for track_id in unique_ids},
+        "from_cache": len(unique_ids) - len(missing),
+        "api_requests": len(batches),
+        "errors": errors
+    }
+
+# Obtener objetos del catálogo por ID en lotes paralelos del tamaño que admite cada endpoint
+# Devuelve los objetos encontrados en el orden de entrada, sin duplicados; la API devuelve null para IDs inexistentes
+async def fetch_by_ids(fetch_batch, ids, batch_size):
+    unique_ids = list(dict.fromkeys(ids))
+    batches = chunked(unique_ids, batch_size)
+    
+    found = {}
+    for batch, items in zip(batches, await gather_with_limit(fetch_batch, batches)):
+        for item_id, item in zip(batch, items):
+            if item:
+                found[item_id] = item
+    
+    missing = len(unique_ids) - len(found)
+    if missing:
+        log(f"{missing} de {len(unique_ids)} IDs no existen en el catálogo", level=logging.WARNING)
+    return [found[item_id] for item_id in unique_ids if item_id in found]
+
+# Obtener los IDs de todas las canciones que ya están en una playlist
+async def fetch_playlist_track_ids(playlist_id):
+    track_ids = set()
+    page = await spotify_api.playlist_items(
+        playlist_id,
+        fields="items(track(id)),next",
+        limit=100,
+        additional_types=["track"]
+    )
+    while page:
+        for item in page["items"]:
+            track = item.get("track")
+            if track and track.get("id"):
+                track_ids.add(track["id"])
+        page = await spotify_api.next(page) if page.get("next") else None
+    return track_ids
+
+# Registro ligero con __slots__: los resultados grandes se construyen sin un dict por elemento
+class Record:
+    __slots__ = ()
+    FIELDS = ()
+    
+    def __init__(self, *values):
+        for name, value in zip(self.FIELDS, values):
+            setattr(self, name, value)
+    
+    # Validar la proyección pedida por el usuario (None devuelve todos los campos)
+    @classmethod
+    def select_fields(cls, fields=None):
+        if not fields:
+            return cls.FIELDS
+        unknown = [name for name in fields if name not in cls.FIELDS]
+        if unknown:
+            raise ValueError(f"Campos no válidos: {', '.join(unknown)}. Disponibles: {', '.join(cls.FIELDS)}")
+        return tuple(dict.fromkeys(fields))
+    
+    def as_dict(self, fields=None):
+        return {name: getattr(self, name) for name in fields or self.FIELDS}
+    
+    def as_row(self, fields):
+        return [getattr(self, name) for name in fields]
+
+class TrackRecord(Record):
+    FIELDS = ("id", "name", "artist", "album", "duration_ms", "popularity", "preview_url")
+    __slots__ = FIELDS
+    
+    @classmethod
+    def from_api(cls, track):
+        return cls(
+            track["id"],
+            track["name"],
+            track["artists"][0]["name"],
+            track["album"]["name"],
+            track["duration_ms"],
+            track["popularity"],
+            track["preview_url"]
+        )
+
+class AlbumRecord(Record):
+    FIELDS = ("id", "name", "artist", "release_date", "total_tracks", "images")
+    __slots__ = FIELDS
+    
+    @classmethod
+    def from_api(cls, album):
+        return cls(
+            album["id"],
+            album["name"],
+            album["artists"][0]["name"],
+            album["release_date"],
+            album["total_tracks"],
+            album["images"]
+        )
+
+class ArtistRecord(Record):
+    FIELDS = ("id", "name", "genres", "popularity", "followers", "images")
+    __slots__ = FIELDS
+    
+    @classmethod
+    def from_api(cls, artist):
+        return cls(
+            artist["id"],
+            artist["name"],
+            artist["genres"],
+            artist["popularity"],
+            artist["followers"]["total"],
+            artist["images"]
+        )
+
+class PlaylistRecord(Record):
+    FIELDS = ("id", "name", "owner", "public", "tracks_total", "url")
+    __slots__ = FIELDS
+    
+    @classmethod
+    def from_api(cls, playlist):
+        return cls(
+            playlist["id"],
+            playlist["name"],
+            playlist["owner"]["display_name"],
+            playlist["public"],
+            playlist["tracks"]["total"],
+            playlist["external_urls"]["spotify"]
+        )
+
+class ProfileRecord(Record):
+    FIELDS = ("id", "display_name", "email", "country", "product", "followers", "images")
+    __slots__ = FIELDS
+    
+    @classmethod
+    def from_api(cls, user):
+        return cls(
+            user["id"],
+            user["display_name"],
+            user.get("email", ""),
+            user.get("country", ""),
+            user["product"],
+            user["followers"]["total"],
+            user["images"]
+        )
+
+# Dar forma a una lista de registros: dicts con los campos pedidos o, en modo compacto,
+# columnas una sola vez y una fila por elemento
+def project_records(records, fields, compact=False):
+    if compact:
+        return {"fields": list(fields), "rows": [record.as_row(fields) for record in records]}
+    return [record.as_dict(fields) for record in records]
+
+# Extraer los campos de una playlist que devuelven las herramientas
+def format_playlist(playlist):
+    return PlaylistRecord.from_api(playlist).as_dict()
+
+# Codificar y decodificar cursores opacos de paginación
+def encode_cursor(offset, limit):
+    payload = json.dumps({"offset": offset, "limit": limit}).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return int(payload["offset"]), int(payload["limit"])
+    except Exception:
+        raise ValueError("Cursor de paginación no válido")
+
+# Obtener varias páginas de un listado: la primera da el total y el resto se pide en paralelo
+async def fetch_paged(fetch_page, page_size, limit=None):
+    first_page = await fetch_page(0)
+    total = first_page["total"]
+    wanted = total if limit is None else min(limit, total)
+    
+    offsets = list(range(page_size, wanted, page_size))
+    pages = await gather_with_limit(fetch_page, offsets)
+    
+    items = list(first_page["items"])
+    for page in pages:
+        items.extend(page["items"])
+    return items[:wanted]
+
+# Obtener las playlists del usuario actual (todas o hasta limit)
+async def fetch_user_playlists(limit=None):
+    return await fetch_paged(
+        lambda offset: spotify_api.current_user_playlists(limit=PLAYLISTS_PAGE_SIZE, offset=offset),
+        PLAYLISTS_PAGE_SIZE,
+        limit
+    )
+
+# Obtener todos los elementos de una playlist
+async def fetch_playlist_items(playlist_id):
+    return await fetch_paged(
+        lambda offset: spotify_api.playlist_items(playlist_id, limit=PLAYLIST_ITEMS_PAGE_SIZE, offset=offset),
+        PLAYLIST_ITEMS_PAGE_SIZE
+    )
+
+# URIs de los elementos de una playlist, en orden (solo se pide el campo necesario)
+async def fetch_playlist_uris(playlist_id):
+    items = await fetch_paged(
+        lambda offset: spotify_api.playlist_items(
+            playlist_id, fields="items(track(uri)),total", limit=PLAYLIST_ITEMS_PAGE_SIZE, offset=offset,
+            additional_types=("track", "episode")
+        ),
+        PLAYLIST_ITEMS_PAGE_SIZE
+    )
+    return [(item.get("track") or {}).get("uri") for item in items]
+
+# Subsecuencia común más larga (Hunt-Szymanski: subsecuencia creciente más larga sobre los pares coincidentes)
+# Devuelve los pares (posición actual, posición deseada) de los elementos que no hace falta tocar.
+# Coste O((n + r) log n) con r pares coincidentes, en lugar de la tabla n x m de la versión clásica
+def lcs_pairs(current, desired):
+    positions = {}
+    for j, item in enumerate(desired):
+        positions.setdefault(item, []).append(j)
+    
+    pairs = []
+    previous = []
+    tails = []  # tails[k]: par con el menor final de una subsecuencia de longitud k + 1
+    tail_values = []
+    for i, item in enumerate(current):
+        # En orden descendente, para usar como mucho una posición deseada por cada posición actual
+        for j in reversed(positions.get(item, ())):
+            k = bisect.bisect_left(tail_values, j)
+            pairs.append((i, j))
+            previous.append(tails[k - 1] if k else -1)
+            if k == len(tails):
+                tails.append(len(pairs) - 1)
+                tail_values.append(j)
+            else:
+                tails[k] = len(pairs) - 1
+                tail_values[k] = j
+    
+    result = []
+    index = tails[-1] if tails else -1
+    while index >= 0:
+        result.append(pairs[index])
+        index = previous[index]
+    result.reverse()
+    return result
+
+# Operaciones para convertir current en desired: borrados, movimientos de bloques y luego inserciones
+# Las posiciones de cada operación se calculan simulando las anteriores, en el mismo orden en que se aplicarán
+def playlist_operations(current, desired, matched, moves):
+    kept = {i for i, _ in matched} | set(moves.values())
+    placed = {j: i for i, j in matched}
+    placed.update(moves)
+    
+    operations = []
+    # Borrar de mayor a menor posición: cada lote no desplaza las posiciones de los siguientes
+    removed = [i for i in range(len(current) - 1, -1, -1) if i not in kept]
+    for batch in chunked(removed, PLAYLIST_REMOVE_BATCH_SIZE):
+        operations.append(("remove", [(current[i], i) for i in batch]))
+    
+    # Mover bloques de elementos contiguos tanto en la lista actual como en la deseada,
+    # colocando cada uno justo detrás del elemento que le precede en la lista deseada
+    simulated = [i for i in range(len(current)) if i in kept]
+    blocks = []
+    for j in sorted(moves):
+        if blocks and blocks[-1][-1][0] == j - 1 and blocks[-1][-1][1] == moves[j] - 1:
+            blocks[-1].append((j, moves[j]))
+        else:
+            blocks.append([(j, moves[j])])
+    
+    for block in blocks:
+        start = simulated.index(block[0][1])
+        length = len(block)
+        anchor = next((placed[j] for j in range(block[0][0] - 1, -1, -1) if j in placed), None)
+        insert_before = simulated.index(anchor) + 1 if anchor is not None else 0
+        if start <= insert_before <= start + length:
+            continue
+        operations.append(("reorder", start, length, insert_before))
+        moved = simulated[start:start + length]
+        rest = simulated[:start] + simulated[start + length:]
+        target = insert_before if insert_before < start else insert_before - length
+        simulated = rest[:target] + moved + rest[target:]
+    
+    # Insertar las canciones nuevas por tramos contiguos; delante de cada tramo ya está todo en su sitio
+    result = [current[i] for i in simulated]
+    run = []
+    for j in range(len(desired) + 1):
+        if j < len(desired) and j not in placed:
+            run.append(j)
+            continue
+        for chunk in chunked(run, PLAYLIST_ADD_BATCH_SIZE):
+            operations.append(("insert", [desired[index] for index in chunk], chunk[0]))
+            result[chunk[0]:chunk[0]] = [desired[index] for index in chunk]
+        run = []
+    
+    if result != desired:
+        raise ValueError("El plan de sincronización no reproduce la lista deseada")
+    return operations
+
+# Plan con el menor número de peticiones: compara mover bloques (conserva la fecha en que se añadieron)
+# con quitar y volver a añadir esos elementos, que se agrupan en menos peticiones si están muy dispersos
+def plan_playlist_sync(current, desired):
+    matched = lcs_pairs(current, desired)
+    matched_current = {i for i, _ in matched}
+    matched_desired = {j for _, j in matched}
+    
+    # Elementos que siguen en la playlist pero en otro orden: candidatos a moverse
+    available = {}
+    for i, item in enumerate(current):
+        if i not in matched_current:
+            available.setdefault(item, deque()).append(i)
+    moves = {}
+    for j, item in enumerate(desired):
+        if j not in matched_desired and available.get(item):
+            moves[j] = available[item].popleft()
+    
+    without_moves = playlist_operations(current, desired, matched, {})
+    if not moves:
+        return without_moves, len(matched)
+    with_moves = playlist_operations(current, desired, matched, moves)
+    return (with_moves if len(with_moves) <= len(without_moves) else without_moves), len(matched)
+
+# Extraer los campos de una canción que devuelven las herramientas
+def format_track(track):
+    return TrackRecord.from_api(track).as_dict()
+
+# Índice local de la biblioteca (canciones guardadas y playlists) en SQLite con búsqueda de texto completo
+class LibraryIndex:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self.fts_enabled = False
+    
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._create_schema()
+        return self._conn
+    
+    def _create_schema(self):
+        conn = self._conn
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS tracks (
+                rowid INTEGER PRIMARY KEY,
+                id TEXT UNIQUE NOT NULL,
+                name TEXT, artist TEXT, album TEXT,
+                duration_ms INTEGER, popularity INTEGER, preview_url TEXT
+            );
+            CREATE TABLE IF NOT EXISTS saved_tracks (track_id TEXT PRIMARY KEY, added_at TEXT);
+            CREATE INDEX IF NOT EXISTS saved_tracks_added_at ON saved_tracks(added_at);
+            CREATE TABLE IF NOT EXISTS playlists (
+                id TEXT PRIMARY KEY, name TEXT, owner TEXT, public INTEGER,
+                snapshot_id TEXT, tracks_total INTEGER, url TEXT, synced_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS playlist_items (
+                playlist_id TEXT, position INTEGER, track_id TEXT, added_at TEXT,
+                PRIMARY KEY (playlist_id, position)
+            );
+            CREATE INDEX IF NOT EXISTS playlist_items_track ON playlist_items(track_id);
+        """)
+        
+        # FTS5 puede no estar compilado en algunas versiones de SQLite; en ese caso se usa LIKE
+        try:
+            conn.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+                    name, artist, album, content='tracks', content_rowid='rowid'
+                );
+                CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+                    INSERT INTO tracks_fts(rowid, name, artist, album) VALUES (new.rowid, new.name, new.artist, new.album);
+                END;
+                CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN
+                    INSERT INTO tracks_fts(tracks_fts, rowid, name, artist, album) VALUES ('delete', old.rowid, old.name, old.artist, old.album);
+                END;
+                CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE ON tracks BEGIN
+                    INSERT INTO tracks_fts(tracks_fts, rowid, name, artist, album) VALUES ('delete', old.rowid, old.name, old.artist, old.album);
+                    INSERT INTO tracks_fts(rowid, name, artist, album) VALUES (new.rowid, new.name, new.artist, new.album);
+                END;
+            """)
+            self.fts_enabled = True
+        except sqlite3.OperationalError as e:
+            log(f"FTS5 no disponible, la búsqueda local usará LIKE: {str(e)}", level=logging.WARNING)
+            self.fts_enabled = False
+        conn.commit()
+    
+    def get_meta(self, key):
+        with self._lock:
+            row = self._connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+    
+    def set_meta(self, key, value):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (key, str(value)))
+            conn.commit()
+    
+    # Vaciar el índice (por ejemplo, si cambia el usuario autenticado)
+    def reset(self, user_id):
+        with self._lock:
+            conn = self._connect()
+            conn.executescript("DELETE FROM playlist_items; DELETE FROM playlists; DELETE FROM saved_tracks; DELETE FROM tracks;")
+            conn.execute("DELETE FROM meta")
+            conn.execute("INSERT INTO meta(key, value) VALUES ('user_id', ?)", (user_id,))
+            conn.commit()
+    
+    def _upsert_tracks(self, conn, tracks):
+        conn.executemany("""
+            INSERT INTO tracks(id, name, artist, album, duration_ms, popularity, preview_url)
+            VALUES (:id, :name, :artist, :album, :duration_ms, :popularity, :preview_url)
+            ON CONFLICT(id) DO UPDATE SET
+                name = excluded.name, artist = excluded.artist, album = excluded.album,
+                duration_ms = excluded.duration_ms, popularity = excluded.popularity, preview_url = excluded.preview_url
+            WHERE name IS NOT excluded.name OR artist IS NOT excluded.artist OR album IS NOT excluded.album
+                OR popularity IS NOT excluded.popularity
+        """, [format_track(track) for track in tracks])
+    
+    def playlist_snapshots(self):
+        with self._lock:
+            return dict(self._connect().execute("SELECT id, snapshot_id FROM playlists").fetchall())
+    
+    def save_playlists(self, playlists):
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("""
+                INSERT INTO playlists(id, name, owner, public, tracks_total, url)
+                VALUES (:id, :name, :owner, :public, :tracks_total, :url)
+                ON CONFLICT(id) DO UPDATE SET
+                    name = excluded.name, owner = excluded.owner, public = excluded.public,
+                    tracks_total = excluded.tracks_total, url = excluded.url
+            """, [format_playlist(playlist) for playlist in playlists])
+            conn.commit()
+    
+    def replace_playlist_items(self, playlist_id, snapshot_id, items):
+        tracks = [item["track"] for item in items if item.get("track") and item["track"].get("id")]
+        with self._lock:
+            conn = self._connect()
+            self._upsert_tracks(conn, tracks)
+            conn.execute("DELETE FROM playlist_items WHERE playlist_id = ?", (playlist_id,))
+            conn.executemany(
+                "INSERT INTO playlist_items(playlist_id, position, track_id, added_at) VALUES (?, ?, ?, ?)",
+                [(playlist_id, position, item["track"]["id"], item.get("added_at"))
+                 for position, item in enumerate(items) if item.get("track") and item["track"].get("id")]
+            )
+            conn.execute("UPDATE playlists SET snapshot_id = ?, synced_at = ? WHERE id = ?", (snapshot_id, time.time(), playlist_id))
+            conn.commit()
+    
+    def remove_playlists(self, playlist_ids):
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("DELETE FROM playlist_items WHERE playlist_id = ?", [(playlist_id,) for playlist_id in playlist_ids])
+            conn.executemany("DELETE FROM playlists WHERE id = ?", [(playlist_id,) for playlist_id in playlist_ids])
+            conn.commit()
+    
+    def has_saved_track(self, track_id, added_at):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT 1 FROM saved_tracks WHERE track_id = ? AND added_at = ?", (track_id, added_at)
+            ).fetchone()
+            return row is not None
+    
+    def add_saved_tracks(self, items, replace=False):
+        with self._lock:
+            conn = self._connect()
+            if replace:
+                conn.execute("DELETE FROM saved_tracks")
+            self._upsert_tracks(conn, [item["track"] for item in items])
+            conn.executemany(
+                "INSERT OR REPLACE INTO saved_tracks(track_id, added_at) VALUES (?, ?)",
+                [(item["track"]["id"], item.get("added_at")) for item in items]
+            )
+            conn.commit()
+    
+    def saved_count(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM saved_tracks").fetchone()[0]
+    
+    # Convertir el texto libre en una consulta FTS5 segura (prefijos de cada palabra, todas obligatorias)
+    @staticmethod
+    def _fts_query(text):
+        terms = [term.replace('"', '""') for term in text.split()]
+        return " ".join(f'"{term}"*' for term in terms)
+    
+    def search(self, query, limit=20, source=None):
+        filters = []
+        if source == "saved":
+            filters.append("t.id IN (SELECT track_id FROM saved_tracks)")
+        elif source == "playlists":
+            filters.append("t.id IN (SELECT track_id FROM playlist_items)")
+        
+        with self._lock:
+            conn = self._connect()
+            if self.fts_enabled and query.strip():
+                sql = f"""
+                    SELECT t.id, t.name, t.artist, t.album, t.duration_ms, t.popularity, t.preview_url
+                    FROM tracks_fts JOIN tracks t ON t.rowid = tracks_fts.rowid
+                    WHERE tracks_fts MATCH ? {''.join(' AND ' + f for f in filters)}
+                    ORDER BY bm25(tracks_fts), t.popularity DESC LIMIT ?
+                """
+                rows = conn.execute(sql, (self._fts_query(query), limit)).fetchall()
+            else:
+                like_filters = []
+                params = []
+                for term in query.split():
+                    like_filters.append("(t.name LIKE ? OR t.artist LIKE ? OR t.album LIKE ?)")
+                    params.extend([f"%{term}%"] * 3)
+                where = " AND ".join(like_filters + filters) or "1"
+                sql = f"""
+                    SELECT t.id, t.name, t.artist, t.album, t.duration_ms, t.popularity, t.preview_url
+                    FROM tracks t WHERE {where} ORDER BY t.popularity DESC LIMIT ?
+                """
+                rows = conn.execute(sql, (*params, limit)).fetchall()
+            
+            results = []
+            for row in rows:
+                track_id = row[0]
+                saved = conn.execute("SELECT 1 FROM saved_tracks WHERE track_id = ?", (track_id,)).fetchone() is not None
+                playlist_names = [name for (name,) in conn.execute(
+                    "SELECT DISTINCT p.name FROM playlist_items i JOIN playlists p ON p.id = i.playlist_id WHERE i.track_id = ?",
+                    (track_id,)
+                )]
+                results.append({
+                    "id": track_id,
+                    "name": row[1],
+                    "artist": row[2],
+                    "album": row[3],
+                    "duration_ms": row[4],
+                    "popularity": row[5],
+                    "preview_url": row[6],
+                    "saved": saved,
+                    "playlists": playlist_names
+                })
+            return results
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    def status(self):
+        with self._lock:
+            conn = self._connect()
+            meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+            return {
+                "path": self.path,
+                "fts_enabled": self.fts_enabled,
+                "user_id": meta.get("user_id"),
+                "tracks": conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0],
+                "saved_tracks": conn.execute("SELECT COUNT(*) FROM saved_tracks").fetchone()[0],
+                "playlists": conn.execute("SELECT COUNT(*) FROM playlists").fetchone()[0],
+                "playlist_items": conn.execute("SELECT COUNT(*) FROM playlist_items").fetchone()[0],
+                "last_sync": float(meta["last_sync"]) if "last_sync" in meta else None,
+                "last_sync_seconds": float(meta["last_sync_seconds"]) if "last_sync_seconds" in meta else None
+            }
+
+# Sincronizar canciones guardadas: se pagina desde las más recientes hasta llegar a una ya conocida
+async def sync_saved_tracks(full=False):
+    library = current_session().library
+    new_items = []
+    offset = 0
+    total = 0
+    while True:
+        page = await spotify_api.current_user_saved_tracks(limit=SAVED_TRACKS_PAGE_SIZE, offset=offset)
+        total = page["total"]
+        reached_known = False
+        for item in page["items"]:
+            if not item.get("track") or not item["track"].get("id"):
+                continue
+            if not full and await asyncio.to_thread(library.has_saved_track, item["track"]["id"], item.get("added_at")):
+                reached_known = True
+                break
+            new_items.append(item)
+        
+        offset += len(page["items"])
+        if reached_known or not page["items"] or offset >= total:
+            break
+    
+    await asyncio.to_thread(library.add_saved_tracks, new_items, full)
+    
+    # Si el total no cuadra es que se quitaron canciones: hace falta una pasada completa
+    if not full and await asyncio.to_thread(library.saved_count) != total:
+        log("Las canciones guardadas no coinciden con el índice, sincronizando completas", level=logging.WARNING)
+        return await sync_saved_tracks(full=True)
+    return len(new_items)
+
+# Sincronizar playlists: solo se vuelven a leer las que cambiaron de snapshot_id
+async def sync_playlists(full=False):
+    library = current_session().library
+    playlists = await fetch_user_playlists()
+    known_snapshots = await asyncio.to_thread(library.playlist_snapshots)
+    await asyncio.to_thread(library.save_playlists, playlists)
+    
+    changed = [playlist for playlist in playlists if full or known_snapshots.get(playlist["id"]) != playlist.get("snapshot_id")]
+    removed = set(known_snapshots) - {playlist["id"] for playlist in playlists}
+    
+    async def sync_one(playlist):
+        items = await fetch_playlist_items(playlist["id"])
+        await asyncio.to_thread(library.replace_playlist_items, playlist["id"], playlist.get("snapshot_id"), items)
+    
+    await gather_with_limit(sync_one, changed)
+    if removed:
+        await asyncio.to_thread(library.remove_playlists, removed)
+    
+    return {"updated": len(changed), "unchanged": len(playlists) - len(changed), "removed": len(removed)}
+
+# Exportaciones en streaming: cada conjunto de datos es un generador asíncrono de páginas (filas, cursor).
+# Cada página se escribe al final del fichero antes de guardar su cursor, y solo se piden por adelantado
+# EXPORT_PREFETCH_PAGES páginas, así la memoria no depende del tamaño del historial
+def iso_timestamp(seconds=None):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+# Posición en un listado ordenado por fecha: la fecha y los IDs que la comparten
+# (las canciones de un álbum guardado a la vez tienen el mismo added_at)
+def extend_mark(mark, timestamp, item_id):
+    if mark is None or mark["at"] != timestamp:
+        return {"at": timestamp, "ids": [item_id]}
+    return {"at": timestamp, "ids": mark["ids"] + [item_id]}
+
+def before_mark(mark, timestamp, item_id):
+    return mark is not None and (timestamp < mark["at"] or (timestamp == mark["at"] and item_id in mark["ids"]))
+
+def after_mark(mark, timestamp, item_id):
+    return mark is not None and (timestamp > mark["at"] or (timestamp == mark["at"] and item_id in mark["ids"]))
+
+# Canciones guardadas, de la más reciente a la más antigua, hasta la marca de la exportación anterior.
+# El cursor guarda esa marca y, si una pasada quedó a medias, su offset y la última canción escrita
+async def export_saved_tracks(cursor):
+    watermark = cursor.get("watermark")
+    run = cursor.get("run") or {"offset": 0, "watermark": None, "last": None}
+    offset, run_watermark, last = run["offset"], run["watermark"], run["last"]
+    while True:
+        page = await spotify_api.current_user_saved_tracks(limit=SAVED_TRACKS_PAGE_SIZE, offset=offset)
+        rows = []
+        finished = not page["items"]
+        for item in page["items"]:
+            track = item.get("track")
+            if not track or not track.get("id"):
+                continue
+            added_at = item.get("added_at")
+            if before_mark(watermark, added_at, track["id"]):
+                finished = True
+                break
+            # Al reanudar, lo guardado entretanto desplaza la lista: se saltan las canciones ya escritas
+            if after_mark(last, added_at, track["id"]):
+                continue
+            rows.append({"added_at": added_at, **TrackRecord.from_api(track).as_dict()})
+            if run_watermark is None or run_watermark["at"] == added_at:
+                run_watermark = extend_mark(run_watermark, added_at, track["id"])
+            last = extend_mark(last, added_at, track["id"])
+        
+        offset += len(page["items"])
+        if finished or offset >= page["total"]:
+            yield rows, {"watermark": run_watermark or watermark, "run": None}
+            return
+        yield rows, {"watermark": watermark, "run": {"offset": offset, "watermark": run_watermark, "last": last}}
+
+# Reproducciones posteriores al cursor "after" (milisegundos), en orden cronológico
+async def export_recently_played(cursor):
+    after = cursor.get("after")
+    while True:
+        page = await spotify_api.current_user_recently_played(limit=RECENTLY_PLAYED_PAGE_SIZE, after=after)
+        if not page["items"]:
+            return
+        # La API devuelve primero la más reciente
+        rows = [
+            {
+                "played_at": item["played_at"],
+                "context": (item.get("context") or {}).get("uri"),
+                **TrackRecord.from_api(item["track"]).as_dict()
+            }
+            for item in reversed(page["items"]) if item.get("track") and item["track"].get("id")
+        ]
+        after = page["cursors"]["after"]
+        yield rows, {"after": after}
+        if len(page["items"]) < RECENTLY_PLAYED_PAGE_SIZE:
+            return
+
+# Instantánea del ranking de canciones o artistas; como mucho una cada EXPORT_TOP_INTERVAL
+async def export_top_items(item_type, time_range, cursor):
+    run = cursor.get("run")
+    if run is None:
+        if cursor.get("last_snapshot") and time.time() - cursor["last_snapshot"] < EXPORT_TOP_INTERVAL:
+            return
+        run = {"offset": 0, "snapshot": time.time()}
+    
+    fetch_page = spotify_api.current_user_top_tracks if item_type == "tracks" else spotify_api.current_user_top_artists
+    record_class = TrackRecord if item_type == "tracks" else ArtistRecord
+    snapshot_at = iso_timestamp(run["snapshot"])
+    offset = run["offset"]
+    while True:
+        page = await fetch_page(limit=TOP_ITEMS_PAGE_SIZE, offset=offset, time_range=time_range)
+        rows = [
+            {"snapshot_at": snapshot_at, "time_range": time_range, "rank": offset + index + 1, **record_class.from_api(item).as_dict()}
+            for index, item in enumerate(page["items"])
+        ]
+        offset += len(page["items"])
+        if not page["items"] or offset >= page["total"]:
+            yield rows, {"last_snapshot": run["snapshot"], "run": None}
+            return
+        yield rows, {"last_snapshot": cursor.get("last_snapshot"), "run": {"offset": offset, "snapshot": run["snapshot"]}}
+
+# Ficheros con una exportación en curso en este proceso
+active_exports = set()
+
+# Ruta del fichero de exportación, siempre dentro de EXPORT_DIR
+def export_path(name):
+    base = os.path.realpath(EXPORT_DIR)
+    path = os.path.realpath(os.path.join(base, os.path.expanduser(name)))
+    if path == base or os.path.commonpath([base, path]) != base:
+        raise ValueError(f"La ruta de exportación debe estar dentro de {base}")
+    return path
+
+# El estado de cada exportación se guarda junto al fichero: qué contiene, cuánto se ha escrito y su cursor
+def export_state_path(path):
+    return path + ".state.json"
+
+def load_export_state(path, dataset, format, time_range, user_id):
+    try:
+        with open(export_state_path(path), encoding="utf-8") as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            raise ValueError(f"{path} ya existe y no es una exportación reanudable")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return {"dataset": dataset, "format": format, "time_range": time_range, "user_id": user_id, "rows": 0, "bytes": 0, "cursor": {}}
+    
+    if (state["dataset"], state["format"], state["time_range"], state["user_id"]) != (dataset, format, time_range, user_id):
+        raise ValueError(f"{path} contiene otra exportación ({state['dataset']}, {state['format']}, usuario {state['user_id']})")
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if size < state["bytes"]:
+        raise ValueError(f"{path} no coincide con su estado: bórralo junto a {export_state_path(path)} para empezar de nuevo")
+    # Una página escrita cuyo cursor no llegó a guardarse se descarta y se vuelve a pedir
+    if size > state["bytes"]:
+        os.truncate(path, state["bytes"])
+    return state
+
+def save_export_state(path, state):
+    temporary = export_state_path(path) + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as file:
+        json.dump(state, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, export_state_path(path))
+
+# Añadir una página al fichero: NDJSON (una fila por línea) o columnar (una línea por página con
+# {"fields", "columns"}, cada columna una lista de valores)
+def write_export_page(path, state, rows, cursor):
+    if rows:
+        if state["format"] == "ndjson":
+            data = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+        else:
+            fields = list(rows[0])
+            data = json.dumps({"fields": fields, "columns": [[row.get(field) for row in rows] for field in fields]}, ensure_ascii=False) + "\n"
+        with open(path, "a", encoding="utf-8") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        state["rows"] += len(rows)
+        state["bytes"] = os.path.getsize(path)
+    state["cursor"] = cursor
+    save_export_state(path, state)
+
+# Escribir las páginas de un generador mientras se piden las siguientes.
+# Devuelve las filas escritas y si el generador llegó al final (False si se detuvo por max_items)
+async def run_export(pages, path, state, max_items=None):
+    pending = asyncio.Queue(EXPORT_PREFETCH_PAGES)
+    
+    async def produce():
+        try:
+            async for page in pages:
+                await pending.put(page)
+            await pending.put(None)
+        except Exception as e:
+            await pending.put(e)
+        finally:
+            await pages.aclose()
+    
+    producer = asyncio.create_task(produce())
+    written = 0
+    try:
+        while True:
+            page = await pending.get()
+            if page is None:
+                return written, True
+            if isinstance(page, Exception):
+                raise page
+            rows, cursor = page
+            await asyncio.to_thread(write_export_page, path, state, rows, cursor)
+            written += len(rows)
+            if max_items is not None and written >= max_items:
+                return written, False
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+
+# Sondeo compartido del estado de reproducción de una cuenta
+# Todas las consultas se sirven de la última instantánea; el intervalo se adapta al estado:
+# rápido tras play/pause y al acabar la canción, lento en pausa o sin reproducción
+class NowPlayingPoller:
+    def __init__(self, key):
+        self.key = key
+        self.snapshot = None
+        self.fetched_at = None  # time.monotonic() de la última instantánea
+        self.version = 0  # Aumenta con cada cambio de canción
+        self.polls = 0
+        self.errors = 0
+        self.last_error = None
+        self.interval = None
+        self._task = None
+        self._loop = None
+        self._boost_until = 0.0
+        self._last_read = 0.0
+        self._waiters = 0
+        self._wakeup = None
+        self._fetched = None
+        self._changed = None
+    
+    def _ensure_running(self):
+        # La tarea hereda el contexto de la herramienta que la arranca, y con él la sesión
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._fetched = asyncio.Event()
+            self._changed = asyncio.Event()
+            self._task = loop.create_task(self._run())
+    
+    async def _run(self):
+        # La tarea sobrevive a la llamada que la arrancó: sus logs no llevan el identificador de esa llamada
+        request_context.set(None)
+        log(f"Sondeo de reproducción iniciado para la sesión {self.key}", level=logging.DEBUG)
+        try:
+            while self._waiters or time.monotonic() - self._last_read < NOW_PLAYING_IDLE_STOP:
+                await self._poll()
+                self.interval = self._next_interval()
+                self._wakeup.clear()
+                await wait_event(self._wakeup, self.interval)
+        finally:
+            self.interval = None
+            # Sin sondeo la instantánea envejece: la próxima consulta espera a una nueva
+            self._fetched.clear()
+            log(f"Sondeo de reproducción detenido para la sesión {self.key}", level=logging.DEBUG)
+    
+    async def _poll(self):
+        try:
+            api = await get_api_client()
+            if not api:
+                raise SpotifyAPIError(401, "No autenticado")
+            snapshot = await api.current_playback(additional_types="track,episode")
+        except Exception as e:
+            self.errors += 1
+            self.last_error = str(e)
+            log(f"Error al consultar la reproducción: {str(e)}", level=logging.ERROR)
+        else:
+            previous = self.snapshot
+            self.snapshot = snapshot
+            self.fetched_at = time.monotonic()
+            self.last_error = None
+            if self.polls and playing_item_id(previous) != playing_item_id(snapshot):
+                self.version += 1
+                # Despertar a todos los que esperan y preparar el evento del siguiente cambio
+                changed, self._changed = self._changed, asyncio.Event()
+                changed.set()
+        finally:
+            self.polls += 1
+            self._fetched.set()
+    
+    def _next_interval(self):
+        now = time.monotonic()
+        if now < self._boost_until:
+            return NOW_PLAYING_FAST_INTERVAL
+        if self.last_error:
+            return NOW_PLAYING_MAX_INTERVAL
+        
+        snapshot = self.snapshot
+        if not snapshot or not snapshot.get("is_playing") or not snapshot.get("item"):
+            # Con alguien esperando un cambio no se deja pasar tanto tiempo
+            return NOW_PLAYING_MAX_INTERVAL if self._waiters else NOW_PLAYING_IDLE_INTERVAL
+        
+        # Volver a consultar justo después de que termine la canción
+        remaining = (snapshot["item"]["duration_ms"] - (snapshot.get("progress_ms") or 0)) / 1000 - (now - self.fetched_at)
+        return min(max(remaining + 0.5, NOW_PLAYING_FAST_INTERVAL), NOW_PLAYING_MAX_INTERVAL)
+    
+    # Sondear ya y seguir en modo rápido unos segundos (tras play/pause el estado cambia enseguida)
+    # La instantánea anterior queda obsoleta: la siguiente consulta espera al nuevo sondeo
+    def boost(self):
+        self._boost_until = time.monotonic() + NOW_PLAYING_BOOST_WINDOW
+        if self._task is not None and not self._task.done() and self._loop is asyncio.get_running_loop():
+            self._fetched.clear()
+            self._wakeup.set()
+    
+    async def latest(self):
+        self._last_read = time.monotonic()
+        self._ensure_running()
+        await self._fetched.wait()
+        return self.snapshot
+    
+    # Esperar al siguiente cambio de canción; devuelve False si se agota el tiempo
+    async def wait_for_change(self, timeout):
+        version = self.version
+        self._waiters += 1
+        try:
+            self._ensure_running()
+            await wait_event(self._changed, timeout)
+        finally:
+            self._waiters -= 1
+            self._last_read = time.monotonic()
+        return self.version != version
+    
+    # Estado en formato de herramienta, con el progreso extrapolado desde la instantánea
+    def describe(self):
+        snapshot = self.snapshot
+        age = time.monotonic() - self.fetched_at if self.fetched_at is not None else None
+        if not snapshot:
+            return {"is_playing": False, "track": None, "snapshot_age_ms": int(age * 1000) if age is not None else None}
+        
+        item = snapshot.get("item")
+        progress = snapshot.get("progress_ms") or 0
+        if snapshot.get("is_playing"):
+            progress += int(age * 1000)
+        if item:
+            progress = min(progress, item["duration_ms"])
+        
+        if item and item.get("type", "track") == "track":
+            track = TrackRecord.from_api(item).as_dict()
+        elif item:
+            track = {"id": item["id"], "name": item["name"], "type": item.get("type"), "duration_ms": item["duration_ms"]}
+        else:
+            track = None
+        
+        device = snapshot.get("device") or {}
+        return {
+            "is_playing": snapshot.get("is_playing", False),
+            "track": track,
+            "progress_ms": progress,
+            "device": {key: device.get(key) for key in ("name", "type", "volume_percent")} if device else None,
+            "shuffle": snapshot.get("shuffle_state"),
+            "repeat": snapshot.get("repeat_state"),
+            "snapshot_age_ms": int(age * 1000)
+        }
+    
+    def stop(self):
+        task, loop = self._task, self._loop
+        if task is not None and not task.done() and not loop.is_closed():
+            loop.call_soon_threadsafe(task.cancel)
+    
+    def stats(self):
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "interval_seconds": self.interval,
+            "polls": self.polls,
+            "errors": self.errors,
+            "track_changes": self.version,
+            "waiters": self._waiters,
+            "snapshot_age_seconds": round(time.monotonic() - self.fetched_at, 1) if self.fetched_at is not None else None
+        }
+
+# Esperar un evento como mucho timeout segundos
+# (asyncio.wait no se traga la cancelación si el evento y la cancelación coinciden, a diferencia de wait_for)
+async def wait_event(event, timeout):
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        await asyncio.wait({waiter}, timeout=timeout)
+    finally:
+        waiter.cancel()
+    return event.is_set()
+
+def playing_item_id(snapshot):
+    item = snapshot.get("item") if snapshot else None
+    return item["id"] if item else None
+
+# Crear servidor MCP
+mcp = FastMCP("Spotify MCP")
+
+# Clave de sesión de la petición MCP actual
+# Sin petición HTTP (stdio o llamadas internas) se mantiene la del contexto, por defecto DEFAULT_SESSION
+# Por red la cuenta solo la elige un secreto de SPOTIFY_MCP_ACCOUNTS; sin cuentas configuradas todos usan DEFAULT_SESSION
+def resolve_session_key():
+    try:
+        # RequestContext.request solo existe desde mcp 1.9.2
+        request = getattr(mcp.get_context().request_context, "request", None)
+    except (LookupError, ValueError):
+        return session_key.get()
+    
+    headers = getattr(request, "headers", None)
+    if headers is None or not ACCOUNT_SECRETS:
+        return session_key.get()
+    
+    scheme, _, secret = headers.get("authorization", "").partition(" ")
+    user_id = ACCOUNT_SECRETS.get(hashlib.sha256(secret.strip().encode()).hexdigest()) if scheme.lower() == "bearer" else None
+    if user_id is None:
+        raise PermissionError("Falta el secreto de la cuenta o no es válido (Authorization: Bearer)")
+    return user_id
+
+# Registrar una herramienta MCP midiendo su latencia, errores y tamaño de respuesta
+def tool():
+    def decorator(func):
+        name = func.__name__
+        
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            error = True
+            payload_bytes = None
+            key = resolve_session_key()
+            reset_token = session_key.set(key)
+            # Identificador de correlación: todas las líneas de log de esta llamada lo llevan
+            context_token = request_context.set((f"{random.getrandbits(48):012x}", name, key))
+            try:
+                result = await func(*args, **kwargs)
+                error = is_error_result(result)
+                if metrics.should_sample_payload(name):
+                    payload_bytes = len(json.dumps(result, default=str))
+                return result
+            finally:
+                elapsed = time.perf_counter() - started
+                log(f"{name} completada en {elapsed * 1000:.1f} ms", level=logging.DEBUG, error=error)
+                request_context.reset(context_token)
+                session_key.reset(reset_token)
+                metrics.observe_tool(name, elapsed, error, payload_bytes)
+        
+        return mcp.tool()(wrapper)
+    return decorator
+
+@tool()
+async def login() -> Dict[str, Any]:
+    """
+    Iniciar sesión en Spotify o verificar estado de autenticación.
+    Si ya estás autenticado, simplemente lo confirma.
+    Si no, inicia el proceso de autenticación automáticamente.
+    """
+    # Intentar usar cliente existente o inicializar desde token; si lo hay, confirmar autenticación
+    if await get_api_client():
+        return {
+            "status": "authenticated",
+            "message": "Ya estás autenticado con Spotify."
+        }
+    
+    # Si hay una autenticación en curso, informar al usuario
+    session = current_session()
+    if session.auth_in_progress:
+        if session.auth_url:
+            return {
+                "status": "auth_in_progress",
+                "message": "Proceso de autenticación en curso. Abre este enlace en tu navegador:",
+                "auth_url": session.auth_url
+            }
+        else:
+            return {
+                "status": "auth_starting",
+                "message": "Iniciando proceso de autenticación..."
+            }
+    
+    # Iniciar nuevo proceso de autenticación (sin token existente)
+    # Solo se olvida el token en memoria: el guardado se conserva si el fallo de verificación era transitorio
+    session.token_info = None
+    session.spotify = None
+    return await asyncio.to_thread(authenticate_user, session)
+
+@tool()
+async def search_track(query: str, limit: int = 10, market: Optional[str] = None, use_cache: bool = True,
+                       fields: Optional[List[str]] = None, compact: bool = False) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Buscar canciones en Spotify.
+    
+    Args:
+        query: Texto de búsqueda
+        limit: Número máximo de resultados
+        market: Código de país ISO 3166-1 (opcional)
+        use_cache: Reutilizar resultados recientes de la misma búsqueda
+        fields: Campos a devolver (id, name, artist, album, duration_ms, popularity, preview_url)
+        compact: Devolver {"fields": [...], "rows": [[...], ...]} en lugar de una lista de objetos
+    """
+    try:
+        fields = TrackRecord.select_fields(fields)
+    except ValueError as e:
+        return [{"error": str(e)}]
+    
+    # Verificar autenticación
+    api = await get_api_client()
+    if not api:
+        return [{"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}]
+    
+    # Realizar búsqueda
+    try:
+        results = await cached_search(query, "track", limit, market=market, use_cache=use_cache)
+        tracks = results["tracks"]["items"]
+        
+        return project_records([TrackRecord.from_api(track) for track in tracks], fields, compact)
+    except Exception as e:
+        log(f"Error al buscar canciones: {str(e)}", level=logging.ERROR)
         return [{"error": f"Error al buscar canciones: {str(e)}"}]
 
-@mcp.tool()
-def search_album(query: str, limit: int = 10) -> List[Dict[str, Any]]:
-    """Buscar álbumes en Spotify."""
-    global spotify
+@tool()
+async def search_album(query: str, limit: int = 10, market: Optional[str] = None, use_cache: bool = True,
+                       fields: Optional[List[str]] = None, compact: bool = False) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Buscar álbumes en Spotify.
+    
+    Args:
+        query: Texto de búsqueda
+        limit: Número máximo de resultados
+        market: Código de país ISO 3166-1 (opcional)
+        use_cache: Reutilizar resultados recientes de la misma búsqueda
+        fields: Campos a devolver (id, name, artist, release_date, total_tracks, images)
+        compact: Devolver {"fields": [...], "rows": [[...], ...]} en lugar de una lista de objetos
+    """
+    try:
+        fields = AlbumRecord.select_fields(fields)
+    except ValueError as e:
+        return [{"error": str(e)}]
+    
+    # Verificar autenticación
+    api = await get_api_client()
+    if not api:
+        return [{"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}]
+    
+    # Realizar búsqueda
+    try:
+        results = await cached_search(query, "album", limit, market=market, use_cache=use_cache)
+        albums = results["albums"]["items"]
+        
+        return project_records([AlbumRecord.from_api(album) for album in albums], fields, compact)
+    except Exception as e:
+        log(f"Error al buscar álbumes: {str(e)}", level=logging.ERROR)
+        return [{"error": f"Error al buscar álbumes: {str(e)}"}]
+
+@tool()
+async def get_tracks(track_ids: List[str], market: Optional[str] = None, fields: Optional[List[str]] = None,
+                     compact: bool = False) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Obtener los datos de varias canciones por su ID.
+    
+    Args:
+        track_ids: IDs de canciones, sin límite de longitud (se consultan en lotes de 50 en paralelo)
+        market: Código de país ISO 3166-1 (opcional)
+        fields: Campos a devolver (id, name, artist, album, duration_ms, popularity, preview_url)
+        compact: Devolver {"fields": [...], "rows": [[...], ...]} en lugar de una lista de objetos
+    
+    Returns:
+        Canciones en el orden de entrada, sin duplicados; los IDs inexistentes se omiten
+    """
+    try:
+        fields = TrackRecord.select_fields(fields)
+    except ValueError as e:
+        return [{"error": str(e)}]
+    
+    # Verificar autenticación
+    api = await get_api_client()
+    if not api:
+        return [{"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}]
+    
+    try:
+        tracks = await fetch_by_ids(lambda batch: api.tracks(batch, market=market), track_ids, TRACKS_BATCH_SIZE)
+        return project_records([TrackRecord.from_api(track) for track in tracks], fields, compact)
+    except Exception as e:
+        log(f"Error al obtener canciones: {str(e)}", level=logging.ERROR)
+        return [{"error": f"Error al obtener canciones: {str(e)}"}]
+
+@tool()
+async def get_albums(album_ids: List[str], market: Optional[str] = None, fields: Optional[List[str]] = None,
+                     compact: bool = False) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Obtener los datos de varios álbumes por su ID.
+    
+    Args:
+        album_ids: IDs de álbumes, sin límite de longitud (se consultan en lotes de 20 en paralelo)
+        market: Código de país ISO 3166-1 (opcional)
+        fields: Campos a devolver (id, name, artist, release_date, total_tracks, images)
+        compact: Devolver {"fields": [...], "rows": [[...], ...]} en lugar de una lista de objetos
+    
+    Returns:
+        Álbumes en el orden de entrada, sin duplicados; los IDs inexistentes se omiten
+    """
+    try:
+        fields = AlbumRecord.select_fields(fields)
+    except ValueError as e:
+        return [{"error": str(e)}]
+    
+    # Verificar autenticación
+    api = await get_api_client()
+    if not api:
+        return [{"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}]
+    
+    try:
+        albums = await fetch_by_ids(lambda batch: api.albums(batch, market=market), album_ids, ALBUMS_BATCH_SIZE)
+        return project_records([AlbumRecord.from_api(album) for album in albums], fields, compact)
+    except Exception as e:
+        log(f"Error al obtener álbumes: {str(e)}", level=logging.ERROR)
+        return [{"error": f"Error al obtener álbumes: {str(e)}"}]
+
+@tool()
+async def get_artists(artist_ids: List[str], fields: Optional[List[str]] = None,
+                      compact: bool = False) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Obtener los datos de varios artistas por su ID.
+    
+    Args:
+        artist_ids: IDs de artistas, sin límite de longitud (se consultan en lotes de 50 en paralelo)
+        fields: Campos a devolver (id, name, genres, popularity, followers, images)
+        compact: Devolver {"fields": [...], "rows": [[...], ...]} en lugar de una lista de objetos
+    
+    Returns:
+        Artistas en el orden de entrada, sin duplicados; los IDs inexistentes se omiten
+    """
+    try:
+        fields = ArtistRecord.select_fields(fields)
+    except ValueError as e:
+        return [{"error": str(e)}]
     
     # Verificar autenticación
-    if not spotify:
-        spotify = initialize_spotify_client()
-        if not spotify:
-            return [{"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}]
+    api = await get_api_client()
+    if not api:
+        return [{"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}]
     
-    # Realizar búsqueda
     try:
-        results = spotify.search(q=query, type="album", limit=limit)
-        albums = results["albums"]["items"]
-        
-        return [{
-            "id": album["id"],
-            "name": album["name"],
-            "artist": album["artists"][0]["name"],
-            "release_date": album["release_date"],
-            "total_tracks": album["total_tracks"],
-            "images": album["images"]
-        } for album in albums]
+        artists = await fetch_by_ids(api.artists, artist_ids, ARTISTS_BATCH_SIZE)
+        return project_records([ArtistRecord.from_api(artist) for artist in artists], fields, compact)
     except Exception as e:
-        log(f"Error al buscar álbumes: {str(e)}")
-        return [{"error": f"Error al buscar álbumes: {str(e)}"}]
+        log(f"Error al obtener artistas: {str(e)}", level=logging.ERROR)
+        return [{"error": f"Error al obtener artistas: {str(e)}"}]
 
-@mcp.tool()
-def play(track_id: str) -> Dict[str, Any]:
+@tool()
+async def play(track_id: str) -> Dict[str, Any]:
     """Reproducir una canción en Spotify."""
-    global spotify
-    
     # Verificar autenticación
-    if not spotify:
-        spotify = initialize_spotify_client()
-        if not spotify:
-            return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
+    api = await get_api_client()
+    if not api:
+        return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
     
     # Iniciar reproducción
     try:
-        spotify.start_playback(uris=[f"spotify:track:{track_id}"])
+        with priority(PRIORITY_INTERACTIVE):
+            await api.start_playback(uris=[f"spotify:track:{track_id}"])
+        current_session().now_playing.boost()
         return {"status": "success", "message": "Reproducción iniciada"}
     except Exception as e:
-        log(f"Error al reproducir: {str(e)}")
+        log(f"Error al reproducir: {str(e)}", level=logging.ERROR)
         return {"status": "error", "message": f"Error al reproducir: {str(e)}"}
 
-@mcp.tool()
-def pause() -> Dict[str, Any]:
+@tool()
+async def pause() -> Dict[str, Any]:
     """Pausar la reproducción actual en Spotify."""
-    global spotify
-    
     # Verificar autenticación
-    if not spotify:
-        spotify = initialize_spotify_client()
-        if not spotify:
-            return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
+    api = await get_api_client()
+    if not api:
+        return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
     
     # Pausar reproducción
     try:
-        spotify.pause_playback()
+        with priority(PRIORITY_INTERACTIVE):
+            await api.pause_playback()
+        current_session().now_playing.boost()
         return {"status": "success", "message": "Reproducción pausada"}
     except Exception as e:
-        log(f"Error al pausar: {str(e)}")
+        log(f"Error al pausar: {str(e)}", level=logging.ERROR)
         return {"status": "error", "message": f"Error al pausar: {str(e)}"}
 
-@mcp.tool()
-def create_playlist(name: str, description: Optional[str] = None) -> Dict[str, Any]:
-    """Crear una nueva playlist en Spotify."""
-    global spotify
+@tool()
+async def now_playing(wait_for_change: bool = False, timeout: float = 60) -> Dict[str, Any]:
+    """
+    Obtener lo que se está reproduciendo en Spotify.
+    
+    Args:
+        wait_for_change: Esperar a que cambie la canción antes de responder (sin sondear desde el cliente)
+        timeout: Segundos máximos de espera con wait_for_change (máximo 300)
+    
+    Returns:
+        Canción, progreso, dispositivo y estado de reproducción; con wait_for_change, "changed" indica
+        si cambió la canción antes de agotarse el tiempo
+    """
+    # Verificar autenticación
+    api = await get_api_client()
+    if not api:
+        return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
     
+    poller = current_session().now_playing
+    snapshot = await poller.latest()
+    if snapshot is None and poller.last_error:
+        return {"error": f"Error al obtener la reproducción: {poller.last_error}"}
+    
+    if not wait_for_change:
+        return poller.describe()
+    
+    changed = await poller.wait_for_change(min(max(timeout, 0), NOW_PLAYING_MAX_WAIT))
+    result = poller.describe()
+    result["changed"] = changed
+    return result
+
+@tool()
+async def create_playlist(name: str, description: Optional[str] = None) -> Dict[str, Any]:
+    """Crear una nueva playlist en Spotify."""
     # Verificar autenticación
-    if not spotify:
-        spotify = initialize_spotify_client()
-        if not spotify:
-            return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
+    api = await get_api_client()
+    if not api:
+        return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
     
     # Crear playlist
     try:
-        user_id = spotify.me()["id"]
-        playlist = spotify.user_playlist_create(
+        user_id = (await get_current_user(api))["id"]
+        playlist = await api.user_playlist_create(
             user=user_id,
             name=name,
             public=False,
@@ -519,156 +3867,912 @@ def create_playlist(name: str, description: Optional[str] = None) -> Dict[str, A
             "url": playlist["external_urls"]["spotify"]
         }
     except Exception as e:
-        log(f"Error al crear playlist: {str(e)}")
+        log(f"Error al crear playlist: {str(e)}", level=logging.ERROR)
         return {"error": f"Error al crear playlist: {str(e)}"}
 
-@mcp.tool()
-def get_audio_features(track_id: str) -> Dict[str, Any]:
-    """Obtener características de audio de una canción en Spotify."""
-    global spotify
+@tool()
+async def build_playlist_from_queries(name: str, queries: List[str], description: Optional[str] = None,
+                                      market: Optional[str] = None, allow_duplicates: bool = False) -> Dict[str, Any]:
+    """
+    Crear una playlist a partir de búsquedas de texto libre en una sola llamada.
+    
+    Las búsquedas se resuelven en paralelo (con concurrencia limitada) y cada una aporta su mejor resultado.
+    Mientras tanto se crea la playlist y las canciones se añaden en bloques de 100, en el orden de las consultas,
+    en cuanto están resueltas.
     
+    Args:
+        name: Nombre de la playlist
+        queries: Búsquedas, una por canción (por ejemplo "Bohemian Rhapsody Queen")
+        description: Descripción de la playlist (opcional)
+        market: Código de país ISO 3166-1 (opcional)
+        allow_duplicates: Permitir que la misma canción aparezca varias veces
+        
+    Returns:
+        Playlist creada, canciones añadidas y consultas que no se pudieron resolver
+    """
     # Verificar autenticación
-    if not spotify:
-        spotify = initialize_spotify_client()
-        if not spotify:
-            return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
+    api = await get_api_client()
+    if not api:
+        return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
+    
+    if not queries:
+        return {"error": "No se proporcionaron búsquedas"}
+    
+    started = time.perf_counter()
+    # Un futuro por consulta: el que añade canciones los consume en orden según se resuelven
+    candidates = [asyncio.get_running_loop().create_future() for _ in queries]
+    
+    async def resolve(index):
+        query = queries[index].strip()
+        if not query:
+            candidates[index].set_result(ValueError("consulta vacía"))
+            return
+        try:
+            results = await cached_search(query, "track", BUILD_PLAYLIST_CANDIDATES, market=market)
+            candidates[index].set_result([track["id"] for track in results["tracks"]["items"] if track and track.get("id")])
+        except Exception as e:
+            candidates[index].set_result(e)
+    
+    async def create():
+        user_id = (await get_current_user(api))["id"]
+        return await api.user_playlist_create(user=user_id, name=name, public=False, description=description)
+    
+    with priority(PRIORITY_BULK):
+        resolver = asyncio.ensure_future(gather_with_limit(resolve, range(len(queries)), BUILD_PLAYLIST_CONCURRENCY))
+        creator = asyncio.ensure_future(create())
+    
+    seen = set()
+    pending = []
+    track_ids = []
+    unresolved = []
+    duplicates = 0
+    added = 0
+    snapshot_id = None
+    playlist = None
+    next_index = 0
+    
+    async def flush():
+        nonlocal added, snapshot_id
+        with priority(PRIORITY_BULK):
+            result = await api.playlist_add_items(playlist["id"], [f"spotify:track:{track_id}" for track_id in pending])
+        snapshot_id = result["snapshot_id"]
+        added += len(pending)
+        pending.clear()
     
-    # Obtener características
     try:
-        features = spotify.audio_features(track_id)[0]
+        try:
+            playlist = await creator
+        except Exception as e:
+            log(f"Error al crear playlist: {str(e)}", level=logging.ERROR)
+            return {"error": f"Error al crear playlist: {str(e)}"}
+        
+        for index, future in enumerate(candidates):
+            result = await future
+            next_index = index + 1
+            if isinstance(result, Exception):
+                unresolved.append({"index": index, "query": queries[index], "reason": str(result)})
+                continue
+            if not result:
+                unresolved.append({"index": index, "query": queries[index], "reason": "sin resultados"})
+                continue
+            
+            # El mejor resultado que no esté ya en la playlist (o el primero si se permiten repetidos)
+            choice = result[0] if allow_duplicates else next((track_id for track_id in result if track_id not in seen), None)
+            if choice is None:
+                duplicates += 1
+                continue
+            
+            seen.add(choice)
+            track_ids.append(choice)
+            pending.append(choice)
+            if len(pending) == PLAYLIST_ADD_BATCH_SIZE:
+                await flush()
         
+        if pending:
+            await flush()
+    except Exception as e:
+        log(f"Error al añadir canciones a la playlist {playlist['id']}: {str(e)}", level=logging.ERROR)
         return {
-            "danceability": features["danceability"],
-            "energy": features["energy"],
-            "key": features["key"],
-            "loudness": features["loudness"],
-            "mode": features["mode"],
-            "speechiness": features["speechiness"],
-            "acousticness": features["acousticness"],
-            "instrumentalness": features["instrumentalness"],
-            "liveness": features["liveness"],
-            "valence": features["valence"],
-            "tempo": features["tempo"],
-            "duration_ms": features["duration_ms"],
-            "time_signature": features["time_signature"]
+            "status": "partial",
+            "error": f"Error al añadir canciones a playlist: {str(e)}",
+            "playlist": {"id": playlist["id"], "name": playlist["name"], "url": playlist["external_urls"]["spotify"]},
+            "added": added,
+            # Las que faltan se pueden añadir con add_tracks_to_playlist y las consultas sin procesar, reintentar
+            "remaining_track_ids": track_ids[added:],
+            "next_query_index": next_index,
+            "unresolved": unresolved,
+            "snapshot_id": snapshot_id
         }
+    finally:
+        resolver.cancel()
+        creator.cancel()
+    
+    return {
+        "status": "success",
+        "playlist": {"id": playlist["id"], "name": playlist["name"], "url": playlist["external_urls"]["spotify"]},
+        "queries": len(queries),
+        "added": added,
+        "duplicates_skipped": duplicates,
+        "unresolved": unresolved,
+        "snapshot_id": snapshot_id,
+        "seconds": round(time.perf_counter() - started, 2)
+    }
+
+@tool()
+async def get_audio_features(track_id: Optional[str] = None, track_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Obtener características de audio de una o varias canciones en Spotify.
+    
+    Args:
+        track_id: ID de una canción
+        track_ids: Lista de IDs para consultar en lote (se agrupan de 100 en 100)
+        
+    Returns:
+        Características de la canción, o un diccionario por ID en modo lote
+    """
+    # Verificar autenticación
+    api = await get_api_client()
+    if not api:
+        return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
+    
+    if not track_id and not track_ids:
+        return {"error": "No se proporcionaron IDs de canciones"}
+    
+    # Obtener características
+    try:
+        if track_ids:
+            return await fetch_audio_features(track_ids + ([track_id] if track_id else []))
+        
+        result = await fetch_audio_features([track_id])
+        features = result["features"][track_id]
+        if features is None:
+            if result["errors"]:
+                raise Exception(result["errors"][0])
+            return {"error": f"No hay características de audio para la canción {track_id}"}
+        
+        return features
     except Exception as e:
-        log(f"Error al obtener características de audio: {str(e)}")
+        log(f"Error al obtener características de audio: {str(e)}", level=logging.ERROR)
         return {"error": f"Error al obtener características de audio: {str(e)}"}
 
-@mcp.tool()
-def get_profile() -> Dict[str, Any]:
-    """Obtener información del perfil de usuario en Spotify."""
-    global spotify
+@tool()
+async def find_similar_tracks(track_id: str, limit: int = 10, features: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Buscar las canciones más parecidas a otra entre las que esta cuenta ya consultó con get_audio_features.
+    No hace peticiones a la API: las canciones se incorporan al consultarlas con get_audio_features.
+    
+    Args:
+        track_id: ID de la canción de referencia
+        limit: Número de canciones a devolver
+        features: Características a comparar (por defecto todas), por ejemplo ["energy", "valence", "tempo"]
+        
+    Returns:
+        Canciones más cercanas con su distancia y los valores de las características comparadas
+    """
+    if optional_module("numpy") is None:
+        return {"error": "La búsqueda de canciones similares requiere el paquete numpy"}
+    
+    features = features or list(SIMILARITY_FEATURES)
+    unknown = [name for name in features if name not in SIMILARITY_FEATURES]
+    if unknown:
+        return {"error": f"Características no válidas: {', '.join(unknown)}. Disponibles: {', '.join(SIMILARITY_FEATURES)}"}
+    
+    similarity_index = current_session().similarity_index
+    if track_id not in similarity_index:
+        return {"error": f"La canción {track_id} no está entre las consultadas por esta cuenta. Consulta antes get_audio_features."}
+    
+    neighbours = similarity_index.nearest(track_id, limit, features)
+    return {
+        "track_id": track_id,
+        "compared_features": features,
+        "candidates": len(similarity_index) - 1,
+        "similar": [{
+            "id": neighbour_id,
+            "distance": round(distance, 4),
+            **similarity_index.values(neighbour_id, features)
+        } for neighbour_id, distance in neighbours]
+    }
+
+@tool()
+async def get_profile(refresh: bool = False, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Obtener información del perfil de usuario en Spotify.
+    
+    Args:
+        refresh: Consultar de nuevo a Spotify en lugar de usar el perfil en caché
+        fields: Campos a devolver (id, display_name, email, country, product, followers, images)
+    """
+    try:
+        fields = ProfileRecord.select_fields(fields)
+    except ValueError as e:
+        return {"error": str(e)}
     
     # Verificar autenticación
-    if not spotify:
-        spotify = initialize_spotify_client()
-        if not spotify:
-            return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
+    api = await get_api_client()
+    if not api:
+        return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
     
     # Obtener perfil
     try:
-        user = spotify.me()
+        user = await get_current_user(api, refresh=refresh)
         
-        return {
-            "id": user["id"],
-            "display_name": user["display_name"],
-            "email": user.get("email", ""),
-            "country": user.get("country", ""),
-            "product": user["product"],
-            "followers": user["followers"]["total"],
-            "images": user["images"]
-        }
+        return ProfileRecord.from_api(user).as_dict(fields)
     except Exception as e:
-        log(f"Error al obtener perfil: {str(e)}")
+        log(f"Error al obtener perfil: {str(e)}", level=logging.ERROR)
         return {"error": f"Error al obtener perfil: {str(e)}"}
 
-@mcp.tool()
-def add_tracks_to_playlist(playlist_id: str, track_ids: List[str]) -> Dict[str, Any]:
+@tool()
+async def add_tracks_to_playlist(playlist_id: str, track_ids: List[str], start_chunk: int = 0, skip_existing: bool = False) -> Dict[str, Any]:
     """
     Añadir canciones a una playlist existente en Spotify.
     
+    Las canciones se envían en bloques de 100, en orden. Si un bloque falla,
+    la respuesta indica qué bloques se completaron y desde cuál reintentar.
+    
     Args:
         playlist_id: ID de la playlist a la que se añadirán las canciones
         track_ids: Lista de IDs de las canciones a añadir
+        start_chunk: Índice del bloque desde el que continuar (para reanudar un envío fallido)
+        skip_existing: No añadir canciones que ya estén en la playlist
         
     Returns:
         Información sobre el resultado de la operación
     """
-    global spotify
-    
     # Verificar autenticación
-    if not spotify:
-        spotify = initialize_spotify_client()
-        if not spotify:
-            return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
+    api = await get_api_client()
+    if not api:
+        return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
     
     # Verificar que hay tracks para añadir
     if not track_ids:
         return {"error": "No se proporcionaron IDs de canciones para añadir"}
     
-    # Convertir IDs a formato URI de Spotify
-    track_uris = [f"spotify:track:{track_id}" for track_id in track_ids]
-    log(f"Añadiendo {len(track_uris)} canciones a la playlist {playlist_id}")
+    # Los bloques se calculan sobre la lista original para que start_chunk sea estable entre reintentos
+    chunks = chunked(track_ids, PLAYLIST_ADD_BATCH_SIZE)
+    if start_chunk < 0 or start_chunk >= len(chunks):
+        return {"error": f"start_chunk debe estar entre 0 y {len(chunks) - 1}"}
+    
+    existing_ids = set()
+    if skip_existing:
+        try:
+            with priority(PRIORITY_BULK):
+                existing_ids = await fetch_playlist_track_ids(playlist_id)
+        except Exception as e:
+            log(f"Error al leer canciones de la playlist: {str(e)}", level=logging.ERROR)
+            return {"error": f"Error al leer canciones de la playlist: {str(e)}"}
+    
+    log(f"Añadiendo {len(track_ids)} canciones a la playlist {playlist_id} en {len(chunks)} bloques")
+    
+    snapshot_id = None
+    completed_chunks = []
+    added = 0
+    skipped = 0
+    
+    # Añadir tracks a la playlist, bloque a bloque y en orden
+    for index in range(start_chunk, len(chunks)):
+        chunk = [track_id for track_id in chunks[index] if track_id not in existing_ids]
+        skipped += len(chunks[index]) - len(chunk)
+        
+        if chunk:
+            # Convertir IDs a formato URI de Spotify
+            track_uris = [f"spotify:track:{track_id}" for track_id in chunk]
+            try:
+                # Los bloques son trabajo masivo: play/pause y las búsquedas pasan antes
+                with priority(PRIORITY_BULK):
+                    result = await api.playlist_add_items(playlist_id, track_uris)
+                snapshot_id = result["snapshot_id"]
+            except Exception as e:
+                log(f"Error al añadir el bloque {index} a la playlist: {str(e)}", level=logging.ERROR)
+                return {
+                    "status": "partial" if completed_chunks else "error",
+                    "error": f"Error al añadir canciones a playlist: {str(e)}",
+                    "added": added,
+                    "skipped": skipped,
+                    "chunks_total": len(chunks),
+                    "completed_chunks": completed_chunks,
+                    "next_chunk": index,
+                    "snapshot_id": snapshot_id
+                }
+            
+            added += len(chunk)
+            log(f"Bloque {index + 1}/{len(chunks)} añadido ({added} canciones)", level=logging.DEBUG)
+        
+        completed_chunks.append(index)
+    
+    return {
+        "status": "success",
+        "message": f"Se añadieron {added} canciones a la playlist",
+        "added": added,
+        "skipped": skipped,
+        "chunks_total": len(chunks),
+        "completed_chunks": completed_chunks,
+        "snapshot_id": snapshot_id
+    }
+
+@tool()
+async def sync_playlist(playlist_id: str, track_ids: List[str], snapshot_id: Optional[str] = None,
+                        dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Dejar una playlist exactamente con las canciones indicadas, en ese orden, con el mínimo de peticiones.
+    
+    Lee la playlist una vez, calcula qué quitar, mover e insertar (diff por subsecuencia común más larga)
+    y aplica las operaciones por lotes encadenando el snapshot_id para detectar cambios concurrentes.
+    
+    Args:
+        playlist_id: ID de la playlist
+        track_ids: IDs de las canciones en el orden deseado (se admiten repeticiones)
+        snapshot_id: Si se indica, no se toca la playlist si su snapshot_id actual es otro
+        dry_run: Solo calcular las operaciones, sin aplicarlas
+        
+    Returns:
+        Número de canciones quitadas, movidas, insertadas y sin cambios, peticiones hechas y snapshot_id final
+    """
+    # Verificar autenticación
+    api = await get_api_client()
+    if not api:
+        return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
+    
+    desired = [f"spotify:track:{track_id}" for track_id in track_ids]
     
-    # Añadir tracks a la playlist
     try:
-        result = spotify.playlist_add_items(playlist_id, track_uris)
-        return {
-            "status": "success",
-            "message": f"Se añadieron {len(track_ids)} canciones a la playlist",
-            "snapshot_id": result["snapshot_id"]
-        }
+        with priority(PRIORITY_BULK):
+            current_snapshot = (await api.playlist(playlist_id, fields="snapshot_id"))["snapshot_id"]
+            if snapshot_id and snapshot_id != current_snapshot:
+                return {"error": f"La playlist cambió: snapshot_id actual {current_snapshot}", "snapshot_id": current_snapshot}
+            current = await fetch_playlist_uris(playlist_id)
     except Exception as e:
-        log(f"Error al añadir canciones a playlist: {str(e)}")
-        return {"error": f"Error al añadir canciones a playlist: {str(e)}"}
+        log(f"Error al leer la playlist: {str(e)}", level=logging.ERROR)
+        return {"error": f"Error al leer la playlist: {str(e)}"}
+    
+    operations, unchanged = await asyncio.to_thread(plan_playlist_sync, current, desired)
+    summary = {
+        "removed": sum(len(operation[1]) for operation in operations if operation[0] == "remove"),
+        "moved": sum(operation[2] for operation in operations if operation[0] == "reorder"),
+        "inserted": sum(len(operation[1]) for operation in operations if operation[0] == "insert"),
+        "unchanged": unchanged,
+        "operations": len(operations)
+    }
+    if dry_run or not operations:
+        return dict(summary, status="dry_run" if dry_run else "success", snapshot_id=current_snapshot)
+    
+    log(f"Sincronizando playlist {playlist_id}: {len(operations)} operaciones")
+    
+    # Aplicar en orden; cada operación lleva el snapshot_id que dejó la anterior
+    for index, operation in enumerate(operations):
+        try:
+            # Las operaciones de la sincronización son trabajo masivo, como los bloques de add_tracks_to_playlist
+            with priority(PRIORITY_BULK):
+                if operation[0] == "remove":
+                    items = {}
+                    for uri, position in operation[1]:
+                        items.setdefault(uri, []).append(position)
+                    result = await api.playlist_remove_specific_occurrences_of_items(
+                        playlist_id, [{"uri": uri, "positions": positions} for uri, positions in items.items()], snapshot_id=current_snapshot
+                    )
+                elif operation[0] == "reorder":
+                    _, start, length, insert_before = operation
+                    result = await api.playlist_reorder_items(
+                        playlist_id, start, insert_before, range_length=length, snapshot_id=current_snapshot
+                    )
+                else:
+                    _, uris, position = operation
+                    result = await api.playlist_add_items(playlist_id, uris, position=position)
+            current_snapshot = result["snapshot_id"]
+        except Exception as e:
+            log(f"Error en la operación {index + 1}/{len(operations)} de la sincronización: {str(e)}", level=logging.ERROR)
+            conflict = isinstance(e, SpotifyAPIError) and e.status in (400, 409)
+            return dict(
+                summary,
+                status="partial" if index else "error",
+                error=f"{'La playlist cambió durante la sincronización' if conflict else 'Error al sincronizar la playlist'}: {str(e)}. "
+                      "Vuelve a ejecutar sync_playlist para completarla",
+                applied_operations=index,
+                snapshot_id=current_snapshot
+            )
+    
+    return dict(summary, status="success", snapshot_id=current_snapshot)
 
-@mcp.tool()
-def get_user_playlists(limit: int = 20) -> List[Dict[str, Any]]:
+@tool()
+async def get_user_playlists(limit: int = 20, fetch_all: bool = False, fields: Optional[List[str]] = None,
+                             compact: bool = False) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
     """
     Obtener las playlists del usuario actual.
     
     Args:
-        limit: Número máximo de playlists a obtener
+        limit: Número máximo de playlists a obtener (más de 50 se piden en varias páginas)
+        fetch_all: Obtener todas las playlists de la cuenta, ignorando limit
+        fields: Campos a devolver (id, name, owner, public, tracks_total, url)
+        compact: Devolver {"fields": [...], "rows": [[...], ...]} en lugar de una lista de objetos
         
     Returns:
         Lista de playlists del usuario
     """
-    global spotify
+    try:
+        fields = PlaylistRecord.select_fields(fields)
+    except ValueError as e:
+        return [{"error": str(e)}]
     
     # Verificar autenticación
-    if not spotify:
-        spotify = initialize_spotify_client()
-        if not spotify:
-            return [{"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}]
+    api = await get_api_client()
+    if not api:
+        return [{"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}]
     
     # Obtener playlists
     try:
-        playlists = spotify.current_user_playlists(limit=limit)
+        if fetch_all or limit > PLAYLISTS_PAGE_SIZE:
+            with priority(PRIORITY_BULK):
+                playlists = await fetch_user_playlists(None if fetch_all else limit)
+        else:
+            playlists = (await api.current_user_playlists(limit=limit))["items"]
         
-        return [{
-            "id": playlist["id"],
-            "name": playlist["name"],
-            "owner": playlist["owner"]["display_name"],
-            "public": playlist["public"],
-            "tracks_total": playlist["tracks"]["total"],
-            "url": playlist["external_urls"]["spotify"]
-        } for playlist in playlists["items"]]
+        return project_records([PlaylistRecord.from_api(playlist) for playlist in playlists], fields, compact)
     except Exception as e:
-        log(f"Error al obtener playlists: {str(e)}")
+        log(f"Error al obtener playlists: {str(e)}", level=logging.ERROR)
         return [{"error": f"Error al obtener playlists: {str(e)}"}]
 
+@tool()
+async def get_user_playlists_page(cursor: Optional[str] = None, limit: int = 50, fields: Optional[List[str]] = None,
+                                  compact: bool = False) -> Dict[str, Any]:
+    """
+    Obtener una página de las playlists del usuario actual.
+    
+    Args:
+        cursor: Cursor devuelto por la llamada anterior (vacío para la primera página)
+        limit: Número de playlists por página (máximo 50)
+        fields: Campos a devolver (id, name, owner, public, tracks_total, url)
+        compact: Devolver items como {"fields": [...], "rows": [[...], ...]}
+        
+    Returns:
+        Playlists de la página, total de la cuenta y cursor de la siguiente página
+    """
+    # Verificar autenticación
+    api = await get_api_client()
+    if not api:
+        return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
+    
+    try:
+        fields = PlaylistRecord.select_fields(fields)
+        offset, page_size = decode_cursor(cursor) if cursor else (0, min(max(limit, 1), PLAYLISTS_PAGE_SIZE))
+    except ValueError as e:
+        return {"error": str(e)}
+    
+    # Obtener la página solicitada
+    try:
+        page = await api.current_user_playlists(limit=page_size, offset=offset)
+        next_offset = offset + len(page["items"])
+        
+        return {
+            "items": project_records([PlaylistRecord.from_api(playlist) for playlist in page["items"]], fields, compact),
+            "total": page["total"],
+            "next_cursor": encode_cursor(next_offset, page_size) if page["items"] and next_offset < page["total"] else None
+        }
+    except Exception as e:
+        log(f"Error al obtener playlists: {str(e)}", level=logging.ERROR)
+        return {"error": f"Error al obtener playlists: {str(e)}"}
+
+@tool()
+async def sync_library(full: bool = False) -> Dict[str, Any]:
+    """
+    Sincronizar el índice local de la biblioteca (canciones guardadas y playlists).
+    
+    La sincronización es incremental: solo se leen las playlists cuyo snapshot_id cambió
+    y las canciones guardadas añadidas desde la última vez.
+    
+    Args:
+        full: Volver a leer toda la biblioteca
+        
+    Returns:
+        Resumen de los cambios aplicados al índice
+    """
+    # Verificar autenticación
+    api = await get_api_client()
+    if not api:
+        return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
+    
+    started = time.perf_counter()
+    try:
+        # El índice pertenece a un usuario; si cambia, se empieza de cero
+        library = current_session().library
+        user_id = (await get_current_user(api))["id"]
+        if await asyncio.to_thread(library.get_meta, "user_id") != user_id:
+            await asyncio.to_thread(library.reset, user_id)
+            full = True
+        
+        with priority(PRIORITY_BULK):
+            # Si una parte falla, la otra se cancela en vez de seguir escribiendo en el índice
+            playlists_result, saved_added = await gather_with_limit(lambda sync: sync(full), [sync_playlists, sync_saved_tracks])
+        
+        elapsed = time.perf_counter() - started
+        await asyncio.to_thread(library.set_meta, "last_sync", time.time())
+        await asyncio.to_thread(library.set_meta, "last_sync_seconds", round(elapsed, 2))
+        
+        return {
+            "status": "success",
+            "playlists_updated": playlists_result["updated"],
+            "playlists_unchanged": playlists_result["unchanged"],
+            "playlists_removed": playlists_result["removed"],
+            "saved_tracks_added": saved_added,
+            "seconds": round(elapsed, 2)
+        }
+    except Exception as e:
+        log(f"Error al sincronizar la biblioteca: {str(e)}", level=logging.ERROR)
+        return {"error": f"Error al sincronizar la biblioteca: {str(e)}"}
+
+@tool()
+async def search_library(query: str, limit: int = 20, source: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Buscar canciones en la biblioteca del usuario sin conexión, usando el índice local.
+    
+    Args:
+        query: Texto de búsqueda (nombre, artista o álbum)
+        limit: Número máximo de resultados
+        source: "saved" para buscar solo en canciones guardadas, "playlists" solo en playlists
+        
+    Returns:
+        Canciones encontradas, indicando si están guardadas y en qué playlists aparecen
+    """
+    if source not in (None, "saved", "playlists"):
+        return [{"error": "source debe ser 'saved' o 'playlists'"}]
+    
+    try:
+        return await asyncio.to_thread(current_session().library.search, query, limit, source)
+    except Exception as e:
+        log(f"Error al buscar en la biblioteca: {str(e)}", level=logging.ERROR)
+        return [{"error": f"Error al buscar en la biblioteca: {str(e)}"}]
+
+@tool()
+async def library_sync_status() -> Dict[str, Any]:
+    """
+    Obtener el estado del índice local de la biblioteca.
+    
+    Returns:
+        Número de canciones, playlists y elementos indexados y fecha de la última sincronización
+    """
+    try:
+        return await asyncio.to_thread(current_session().library.status)
+    except Exception as e:
+        log(f"Error al leer el índice de la biblioteca: {str(e)}", level=logging.ERROR)
+        return {"error": f"Error al leer el índice de la biblioteca: {str(e)}"}
+
+@tool()
+async def export_listening_data(
+    dataset: str,
+    path: str,
+    format: str = "ndjson",
+    time_range: str = "medium_term",
+    max_items: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Exportar el historial de escucha, los rankings o las canciones guardadas a un fichero.
+    
+    Los datos se piden y escriben página a página, sin cargarlos en memoria. La exportación es
+    reanudable: al volver a llamar con el mismo fichero se continúa donde terminó la anterior y solo
+    se añaden datos nuevos (reproducciones posteriores, canciones guardadas desde entonces o una
+    nueva instantánea del ranking, como mucho una al día).
+    
+    Args:
+        dataset: "recently_played", "top_tracks", "top_artists" o "saved_tracks"
+        path: Fichero de destino, relativo a SPOTIFY_MCP_EXPORT_DIR
+        format: "ndjson" (una fila JSON por línea) o "columnar" (una línea por página con "fields" y "columns")
+        time_range: Periodo de los rankings: "short_term", "medium_term" o "long_term"
+        max_items: Detenerse tras escribir al menos este número de filas; la siguiente llamada continúa
+        
+    Returns:
+        Filas escritas en esta llamada, total del fichero y si la exportación llegó al final
+    """
+    if dataset not in EXPORT_DATASETS:
+        return {"error": f"dataset debe ser uno de: {', '.join(EXPORT_DATASETS)}"}
+    if format not in EXPORT_FORMATS:
+        return {"error": f"format debe ser uno de: {', '.join(EXPORT_FORMATS)}"}
+    if dataset.startswith("top_") and time_range not in TOP_TIME_RANGES:
+        return {"error": f"time_range debe ser uno de: {', '.join(TOP_TIME_RANGES)}"}
+    
+    # Verificar autenticación
+    api = await get_api_client()
+    if not api:
+        return {"error": "No autenticado. Usa login() para iniciar sesión en Spotify."}
+    
+    try:
+        target = export_path(path)
+    except ValueError as e:
+        return {"error": str(e)}
+    # Dos exportaciones a la vez sobre el mismo fichero lo corromperían
+    if target in active_exports:
+        return {"error": f"Ya hay una exportación en curso en {target}"}
+    
+    active_exports.add(target)
+    try:
+        user_id = (await get_current_user(api))["id"]
+        time_range = time_range if dataset.startswith("top_") else None
+        state = await asyncio.to_thread(load_export_state, target, dataset, format, time_range, user_id)
+        
+        if dataset == "saved_tracks":
+            pages = export_saved_tracks(state["cursor"])
+        elif dataset == "recently_played":
+            pages = export_recently_played(state["cursor"])
+        else:
+            pages = export_top_items(dataset[len("top_"):], time_range, state["cursor"])
+        
+        with priority(PRIORITY_BULK):
+            written, complete = await run_export(pages, target, state, max_items)
+        
+        return {
+            "status": "success",
+            "dataset": dataset,
+            "path": target,
+            "format": format,
+            "rows_written": written,
+            "total_rows": state["rows"],
+            "bytes": state["bytes"],
+            "complete": complete
+        }
+    except ValueError as e:
+        return {"error": str(e)}
+    except Exception as e:
+        log(f"Error al exportar {dataset}: {str(e)}", level=logging.ERROR)
+        return {"error": f"Error al exportar {dataset}: {str(e)}. La siguiente llamada continuará desde la última página escrita."}
+    finally:
+        active_exports.discard(target)
+
+@tool()
+async def get_rate_limit_status() -> Dict[str, Any]:
+    """
+    Obtener el estado del planificador de peticiones a Spotify.
+    
+    Returns:
+        Peticiones en cola, tokens disponibles, respuestas 429 recibidas y reintentos
+    """
+    return scheduler.stats()
+
+# Estadísticas completas del servidor: herramientas, API, cachés, planificador y token
+def collect_stats():
+    stats = metrics.snapshot()
+    stats["caches"] = {
+        "search": search_cache.stats(),
+        "audio_features": audio_features_cache.stats(),
+        "http": http_cache.stats() if http_cache else {"enabled": False}
+    }
+    stats["scheduler"] = scheduler.stats()
+    similarity_index = current_session().similarity_index
+    stats["similarity_index"] = {
+        "tracks": len(similarity_index),
+        "max_tracks": similarity_index.max_tracks,
+        "evictions": similarity_index.evictions,
+        "enabled": optional_module("numpy") is not None
+    }
+    token_info = current_session().token_info
+    stats["token"] = {
+        "refreshes": token_refresher.refreshes,
+        "refresh_failures": token_refresher.failures,
+        "expires_in_seconds": int(token_info['expires_at'] - time.time()) if token_info and 'expires_at' in token_info else None
+    }
+    stats["sessions"] = sessions.stats()
+    stats["now_playing"] = current_session().now_playing.stats()
+    stats["resilience"] = resilience.stats()
+    stats["logging"] = log_stats()
+    return stats
+
+@tool()
+async def server_stats() -> Dict[str, Any]:
+    """
+    Obtener métricas del servidor.
+    
+    Returns:
+        Latencia y errores por herramienta, llamadas a la API por endpoint, aciertos de caché,
+        reintentos y respuestas 429, y estado del token
+    """
+    return collect_stats()
+
+# Escapar valores de etiquetas en el formato de texto de Prometheus
+def prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# Exportar un histograma en formato Prometheus
+def prometheus_histogram(lines, name, labels, histogram):
+    cumulative = 0
+    for bucket, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bucket}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+# Generar todas las métricas en el formato de texto de Prometheus
+def prometheus_metrics():
+    lines = []
+    with metrics._lock:
+        lines.append("# TYPE spotify_mcp_tool_duration_seconds histogram")
+        for tool_name, histogram in metrics.tool_latency.items():
+            prometheus_histogram(lines, "spotify_mcp_tool_duration_seconds", f'tool="{tool_name}"', histogram)
+        lines.append("# TYPE spotify_mcp_tool_errors_total counter")
+        for tool_name, count in metrics.tool_errors.items():
+            lines.append(f'spotify_mcp_tool_errors_total{{tool="{tool_name}"}} {count}')
+        lines.append("# TYPE spotify_mcp_tool_payload_bytes histogram")
+        for tool_name, histogram in metrics.tool_payload.items():
+            prometheus_histogram(lines, "spotify_mcp_tool_payload_bytes", f'tool="{tool_name}"', histogram)
+        lines.append("# TYPE spotify_mcp_upstream_requests_total counter")
+        for (endpoint, status), count in metrics.upstream_calls.items():
+            lines.append(f'spotify_mcp_upstream_requests_total{{endpoint="{prometheus_label(endpoint)}",status="{status}"}} {count}')
+        lines.append("# TYPE spotify_mcp_upstream_coalesced_total counter")
+        for endpoint, count in metrics.upstream_coalesced.items():
+            lines.append(f'spotify_mcp_upstream_coalesced_total{{endpoint="{prometheus_label(endpoint)}"}} {count}')
+        lines.append("# TYPE spotify_mcp_upstream_duration_seconds histogram")
+        for endpoint, histogram in metrics.upstream_latency.items():
+            prometheus_histogram(lines, "spotify_mcp_upstream_duration_seconds", f'endpoint="{prometheus_label(endpoint)}"', histogram)
+        lines.append("# TYPE spotify_mcp_upstream_payload_bytes histogram")
+        for endpoint, histogram in metrics.upstream_payload.items():
+            prometheus_histogram(lines, "spotify_mcp_upstream_payload_bytes", f'endpoint="{prometheus_label(endpoint)}"', histogram)
+    
+    for cache_name, cache in (("search", search_cache), ("audio_features", audio_features_cache)):
+        cache_stats = cache.stats()
+        lines.append(f'spotify_mcp_cache_hits_total{{cache="{cache_name}"}} {cache_stats["hits"]}')
+        lines.append(f'spotify_mcp_cache_misses_total{{cache="{cache_name}"}} {cache_stats["misses"]}')
+        lines.append(f'spotify_mcp_cache_entries{{cache="{cache_name}"}} {cache_stats["entries"]}')
+    if http_cache:
+        http_stats = http_cache.stats()
+        lines.append(f'spotify_mcp_cache_hits_total{{cache="http"}} {http_stats["hits"]}')
+        lines.append(f'spotify_mcp_cache_misses_total{{cache="http"}} {http_stats["misses"]}')
+        lines.append(f'spotify_mcp_cache_entries{{cache="http"}} {http_stats["entries"] or 0}')
+        lines.append(f"spotify_mcp_http_cache_revalidations_total {http_stats['revalidations']}")
+        lines.append(f"spotify_mcp_http_cache_bytes {http_stats['bytes']}")
+    
+    scheduler_stats = scheduler.stats()
+    lines.append(f"spotify_mcp_scheduler_queue_depth {scheduler_stats['queue_depth']}")
+    lines.append(f"spotify_mcp_rate_limited_total {scheduler_stats['throttled']}")
+    lines.append(f"spotify_mcp_retries_total {scheduler_stats['retries']}")
+    lines.append(f"spotify_mcp_token_refreshes_total {token_refresher.refreshes}")
+    session_stats = sessions.stats()
+    lines.append(f"spotify_mcp_sessions {session_stats['active']}")
+    lines.append(f"spotify_mcp_sessions_authenticated {session_stats['authenticated']}")
+    lines.append(f"spotify_mcp_session_evictions_total {session_stats['evictions']}")
+    lines.append(f"spotify_mcp_hedged_requests_total {sum(resilience.hedged.values())}")
+    lines.append(f"spotify_mcp_hedge_wins_total {sum(resilience.hedge_wins.values())}")
+    for endpoint, count in resilience.deadline_exceeded.items():
+        lines.append(f'spotify_mcp_deadline_exceeded_total{{endpoint="{prometheus_label(endpoint)}"}} {count}')
+    for endpoint, count in resilience.stale_served.items():
+        lines.append(f'spotify_mcp_stale_responses_total{{endpoint="{prometheus_label(endpoint)}"}} {count}')
+    for endpoint, breaker in resilience.breakers.items():
+        lines.append(f'spotify_mcp_circuit_open{{endpoint="{prometheus_label(endpoint)}"}} {int(breaker.state != "closed")}')
+        lines.append(f'spotify_mcp_circuit_rejections_total{{endpoint="{prometheus_label(endpoint)}"}} {breaker.rejected}')
+    logging_stats = log_stats()
+    lines.append(f'spotify_mcp_log_discarded_total{{reason="queue_full"}} {logging_stats["dropped"]}')
+    lines.append(f'spotify_mcp_log_discarded_total{{reason="rate_limited"}} {logging_stats["rate_limited"]}')
+    lines.append(f'spotify_mcp_log_discarded_total{{reason="sampled"}} {logging_stats["sampled_out"]}')
+    return "\n".join(lines) + "\n"
+
+# Handler HTTP para el endpoint de métricas de Prometheus
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+    
+    def do_GET(self):
+        if urlparse(self.path).path != "/metrics":
+            self.send_response(404)
+            self.send_header('Content-type', 'text/plain')
+            self.end_headers()
+            self.wfile.write(b"Not Found")
+            return
+        
+        body = prometheus_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# Iniciar el endpoint de métricas en un hilo en segundo plano
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except Exception as e:
+        log(f"No se pudo iniciar el endpoint de métricas: {str(e)}", level=logging.WARNING)
+        return None
+    
+    server.daemon_threads = True
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    log(f"Métricas de Prometheus disponibles en http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+# Aplicación ASGI de un worker HTTP (uvicorn la crea con factory=True en cada proceso)
+def create_http_app(transport=None):
+    transport = transport or HTTP_TRANSPORT
+    if transport == "sse":
+        return mcp.sse_app()
+    
+    # Con varios workers cada petición puede llegar a un proceso distinto: sin sesiones MCP en memoria
+    # La cuenta no depende de esto: la elige siempre el secreto de la petición (ver resolve_session_key)
+    mcp.settings.stateless_http = HTTP_WORKERS > 1
+    # Cada worker es un proceso nuevo que calienta su propia sesión por defecto
+    start_warm_up()
+    return mcp.streamable_http_app()
+
+# Servir el MCP por HTTP (streamable) o SSE con uno o varios workers de uvicorn
+def run_http_server(transport, host, port, workers):
+    import uvicorn
+    
+    if workers > 1:
+        if transport == "sse":
+            log("El transporte SSE guarda las sesiones en memoria: usa un solo worker o --transport http", level=logging.WARNING)
+            return 1
+        if shared_store is None or optional_module("cryptography.fernet") is None:
+            log("Con varios workers hace falta SPOTIFY_MCP_SHARED_BACKEND y el paquete cryptography para compartir tokens", level=logging.WARNING)
+            return 1
+        
+        # Los workers son procesos nuevos que leen la configuración del entorno
+        os.environ["SPOTIFY_MCP_TRANSPORT"] = transport
+        os.environ["SPOTIFY_MCP_WORKERS"] = str(workers)
+        log(f"Servidor MCP ({transport}) en http://{host}:{port} con {workers} workers")
+        uvicorn.run(
+            "fixed_server:create_http_app",
+            factory=True,
+            host=host,
+            port=port,
+            workers=workers,
+            app_dir=os.path.dirname(os.path.abspath(__file__)),
+            log_level="warning"
+        )
+    else:
+        log(f"Servidor MCP ({transport}) en http://{host}:{port}")
+        uvicorn.run(create_http_app(transport), host=host, port=port, log_level="warning")
+    return 0
+
+# Calentamiento: recuperar y verificar el token guardado y cargar los módulos diferidos
+# La verificación hace una petición a Spotify; en segundo plano no retrasa el handshake de MCP,
+# y las herramientas que lleguen antes esperan a la misma verificación en lugar de repetirla
+def warm_up():
+    with startup_profile.phase("calentamiento: token y verificación del cliente"):
+        authenticated = initialize_spotify_client(sessions.get(DEFAULT_SESSION))
+    if authenticated:
+        log("Sesión por defecto autenticada.")
+    else:
+        log("Sin autenticación previa. Usa login() para autenticarte.")
+    
+    with startup_profile.phase("calentamiento: numpy"):
+        optional_module("numpy")
+    return authenticated
+
+# Lanzar el calentamiento una sola vez por proceso
+@functools.lru_cache(maxsize=None)
+def start_warm_up():
+    thread = threading.Thread(target=warm_up, name="warm-up")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Spotify MCP Server")
+    parser.add_argument("--transport", choices=("stdio", "http", "sse"), default=HTTP_TRANSPORT, help="Transporte MCP")
+    parser.add_argument("--host", default=HTTP_HOST, help="Dirección del servidor HTTP")
+    parser.add_argument("--port", type=int, default=HTTP_PORT, help="Puerto del servidor HTTP")
+    parser.add_argument("--workers", type=int, default=HTTP_WORKERS, help="Procesos de uvicorn (solo --transport http)")
+    parser.add_argument("--profile-startup", action="store_true", help="Medir el tiempo de cada fase del arranque y salir")
+    return parser.parse_args(argv)
+
+startup_profile.mark("import: configuración, clases y registro de herramientas")
+
 if __name__ == "__main__":
+    args = parse_args()
+    
+    # Ejecutar el calentamiento en primer plano para medirlo, mostrar las fases y salir
+    if args.profile_startup:
+        warm_up()
+        print(startup_profile.report())
+        sys.exit(0)
+    
     log("Iniciando Spotify MCP Server (Versión Memoria)...")
+    log(f"Usando URI de redirección fija: {SPOTIFY_REDIRECT_URI}")
     
-    # Intentar inicializar cliente al inicio
-    spotify = initialize_spotify_client()
+    # Verificar el token guardado sin bloquear la respuesta al handshake
+    start_warm_up()
     
-    if spotify:
-        log("Servidor iniciado con autenticación exitosa.")
-    else:
-        log("Servidor iniciado sin autenticación. Usa login() para autenticarte.")
+    # Endpoint de métricas opcional (con varios workers cada proceso tiene sus propias métricas)
+    if METRICS_PORT and args.workers <= 1:
+        start_metrics_server()
     
     # Ejecutar servidor MCP
-    mcp.run() 
\ No newline at end of file
+    if args.transport == "stdio":
+        mcp.run()
+    else:
+        sys.exit(run_http_server(args.transport, args.host, args.port, args.workers))